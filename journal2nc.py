@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+# Converts the binary step journal of a superparametrization run (spmaster.py --journal)
+# into the usual netCDF output file.
+#
+# usage: python journal2nc.py output/spifs.nc
+
+from __future__ import print_function
+import argparse
+import logging
+
+from splib import spjournal
+
+logging.basicConfig(level=logging.INFO)
+
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description="Convert a spifs step journal to netCDF")
+    parser.add_argument("nc_name", metavar="FILE.nc",
+                        help="netCDF file to create, the journal is read from the .journal and .journal.json files "
+                             "with the same base name")
+    parser.add_argument("--journal", metavar="FILE", default=None,
+                        help="Journal file, if not named after the netCDF file")
+    parser.add_argument("--layout", metavar="FILE", default=None,
+                        help="Journal layout file, if not named after the netCDF file")
+    args = parser.parse_args()
+    n = spjournal.convert(args.nc_name, args.journal, args.layout)
+    print("Converted %d time steps into %s" % (n, args.nc_name))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+
+# Dedicated I/O rank for superparametrization runs with the nospawn channel.
+# Writes the netCDF output for the master, see the --io_ranks option of spmaster.py.
+# Launch after the model workers, e.g.
+#   mpiexec -n 1 python2 ./spmaster.py --channel=nospawn --io_ranks 2 ... : -n 1 openifs_worker : \
+#           -n 2 dales_worker : -n 2 python2 ./spio_rank.py
+
+import logging
+
+from splib import spmpi
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    spmpi.run_io_rank()
@@ -5,10 +5,8 @@ import logging
 import os
 import shutil
 
-from amuse.community import units
+from amuse.units import units
 
-import spdummy
-import ncmod
 import sputils
 
 # model type names
@@ -28,7 +26,7 @@ log = logging.getLogger(__name__)
 # Factory method for model creation
 # TODO: use kwargs...   
 def create_model(model_type, inputdir, workdir, nprocs=1, redirect="file", channel_type="mpi", restart=False,
-                 starttime=None, index=-1, qt_forcing="sp"):
+                 starttime=None, index=-1, qt_forcing="sp", trestart=43200, files=None, overlay=()):
     ofile = os.path.join(workdir, model_type + ".out")
     efile = os.path.join(workdir, model_type + ".err")
     if model_type == oifs_type:
@@ -68,9 +66,11 @@ def create_model(model_type, inputdir, workdir, nprocs=1, redirect="file", chann
                        "local": Dales.QT_FORCING_LOCAL}
 
         if not restart:
-            files = glob.glob(os.path.join(inputdir, '*'))
+            # the input file list can be passed in, to avoid listing the input directory for every instance
+            if files is None:
+                files = glob.glob(os.path.join(inputdir, '*'))
             log.info("Linking Dales input files from %s..." % inputdir)
-            sputils.link_dir(files, workdir)
+            sputils.link_dir(files, workdir, copies=overlay)
 
         dales = Dales(number_of_workers=nprocs,
                       redirection=redirect,
@@ -79,7 +79,7 @@ def create_model(model_type, inputdir, workdir, nprocs=1, redirect="file", chann
                       channel_type=channel_type,
                       workdir=workdir)  # , debugger='gdb')
         dales.parameters.restart_flag = restart
-        dales.parameters.trestart = 43200 | units.s  # TODO: make this adjustable
+        dales.parameters.trestart = trestart | units.s
         if starttime is not None:
             dales.parameters.starttime = starttime
         dales.parameters.qt_forcing = qt_forcings[qt_forcing]
@@ -87,19 +87,23 @@ def create_model(model_type, inputdir, workdir, nprocs=1, redirect="file", chann
         return dales
 
     elif model_type == dummy_gcm_type:
+        import spdummy
         dummy = spdummy.dummy_gcm(nprocs)
         setattr(dummy, "workdir", workdir)
         return dummy
 
     elif model_type == dummy_les_type:
+        import spdummy
         dummy = spdummy.dummy_les(nprocs)
         setattr(dummy, "workdir", workdir)
         return dummy
 
     elif model_type == ncfile_gcm_type:
+        import ncmod
         return ncmod.netcdf_gcm(os.path.join(inputdir, "spifs.nc"))
 
     elif model_type == ncfile_les_type:
+        import ncmod
         return ncmod.netcdf_les(os.path.join(inputdir, "spifs.nc"), index)
 
     else:
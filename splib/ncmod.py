@@ -5,7 +5,7 @@ import logging
 import netCDF4
 import numpy
 import parser
-from amuse.community import units
+from amuse.units import units
 from amuse.community.interface.common import CommonCode
 
 # Logger
@@ -119,6 +119,9 @@ class netcdf_gcm(netcdf_model_base):
         else:
             log.error("Attempt to add index %d to sp mask, which is out of range for this netcdf file-based model" % i)
 
+    def reset_mask(self, i):
+        self.mask.discard(i)
+
     def get_field(self, name, i, k):
         group_name = self.group_names[i]
         vardict = self.dataset.groups[group_name].variables[name]
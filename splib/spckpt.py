@@ -0,0 +1,98 @@
+import logging
+import os
+
+import numpy
+from amuse.units import units
+
+import spcpl
+import spio
+
+# Coupler checkpoints: the state needed to resume a run without scanning the netCDF history,
+# i.e. the last gcm tendencies of every les, the step counters, the random generator state
+# and the netCDF write offset. Stored as numpy .npz files, indexed by array name, one for every checkpoint time,
+# so that a restart finds the checkpoint matching the time of the gcm restart files.
+# The tendencies are stacked per variable, with one row for each les in the order of grid_index.
+
+# Logger
+log = logging.getLogger(__name__)
+
+
+# Returns the file name of the checkpoint at model time t (s), the time inserted into the configured path
+def checkpoint_path(path, t):
+    root, ext = os.path.splitext(path)
+    return "%s-%d%s" % (root, int(round(t)), ext)
+
+
+# Returns the model times (s) of the checkpoint files present for the configured path
+def checkpoint_times(path):
+    directory, name = os.path.split(path)
+    root, ext = os.path.splitext(name)
+    if not os.path.isdir(directory or "."):
+        return []
+    suffixes = [f[len(root) + 1:len(f) - len(ext)] for f in os.listdir(directory or ".")
+                if f.startswith(root + "-") and f.endswith(ext)]
+    return sorted(int(suffix) for suffix in suffixes if suffix.isdigit())
+
+
+# Writes the checkpoint file for the current model time. The file is replaced atomically, so a crash while
+# writing leaves a previous checkpoint intact.
+def write_checkpoint(path, gcm, les_models):
+    t = gcm.get_model_time().value_in(units.s)
+    path = checkpoint_path(path, t)
+    arrays = {"time": t,
+              "gcm_step": gcm.step,
+              "first_half_step_done": gcm.first_half_step_done,
+              "cdf_step": spio.cdf_step}
+    rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = numpy.random.get_state()
+    arrays.update(rng_keys=rng_keys, rng_pos=rng_pos, rng_has_gauss=rng_has_gauss,
+                  rng_cached_gaussian=rng_cached_gaussian)
+    les_list = [les for les in les_models if getattr(les, "gcm_tendencies", None) is not None]
+    arrays["grid_indices"] = numpy.array([les.grid_index for les in les_list], dtype=numpy.int64)
+    for varname in spcpl.gcm_tendency_vars:
+        arrays["f_" + varname] = numpy.array([les.gcm_tendencies[varname] for les in les_list])
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        numpy.savez(f, **arrays)
+    os.rename(tmp_path, path)
+    log.info("Wrote checkpoint %s at step %d" % (path, gcm.step))
+
+
+# Reads the checkpoint file into a dictionary of arrays
+def read_checkpoint(path):
+    with numpy.load(path) as data:
+        return dict((key, data[key]) for key in data.files)
+
+
+# Restores the coupler state from the checkpoint file at the restart time of the gcm and sets the stored
+# tendencies upon the gcm. Returns False, leaving the coupler state untouched, when there is no such checkpoint.
+def restore_checkpoint(path, gcm, les_models):
+    t = gcm.get_model_time().value_in(units.s)
+    times = checkpoint_times(path)
+    if int(round(t)) not in times:
+        if len(times) > 0:
+            log.warning("No checkpoint at the gcm restart time %.0f s, only at times %s - ignoring them" %
+                        (t, ", ".join("%d s" % time for time in times)))
+        return False
+    path = checkpoint_path(path, t)
+    data = read_checkpoint(path)
+    if abs(t - data["time"]) > 1:
+        log.warning("Checkpoint %s was written at time %.0f s, but the gcm restarts at time %.0f s - ignoring it" %
+                    (path, data["time"], t))
+        return False
+    gcm.step = int(data["gcm_step"])
+    # the restarted gcm begins at a step boundary, so the first half step has to be repeated
+    gcm.first_half_step_done = False
+    log.info("Checkpoint written with first half step done: %s" % str(bool(data["first_half_step_done"])))
+    numpy.random.set_state(("MT19937", data["rng_keys"], int(data["rng_pos"]), int(data["rng_has_gauss"]),
+                            float(data["rng_cached_gaussian"])))
+    spio.resume_at(int(data["cdf_step"]))
+    rows = dict((index, row) for row, index in enumerate(data["grid_indices"]))
+    for les in les_models:
+        row = rows.get(les.grid_index, None)
+        if row is None:
+            log.warning("No tendencies in checkpoint for les at index %d" % les.grid_index)
+            continue
+        les.gcm_tendencies = dict((varname, data["f_" + varname][row]) for varname in spcpl.gcm_tendency_vars)
+        spcpl.apply_gcm_tendencies(gcm, les)
+    log.info("Restored checkpoint %s at step %d" % (path, gcm.step))
+    return True
@@ -0,0 +1,84 @@
+import logging
+
+import numpy
+import spcpl
+import sputils
+
+# Clustering of gcm columns in profile space, to share one les between similar columns.
+#
+# At the start of the run, the columns of the superparametrized region are clustered with a leader algorithm:
+# a column which is not similar to any representative so far becomes a representative, and gets an les. Every
+# step, the other columns (the members) are assigned to their most similar representative, and share its
+# tendencies upon the gcm. Members not similar to any representative are left to the gcm parametrizations.
+#
+# Two columns are similar when the rms differences over the levels of their profiles of virtual temperature, total
+# humidity and wind are all within the tolerances. The rms differences between all members and representatives are
+# computed with matrix products, without holding the differences of all pairs of profiles.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Variables compared between columns
+feature_names = ["Tv", "QT", "U", "V"]
+
+# Gcm profiles the features are computed from
+profile_names = ["U", "V", "T", "SH", "QL", "QI"]
+
+
+# Fetches the profiles of the gcm columns with the given grid indices, as arrays with one row per column
+def gather_profiles(gcm, indices):
+    profiles = {}
+    for name in profile_names:
+        unit = spcpl.cpl_units.get(name, None)
+        data = gcm.get_profile_fields(name, indices)
+        profiles[name] = numpy.asarray(data.value_in(unit) if unit else data, dtype=numpy.float64)
+    return profiles
+
+
+# Returns the features of columns from their gcm profiles
+def profile_features(profiles):
+    U, V, T, SH, QL, QI = (numpy.atleast_2d(numpy.asarray(profiles[name], dtype=numpy.float64))
+                           for name in profile_names)
+    c = sputils.rv / sputils.rd - 1
+    return {"Tv": T * (1 + c * SH - (QL + QI)), "QT": SH + QL + QI, "U": U, "V": V}
+
+
+# Returns the distances between all columns a and b, with one row per column in every feature: the maximum over
+# the features of the rms difference divided by the tolerance. Columns are similar at distances up to 1.
+def distances(features_a, features_b, tolerance):
+    result = None
+    for name in feature_names:
+        a, b = features_a[name], features_b[name]
+        msd = ((a * a).mean(axis=1)[:, None] - 2. * a.dot(b.T) / a.shape[1] + (b * b).mean(axis=1)[None, :])
+        d = numpy.sqrt(numpy.maximum(msd, 0.)) / tolerance[name]
+        result = d if result is None else numpy.maximum(result, d)
+    return result
+
+
+# Selects at most max_num representatives (-1: no limit) among the columns, in their order. Returns their positions.
+def select_representatives(features, tolerance, max_num=-1):
+    num_columns = len(features[feature_names[0]])
+    leaders = []
+    for i in range(num_columns):
+        if 0 <= max_num <= len(leaders):
+            break
+        column = dict((name, features[name][i:i + 1]) for name in feature_names)
+        if len(leaders) == 0:
+            leaders.append(i)
+            continue
+        leader_features = dict((name, features[name][leaders]) for name in feature_names)
+        if distances(column, leader_features, tolerance).min() > 1.:
+            leaders.append(i)
+    return leaders
+
+
+# Assigns members to their most similar representative. Returns the position of the representative for every
+# member, -1 if no representative is similar, and the distances to the nearest representatives.
+def assign(member_features, representative_features, tolerance):
+    num_members = len(member_features[feature_names[0]])
+    if len(representative_features[feature_names[0]]) == 0:
+        return numpy.full(num_members, -1, dtype=int), numpy.full(num_members, numpy.inf)
+    d = distances(member_features, representative_features, tolerance)
+    nearest = d.argmin(axis=1)
+    nearest_distance = d[numpy.arange(len(nearest)), nearest]
+    return numpy.where(nearest_distance <= 1., nearest, -1), nearest_distance
@@ -3,10 +3,9 @@ from __future__ import print_function
 import time
 import numpy
 import logging
-from amuse.community import units
+from amuse.units import units
 import sputils
 import spio
-import scipy.optimize
 
 # Logger
 log = logging.getLogger(__name__)
@@ -26,6 +25,7 @@ def get_cloud_fraction(les):
 
 
 gcm_vars = ["U", "V", "T", "SH", "QL", "QI", "Pfull", "Phalf", "A"]
+gcm_tendency_vars = ["U", "V", "T", "SH", "QL", "QI", "A"]
 surf_vars = ["Z0M", "Z0H", "QLflux", "QIflux", "SHflux", "TLflux", "TSflux"]
 cpl_units = {"U": units.m / units.s,
              "V": units.m / units.s,
@@ -40,6 +40,13 @@ cpl_units = {"U": units.m / units.s,
              "TLflux": units.W / units.m ** 2,
              "TSflux": units.W / units.m ** 2}
 
+# Precision of the coupling buffers and of the fields held by the master, see set_precision
+coupling_dtype = numpy.dtype(numpy.float64)
+
+# Variables kept in the coupling precision. Pressures, temperatures and heights are always kept in
+# double precision: they have large offsets, and their small differences enter the conversions.
+reduced_precision_vars = ["U", "V", "W", "SH", "QL", "QI", "QT", "A", "Qsat"]
+
 var_to_netcdf_name = {"Z0M": "z0m",
                       "Z0H": "z0h",
                       "Phalf": "Ph",
@@ -47,8 +54,27 @@ var_to_netcdf_name = {"Z0M": "z0m",
                       }
 
 
+# Sets the precision of the coupling buffers, "float64" or "float32"
+def set_precision(precision):
+    global coupling_dtype
+    if precision not in ["float64", "float32"]:
+        raise Exception("Unsupported coupling precision %s" % precision)
+    coupling_dtype = numpy.dtype(precision)
+
+
+# Returns the array in the coupling precision, if the variable may be kept in reduced precision
+def to_coupling_precision(varname, values):
+    if coupling_dtype == numpy.float64 or varname not in reduced_precision_vars:
+        return values
+    if not isinstance(values, numpy.ndarray):
+        return values
+    return values.astype(coupling_dtype, copy=False)
+
+
 # Retrieves all necessary vertical profiles to distribute to LES models:
-def gather_gcm_data(gcm, les_models, couple_surface, output_column_indices=None):
+# The extra output columns are converted together and written as one batch, in a background thread
+# if write_background is set.
+def gather_gcm_data(gcm, les_models, couple_surface, output_column_indices=None, write_background=False):
     extra_cols = [] if output_column_indices is None else output_column_indices
     cols = [les.grid_index for les in les_models] + extra_cols
     start = time.time()
@@ -61,7 +87,7 @@ def gather_gcm_data(gcm, les_models, couple_surface, output_column_indices=None)
         else:
             unit = cpl_units.get(gcm_var, None)
             data = gcm.get_profile_fields(gcm_var, cols)
-            profile_data[gcm_var] = data.value_in(unit) if unit else data
+            profile_data[gcm_var] = to_coupling_precision(gcm_var, data.value_in(unit) if unit else data)
     # Retrieve fluxes...
     if couple_surface:
         for surf_var in surf_vars:
@@ -83,22 +109,22 @@ def gather_gcm_data(gcm, les_models, couple_surface, output_column_indices=None)
             for varname in surf_vars:
                 setattr(les, varname, surface_data[varname][i])
 
-    # Store data for the extra output columns in netCDF
-    for i, col in enumerate(extra_cols):
+    # Store data for the extra output columns in netCDF, with one row per column
+    if len(extra_cols) > 0:
+        n = len(les_models)
         C = {}
         for varname in gcm_vars:
             # map variable name to netCDF variable name - if not in dict the name is the same
             cdfname = var_to_netcdf_name.get(varname, varname)
-            C[cdfname] = profile_data[varname][i + len(les_models)][:]
+            C[cdfname] = numpy.asarray(profile_data[varname][n:])
         output_column_conversion(C)
         if couple_surface:
             for varname in surf_vars:
                 cdfname = var_to_netcdf_name.get(varname, varname)
-                C[cdfname] = surface_data[varname][i + len(les_models)]
+                C[cdfname] = numpy.asarray(surface_data[varname][n:])
             C['z0m'], C['z0h'], C['wthl'], C['wqt'] = convert_surface_fluxes(C)
 
-        spio.write_netCDF_data(col, **C)
-        # print('Storing extra column data', varname, C)
+        spio.write_output_columns(extra_cols, C, background=write_background)
 
 
 # Converts the OpenIFS surface fluxes to LES quantities
@@ -108,8 +134,10 @@ def convert_surface_fluxes(les):
         Ph = getattr(les, "Phalf", None)
         T = getattr(les, "T", None)
     else:
-        # make it possible to pass a dictionary instead of a les object
-        Z0M, Z0H, QLflux, QIflux, SHflux, TLflux, TSflux = (les.get(varname, None) for varname in surf_vars)
+        # make it possible to pass a dictionary instead of a les object, with netCDF variable names as keys
+        # and possibly holding several columns, one per row
+        Z0M, Z0H, QLflux, QIflux, SHflux, TLflux, TSflux = (les.get(var_to_netcdf_name.get(varname, varname), None)
+                                                            for varname in surf_vars)
         # Ph = les.get("Ph",None)
         # T  = les.get("T",None)
         Ph = les["Ph"]  # want to know immediately (crash) if these are missing
@@ -119,7 +147,7 @@ def convert_surface_fluxes(les):
     # rho = les.rhobf[0]
     # instantaneous density at the surface :    
     #    rho = sputils.mair*1e-3 * Ph[-1] / (sputils.rd * T[-1])
-    rho = Ph[-1] / (sputils.rd * T[-1])
+    rho = Ph[..., -1] / (sputils.rd * T[..., -1])
     # note mair is g/mol, need kg/mol
     # note: rd is R/M - universal gas constant / Molar mass of dry air
 
@@ -127,7 +155,7 @@ def convert_surface_fluxes(les):
 
     wqt = - (QLflux + QIflux + SHflux) / rho
 
-    wthl = - TSflux * sputils.iexner(Ph[-1]) / (sputils.cp * rho)  # only SENSIBLE heat
+    wthl = - TSflux * sputils.iexner(Ph[..., -1]) / (sputils.cp * rho)  # only SENSIBLE heat
 
     # Signs: 
     # Dales: positive fluxes are upwards - into the atmosphere
@@ -190,25 +218,26 @@ def convert_profiles(les, write=True):
 
 # calculates QT and THL etc for GCM profiles for extra output columns
 # like convert_profiles() for the les columns
+# the profiles may hold several columns, as arrays with one row per column
 def output_column_conversion(profile):
     c = sputils.rv / sputils.rd - 1  # epsilon^(-1) -1  = 0.61
     profile['Tv'] = profile['T'] * (1 + c * profile['SH'] - (profile['QL'] + profile['QI']))
 
-    dP = profile['Ph'][1:] - profile['Ph'][:-1]  # dP - pressure difference over one cell
+    dP = profile['Ph'][..., 1:] - profile['Ph'][..., :-1]  # dP - pressure difference over one cell
     dZ = sputils.rd * profile['Tv'] / (sputils.grav * profile['Pf']) * dP  # dZ - height of one cell
 
     # sum up dZ to get Z at half-levels.
     # 0 is at the end of the list, therefore reverse lists before and after.
-    Zh = numpy.cumsum(dZ[::-1])[::-1]
+    Zh = numpy.cumsum(dZ[..., ::-1], axis=-1)[..., ::-1]
 
-    Zh = numpy.append(Zh, 0)  # append a 0 for ground
+    Zh = numpy.concatenate((Zh, numpy.zeros(Zh.shape[:-1] + (1,))), axis=-1)  # append a 0 for ground
 
     # height of full levels - simply average half levels (for now)
     # better: use full level pressure to calculate height?
     # Zf = (Zh[1:] + Zh[:-1]) * .5
-    profile['Zh'] = Zh[1:]
-    profile['Psurf'] = profile['Ph'][-1]
-    profile['Ph'] = profile['Ph'][1:]
+    profile['Zh'] = Zh[..., 1:]
+    profile['Psurf'] = profile['Ph'][..., -1]
+    profile['Ph'] = profile['Ph'][..., 1:]
     profile['THL'] = (profile['T'] - (sputils.rlv * (profile['QL'] + profile['QI'])) / sputils.cp) * sputils.iexner(profile['Pf'])
     profile['QT'] = profile['SH'] + profile['QL'] + profile['QI']
 
@@ -219,6 +248,11 @@ def output_column_conversion(profile):
 # TODO check w with DALES input files
 
 def set_les_state(les, u, v, thl, qt, ps=None):
+    apply_les_state(les, perturbed_les_state(les, u, v, thl, qt), ps)
+
+
+# Returns the 3d initial fields for the les, the profiles perturbed with noise from the given random generator
+def perturbed_les_state(les, u, v, thl, qt, rng=numpy.random):
     # tiny noise used until feb 2018
     # vabsmax,qabsmax = 0.001,0.00001
     # les.set_field('U',   numpy.random.uniform(-vabsmax, vabsmax, (les.itot, les.jtot, les.k)) + u)
@@ -228,10 +262,17 @@ def set_les_state(les, u, v, thl, qt, ps=None):
 
     # more noise, according to Dales defaults. qabsmax defaults to 1e-5, 2.5e-5 is from a namoptions file
     vabsmax, thlabsmax, qabsmax = 0.5, 0.1, 2.5e-5
-    les.set_field('U', numpy.random.uniform(-vabsmax, vabsmax, (les.itot, les.jtot, les.k)) + u)
-    les.set_field('V', numpy.random.uniform(-vabsmax, vabsmax, (les.itot, les.jtot, les.k)) + v)
-    les.set_field('THL', numpy.random.uniform(-thlabsmax, thlabsmax, (les.itot, les.jtot, les.k)) + thl)
-    les.set_field('QT', numpy.random.uniform(-qabsmax, qabsmax, (les.itot, les.jtot, les.k)) + qt)
+    shape = (les.itot, les.jtot, les.k)
+    return [('U', to_coupling_precision('U', rng.uniform(-vabsmax, vabsmax, shape) + u)),
+            ('V', to_coupling_precision('V', rng.uniform(-vabsmax, vabsmax, shape) + v)),
+            ('THL', rng.uniform(-thlabsmax, thlabsmax, shape) + thl),
+            ('QT', to_coupling_precision('QT', rng.uniform(-qabsmax, qabsmax, shape) + qt))]
+
+
+# Sends the initial fields and surface pressure to the les
+def apply_les_state(les, fields, ps=None):
+    for name, values in fields:
+        les.set_field(name, values)
 
     if ps:
         les.set_surface_pressure(ps)
@@ -295,13 +336,21 @@ def set_les_forcings(les, gcm, dt_gcm, factor, couple_surface, qt_forcing='sp'):
     if qt_forcing == 'variance':
         if les.get_model_time() > 0 | units.s:
             starttime = time.time()
-            variability_nudge(les, gcm)
+            variability_nudge(les, dt_gcm)
             walltime = time.time() - starttime
             log.info("variability nudge took %6.2f s"%walltime)
 
 
 # Computes the LES tendencies upon the GCM:
 def set_gcm_tendencies(gcm, les, factor=1):
+    ft = gcm.get_timestep().value_in(units.s)  # should be the length of the NEXT time step
+    compute_gcm_tendencies(les, ft, factor)
+    apply_gcm_tendencies(gcm, les)
+
+
+# Computes the LES tendencies upon the GCM with forcing time scale ft, and keeps them with the les.
+# Makes no calls upon the GCM, so that it can run concurrently for several les instances.
+def compute_gcm_tendencies(les, ft, factor=1):
     U, V, T, SH, QL, QI, Pf, Ph, A = (getattr(les, varname, None) for varname in gcm_vars)
 
     Zf = les.gcm_Zf  # note: gcm Zf varies in time and space - must get it again after every step, for every column
@@ -330,8 +379,8 @@ def set_gcm_tendencies(gcm, les, factor=1):
                         ql_ice=ql_ice_d, ql_water=ql_water_d, thl=thl_d,
                         t=t, t_=t_d, qr=qr_d)
 
-    # forcing
-    ft = gcm.get_timestep().value_in(units.s)  # should be the length of the NEXT time step
+    # keep the les profiles for the health checks, see sphealth
+    les.les_profiles = {"u": u_d, "v": v_d, "thl": thl_d, "qt": qt_d, "ql": ql_d}
 
     # interpolate to GCM heights
     t_d = numpy.interp(Zf, h, t_d)
@@ -369,31 +418,35 @@ def set_gcm_tendencies(gcm, les, factor=1):
     f_V[0:start_index] = 0
     f_A[0:start_index] = 0
 
-    gcm.set_profile_tendency("U", les.grid_index, f_U)
-    gcm.set_profile_tendency("V", les.grid_index, f_V)
-    gcm.set_profile_tendency("T", les.grid_index, f_T)
-    gcm.set_profile_tendency("SH", les.grid_index, f_SH)
-    gcm.set_profile_tendency("QL", les.grid_index, f_QL)
-    gcm.set_profile_tendency("QI", les.grid_index, f_QI)
-    gcm.set_profile_tendency("A", les.grid_index, f_A)
+    # keep the tendencies with the les, for re-use and checkpointing
+    les.gcm_tendencies = {"U": f_U, "V": f_V, "T": f_T, "SH": f_SH, "QL": f_QL, "QI": f_QI, "A": f_A}
 
     # store forcings on GCM in the statistics in the corresponding LES group
     spio.write_les_data(les, f_U=f_U, f_V=f_V, f_T=f_T, f_SH=f_SH, A=A, f_QL=f_QL, f_QI=f_QI)
 
 
-def set_gcm_tendencies_from_file(gcm, les):
+# Sets the tendencies last computed from the les upon the gcm, in the column of the les or in the given column
+def apply_gcm_tendencies(gcm, les, grid_index=None):
+    index = les.grid_index if grid_index is None else grid_index
+    for varname in gcm_tendency_vars:
+        gcm.set_profile_tendency(varname, index, les.gcm_tendencies[varname])
+
+
+# Returns the index in spifs.nc of the time closest to the current gcm time
+def get_restart_time_index(gcm):
     t = gcm.get_model_time().value_in(units.s)
-    ti = (numpy.abs(spio.cdf_root.variables['Time'] - t)).argmin()
+    ti = (numpy.abs(spio.cdf_root.variables['Time'][:] - t)).argmin()
+    log.info("Restart at time %.0f s from output time index %d at %.0f s" %
+             (t, ti, spio.cdf_root.variables['Time'][ti]))
+    return ti
 
-    print('set_gcm_tendencies_from_file()', t, ti, spio.cdf_root.variables['Time'][ti])
-    
-    gcm.set_profile_tendency("U",  les.grid_index, les.cdf.variables['f_U' ][ti])
-    gcm.set_profile_tendency("V",  les.grid_index, les.cdf.variables['f_V' ][ti])
-    gcm.set_profile_tendency("T",  les.grid_index, les.cdf.variables['f_T' ][ti])
-    gcm.set_profile_tendency("SH", les.grid_index, les.cdf.variables['f_SH'][ti])
-    gcm.set_profile_tendency("QL", les.grid_index, les.cdf.variables['f_QL'][ti])
-    gcm.set_profile_tendency("QI", les.grid_index, les.cdf.variables['f_QI'][ti])
-    gcm.set_profile_tendency("A",  les.grid_index, les.cdf.variables['f_A' ][ti])
+
+# Sets the gcm tendencies stored in spifs.nc at the given (or current) time
+def set_gcm_tendencies_from_file(gcm, les, ti=None):
+    if ti is None:
+        ti = get_restart_time_index(gcm)
+    les.gcm_tendencies = dict((varname, les.cdf.variables['f_' + varname][ti]) for varname in gcm_tendency_vars)
+    apply_gcm_tendencies(gcm, les)
 
 
 # fetch LES profiles and write to spifs.nc - used during spinup
@@ -429,11 +482,11 @@ def write_les_profiles(les):
 
 # TODO this routine sometimes hangs for a very long time, especially if it is called when
 # variance nudging is not enabled in the LES
-def variability_nudge(les, gcm):
+def variability_nudge(les, dt_gcm):
     # this cannot be used before the LES has been stepped - otherwise qsat and ql are not defined.
     
-    qsat = les.get_field("Qsat")
-    qt = les.get_field("QT")
+    qsat = to_coupling_precision("Qsat", les.get_field("Qsat"))
+    qt = to_coupling_precision("QT", les.get_field("QT"))
     ql2 = les.get_profile("QL")
 
     qt_av = les.get_profile("QT")
@@ -469,6 +522,7 @@ def variability_nudge(les, gcm):
                          (k, q_min, q_max, numpy.mean(qt[:,:,k]), numpy.std(qt[:,:,k])))
                 # seems to happen easily in the sponge layer, where the variability is kept small
                 continue
+            import scipy.optimize  # only needed for the variance forcing, slow to import
             beta[k] = scipy.optimize.brentq(get_ql_diff, beta_min, beta_max)
 
         elif ql[k] > les.ql_ref[k]: # The GCM says no clouds, or very little, and the LES has more than this. 
@@ -486,7 +540,7 @@ def variability_nudge(les, gcm):
         
         # print (k, current_ql_diff, les.ql_ref[k], beta[k])
         
-    alpha = numpy.log(beta) / gcm.get_timestep()
+    alpha = numpy.log(beta) / (dt_gcm | units.s)
     les.set_qt_variability_factor(alpha)
 
     qt_std = numpy.std(qt, axis=(0,1)) 
@@ -2,7 +2,7 @@ from __future__ import division
 import logging
 import numpy
 import datetime
-from amuse.community import units
+from amuse.units import units
 
 # Logger
 log = logging.getLogger(__name__)
@@ -84,6 +84,9 @@ class dummy_gcm(dummy_base):
     def set_mask(self, i):
         self.mask.add(i)
 
+    def reset_mask(self, i):
+        self.mask.discard(i)
+
     def get_field(self, name, i, k):
         func_hor, func_vert, norm, unit = self.field_helper(name)
         field = norm * func_hor(self.latitudes[i], self.longitudes[i]) * func_vert(k)
@@ -307,6 +310,9 @@ class dummy_les(dummy_base):
     def set_tendency_surface_pressure(self, values):
         log.info("Setting SP-tendency to %s" % str(values))
 
+    def set_tendency_QL(self, values):
+        log.info("Setting QL-tendency to %s" % str(values))
+
     def set_multiplicative_qt_forcing(self, values):
         log.info("Setting multiplicative qt forcing to %s" % str(values))
 
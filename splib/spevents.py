@@ -0,0 +1,125 @@
+import collections
+import logging
+import sys
+import time
+
+# Event-driven orchestration of asynchronous AMUSE requests from a single thread.
+#
+# Work is submitted as tasks, each issuing one asynchronous request. When a request completes, the
+# callback of its task runs in the orchestrating thread and may return a follow-up task, e.g. the next
+# les time step, so that chains of requests proceed without python threads. This works with MPI
+# libraries without MPI_THREAD_MULTIPLE. The nr. of requests in flight is bounded, and optionally
+# the cores they use (see spsched.core_budget). When a task fails, the queued tasks are cancelled,
+# the requests in flight are completed and the error is raised from run(), unless the task handles
+# its own failure.
+
+# Logger
+log = logging.getLogger(__name__)
+
+
+# Raised by run() when a task failed, holding the name of the task and the original exception
+class task_error(Exception):
+
+    def __init__(self, name, error, num_cancelled):
+        super(task_error, self).__init__("Task %s failed: %s (%d queued tasks cancelled)" %
+                                         (name, str(error), num_cancelled))
+        self.name = name
+        self.error = error
+        self.num_cancelled = num_cancelled
+
+
+# A unit of work: start issues the asynchronous request, done is called with its result and may return
+# a follow-up task. width is the nr. of cores the request occupies. If given, failed is called with the
+# exception when the task fails, instead of failing the run.
+class task(object):
+
+    def __init__(self, name, start, done=None, width=1, failed=None):
+        self.name = name
+        self.start = start
+        self.done = done
+        self.width = width
+        self.failed = failed
+
+
+class orchestrator(object):
+
+    def __init__(self, max_pending=sys.maxint, budget=None, pool=None):
+        if pool is None:
+            from amuse.rfi.channel import AsyncRequestsPool
+            pool = AsyncRequestsPool()
+        self.pool = pool
+        self.max_pending = max(max_pending, 1)
+        self.budget = budget
+        self.queue = collections.deque()
+        self.pending = 0
+        self.error = None
+        self.num_cancelled = 0
+
+    def submit(self, new_task):
+        self.queue.append(new_task)
+
+    # Drops the queued tasks. Requests in flight cannot be withdrawn from the workers, they complete normally.
+    def cancel(self):
+        self.num_cancelled += len(self.queue)
+        self.queue.clear()
+
+    # Starts queued tasks while the limits allow
+    def admit(self):
+        while len(self.queue) > 0 and self.pending < self.max_pending:
+            if self.budget is not None and not self.budget.try_acquire(self.queue[0].width):
+                break
+            self.start_task(self.queue.popleft())
+
+    def start_task(self, new_task):
+        try:
+            request = new_task.start()
+        except Exception as e:
+            self.release(new_task)
+            self.fail(new_task, e)
+            return
+        self.pending += 1
+        self.pool.add_request(request, self.complete, args=(new_task,))
+
+    def release(self, done_task):
+        if self.budget is not None:
+            self.budget.release(done_task.width)
+
+    # Callback of the request pool
+    def complete(self, request, done_task):
+        self.pending -= 1
+        self.release(done_task)
+        try:
+            result = request.result()
+            follow_up = done_task.done(result) if done_task.done is not None else None
+        except Exception as e:
+            self.fail(done_task, e)
+            return
+        if follow_up is not None and self.error is None:
+            self.queue.appendleft(follow_up)  # continue running chains before starting new ones
+
+    def fail(self, failed_task, error):
+        if failed_task.failed is not None:
+            failed_task.failed(error)
+            return
+        log.error("Task %s failed: %s" % (failed_task.name, str(error)))
+        if self.error is None:
+            self.error = (failed_task.name, error)
+        self.cancel()
+
+    # Runs the submitted tasks to completion. The optional function concurrent runs in this thread after the
+    # first requests have been issued, e.g. a gcm phase overlapping with the les time steps.
+    def run(self, concurrent=None):
+        start = time.time()
+        self.admit()
+        if concurrent is not None:
+            try:
+                concurrent()
+            except Exception as e:
+                self.fail(task("concurrent", None), e)
+        while len(self.queue) > 0 or self.pending > 0:
+            self.admit()
+            if self.pending > 0:
+                self.pool.wait()
+        if self.error is not None:
+            raise task_error(self.error[0], self.error[1], self.num_cancelled)
+        log.info("Event loop done in %.2f s" % (time.time() - start))
@@ -0,0 +1,172 @@
+import glob
+import logging
+import os
+import threading
+import time
+
+import numpy
+import spcpl
+from amuse.units import units
+
+# Failover of single les columns.
+#
+# When an les instance fails during a time step, the failure is recorded instead of ending the run. After the les
+# phase, the master replaces every failed instance: from its latest restart file if it wrote one recently enough,
+# otherwise with a fresh instance initialized to the current state of its gcm column. A fresh instance starts at
+# model time zero, it is wrapped in a proxy shifting its clock to the coupling time. In the step of the failure,
+# the gcm gets the last known tendencies of the column, or zero tendencies before the first ones. Every failover
+# is written to failover.txt in the output directory.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Attributes of the coupler carried over from a failed les to its replacement
+carried_attributes = ["grid_index", "lat", "lon", "position", "cdf", "gcm_tendencies", "last_walltime", "gcm_Zf",
+                      "gcm_Zh", "ql_ref"]
+
+lock = threading.Lock()
+failed = []  # tuples (les, exception) of the failures in the current step
+num_failovers = 0
+
+
+# Evolve method of a shifted les, see shifted_les
+class shifted_evolve(object):
+
+    def __init__(self, les, offset):
+        self.les = les
+        self.offset = offset
+
+    def __call__(self, stop_time, exactEnd=True):
+        return self.les.evolve_model(stop_time - self.offset, exactEnd=exactEnd)
+
+    def async(self, stop_time, exactEnd=True):
+        return self.les.evolve_model.async(stop_time - self.offset, exactEnd=exactEnd)
+
+
+# An les started or reset during the run, of which the model time is shifted by the given offset to the coupling time.
+# Other attributes and methods are forwarded to the les. As with multiplexed columns, the les does not know the
+# absolute time, which matters for e.g. interactive radiation.
+class shifted_les(object):
+
+    def __init__(self, les, offset):
+        self.les = les
+        self.clock_offset = offset
+        self.evolve_model = shifted_evolve(les, offset)
+
+    def __getattr__(self, name):
+        if name == "les":
+            raise AttributeError(name)
+        return getattr(self.les, name)
+
+    def get_model_time(self):
+        return self.les.get_model_time() + self.clock_offset
+
+    def set_offset(self, offset):
+        self.clock_offset = offset
+        self.evolve_model.offset = offset
+
+
+# Returns the les with its clock shifted to the model time t, wrapped in a shifted_les unless it is one already
+def shift_clock(les, t):
+    if isinstance(les, shifted_les):
+        les.set_offset(t - les.les.get_model_time())
+        return les
+    return shifted_les(les, t - les.get_model_time())
+
+
+# Records the failure of an les in the current step. Called from the threads driving the les instances.
+def record_failure(les, error):
+    log.error("Les at point %d failed: %s" % (les.grid_index, str(error)))
+    with lock:
+        if not any(f[0] is les for f in failed):
+            failed.append((les, error))
+
+
+# Forgets the failures of the current step, returns them
+def clear_failures():
+    global failed
+    with lock:
+        current, failed = failed, []
+    return current
+
+
+# Returns the points of the les instances that failed in the current step
+def failed_indices():
+    with lock:
+        return [les.grid_index for les, _ in failed]
+
+
+# Returns whether the les instance wrote restart files
+def have_restart_files(les):
+    workdir = getattr(les, "workdir", None)
+    return workdir is not None and any(glob.glob(os.path.join(workdir, "initd*")))
+
+
+# Stops a failed les, its worker may be gone already
+def stop_failed(les):
+    try:
+        les.cleanup_code()
+        les.stop()
+    except Exception as e:
+        log.warning("Exception while stopping failed les at index %d: %s" % (les.grid_index, str(e)))
+
+
+# Starts the replacement of a failed les, evolved to stop_time. The les instances are started by the function
+# start_les(workdir, grid_index, restart), fresh instances in a work directory named after run_dir. A restarted les
+# lagging more than max_lag seconds behind stop_time would catch up in a single long step with a single forcing,
+# it is replaced by a fresh instance instead, otherwise it catches up with stop_time here, with the forcings of its
+# restart files. Returns the replacement and the kind of failover.
+def start_replacement(les, stop_time, start_les, run_dir, max_lag):
+    offset = getattr(les, "clock_offset", None)
+    replacement = None
+    if have_restart_files(les):
+        replacement = start_les(les.workdir, les.grid_index, True)
+        lag = stop_time - replacement.get_model_time() - (0 | units.s if offset is None else offset)
+        if lag.value_in(units.s) > max_lag:
+            log.warning("The restart files of the les at point %d are %.0f s old - starting a fresh les instead" %
+                        (les.grid_index, lag.value_in(units.s)))
+            stop_failed(replacement)
+            replacement = None
+        action = "restart"
+    if replacement is None:
+        workdir = "%s-%d-failover%d" % (run_dir, les.grid_index, num_failovers)
+        replacement = start_les(workdir, les.grid_index, False)
+        offset = stop_time - replacement.get_model_time()
+        action = "reinit"
+    if offset is not None:
+        replacement = shifted_les(replacement, offset)
+    if action == "restart":
+        replacement.evolve_model(stop_time, exactEnd=True)
+    for name in carried_attributes + spcpl.gcm_vars + spcpl.surf_vars:
+        if hasattr(les, name):
+            setattr(replacement, name, getattr(les, name))
+    if action == "reinit":
+        u, v, thl, qt, ps, ql = spcpl.convert_profiles(replacement, write=False)
+        spcpl.set_les_state(replacement, u, v, thl, qt, ps)
+    return replacement, action
+
+
+# Replaces the les instances that failed in the current step in les_list, see start_replacement. The gcm_tendencies
+# of the replacements are the last known ones of their columns, or zero. Failovers are listed in output_dir.
+# Returns the replacements.
+def failover(les_list, stop_time, gcm, start_les, output_dir, run_dir, max_lag):
+    global num_failovers
+    replacements = []
+    with open(os.path.join(output_dir, "failover.txt"), "a") as f:
+        for les, error in clear_failures():
+            stop_failed(les)
+            try:
+                replacement, action = start_replacement(les, stop_time, start_les, run_dir, max_lag)
+            except Exception as e:
+                log.error("Failover of les at point %d failed: %s" % (les.grid_index, str(e)))
+                raise
+            if getattr(replacement, "gcm_tendencies", None) is None:
+                replacement.gcm_tendencies = dict((name, numpy.zeros(gcm.ktot)) for name in spcpl.gcm_tendency_vars)
+            les_list[les_list.index(les)] = replacement
+            replacements.append(replacement)
+            num_failovers += 1
+            log.error("Les at point %d (lat %.2f, lon %.2f) failed over: %s at model time %s" %
+                      (les.grid_index, les.lat, les.lon, action, str(replacement.get_model_time())))
+            f.write("%10.2f %6d %7d %-8s %s\n" % (time.time(), gcm.step, les.grid_index, action,
+                                                  str(error).replace("\n", " ")))
+    return replacements
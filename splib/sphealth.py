@@ -0,0 +1,67 @@
+import logging
+
+import numpy
+
+# Numerical health checks of the les columns.
+#
+# After the les tendencies upon the gcm are computed, the les profiles fetched for them and the tendencies of all
+# columns are checked together, as arrays with one row per column: for values which are not finite, values out of
+# physical bounds, and tendencies which are outliers compared to the other columns. The master quarantines the
+# columns failing a check, see splib.check_les_health.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Physical bounds of the les slab profiles, in the units of spcpl.compute_gcm_tendencies
+bounds = {"u": (-150., 150.),  # m/s
+          "v": (-150., 150.),  # m/s
+          "thl": (150., 500.),  # K
+          "qt": (-1e-6, 0.1),  # kg/kg
+          "ql": (-1e-6, 0.02)}  # kg/kg
+
+# Tendencies upon the gcm checked for outliers, with the magnitude below which a tendency is never an outlier
+outlier_floors = {"T": 1e-3,  # K/s
+                  "SH": 1e-6}  # kg/kg/s
+
+# Minimal nr. of columns for the outlier check
+min_outlier_columns = 3
+
+
+# Stacks the profiles of the columns into an array with one row per column. Returns None if a column lacks it or
+# the columns have different lengths.
+def stack(profiles):
+    if any(p is None for p in profiles) or len(set(numpy.shape(p) for p in profiles)) > 1:
+        return None
+    return numpy.vstack([numpy.asarray(p, dtype=numpy.float64) for p in profiles])
+
+
+# Checks the columns. profiles maps les profile names (see bounds) and tendencies maps gcm tendency names to arrays
+# with one row per column. A tendency is an outlier when its maximal magnitude in the column exceeds
+# outlier_factor times the median over the columns (0: no outlier check). Returns a dict with the reasons of
+# failing, per failing column.
+def check_columns(profiles, tendencies, outlier_factor=0):
+    reasons = {}
+
+    def flag(name, failing, what):
+        for row in numpy.flatnonzero(failing):
+            reasons.setdefault(row, []).append("%s %s" % (name, what))
+
+    for name, values in sorted(profiles.items() + tendencies.items()):
+        flag(name, ~numpy.isfinite(values).all(axis=1), "not finite")
+    for name, values in sorted(profiles.iteritems()):
+        if name in bounds:
+            low, high = bounds[name]
+            with numpy.errstate(invalid="ignore"):
+                flag(name, ((values < low) | (values > high)).any(axis=1), "out of bounds [%g, %g]" % (low, high))
+    if outlier_factor > 0:
+        for name, values in sorted(tendencies.iteritems()):
+            if name not in outlier_floors or values.shape[0] < min_outlier_columns:
+                continue
+            magnitude = numpy.abs(values).max(axis=1)
+            finite = numpy.isfinite(magnitude)
+            if not finite.any():
+                continue
+            limit = max(outlier_factor * numpy.median(magnitude[finite]), outlier_floors[name])
+            with numpy.errstate(invalid="ignore"):
+                flag("f_" + name, magnitude > limit, "magnitude outlier above %g" % limit)
+    return reasons
@@ -1,9 +1,10 @@
 import numpy
+import os
 import time
 import threading
 import netCDF4
 import logging
-from amuse.community import units
+from amuse.units import units
 
 # open a netcdf file for storing lwp fields and vertical profiles
 # needs the oifs instance and one les instance for axis information.
@@ -26,49 +27,174 @@ cdf_lock = threading.Lock()  # lock protecting the netCDF root
 # Current time step being written
 cdf_step = -1
 
+# Whether writing continues from a given time step instead of appending (see resume_at)
+cdf_resumed = False
+
 # dict mapping column index to netCDF group handle
 # for the extra output columns
 output_column_cdf = {}
 
+# netCDF group holding all extra output columns with a column dimension, if they are stored as one slab
+output_column_group = None
+
+# netCDF group holding the cluster assignments of the columns sharing les instances, see spcluster
+cluster_group = None
+
+# thread writing the extra output columns in the background (see write_output_columns)
+output_thread = None
+
+# set while les data is written from several threads (see write_les_data)
+concurrent_writes = False
+
+# function receiving the les data instead of writing it, on sub-coordinators (see spnode)
+les_data_sink = None
+
+# Connections to dedicated I/O ranks writing the netCDF files (see spiorank), empty if the master writes
+io_clients = []
+
+# Nr. of files opened, used to distribute the files over the I/O ranks
+num_opened = 0
+
+# Output streams, mapping the stream name to the output_stream object
+output_streams = {}
+
+# dict mapping variable name to its output stream. Variables not in any stream are written to the
+# main file at every time step.
+variable_streams = {}
+
+# GCM profiles stored for every column
+column_profile_vars = [('U', 'm/s'),
+                       ('V', 'm/s'),
+                       ('T', 'K'),
+                       ('SH', '1'),
+                       ('QL', '1'),
+                       ('QI', '1'),
+                       ('Pf', 'Pa'),
+                       ('Ph', 'Pa'),
+                       ('Tv', 'K'),
+                       ('Zf', 'm'),
+                       ('Zh', 'm'),
+                       ('THL', 'K'),
+                       ('QT', '1'),
+                       ('A', '1')]
+
+# Surface fields stored for every column, the fluxes only with surface coupling
+column_surface_vars = [('Psurf', 'Pa')]
+column_flux_vars = [('z0m', 'm'),
+                    ('z0h', 'm'),
+                    ('wthl', 'K m/s'),
+                    ('wqt', 'kg m/s'),
+                    ('TLflux', 'W/m^2'),
+                    ('TSflux', 'W/m^2'),
+                    ('SHflux', 'kg / m^2s'),
+                    ('QLflux', 'kg / m^2s'),
+                    ('QIflux', 'kg / m^2s')]
+
 
 # Initializes netcdf; when called multiple times, skips initialization
 # output_columns is an optional list of extra columns for which output in the netCDF
 # is wanted, even though they do not have an embedded LES.
-def init_netcdf(nc_name, oifs, les_models, datetime, output_columns=None, append=False, with_surf_vars=True):
-    global cdf_root, output_column_cdf
+# If columns_slab is set, the extra columns are stored together in the group "columns", with a column dimension.
+# If journal is set, the output is written to a binary journal instead, which is converted to netCDF afterwards.
+def init_netcdf(nc_name, oifs, les_models, datetime, output_columns=None, append=False, with_surf_vars=True,
+                columns_slab=False, journal=False, cluster_members=None):
+    global cdf_root, output_column_cdf, output_column_group, cdf_resumed, cluster_group
     extra_cols = [] if output_columns is None else output_columns
+    cdf_resumed = False
+    output_column_cdf, output_column_group, cluster_group = {}, None, None
 
     if cdf_root:
         cdf_root.close()
-        
+
+    if journal and any(stream.file_name is None for stream in output_streams.itervalues()):
+        raise Exception("Output streams need their own file when writing a journal")
+
     if append:
-        cdf_root = netCDF4.Dataset(nc_name, "a")
+        cdf_root = open_dataset(nc_name, "a", journal=journal)
+        open_streams(nc_name, append=True)
 #        print (cdf_root.groups)
         for les in les_models:
             les.cdf = cdf_root.groups[str(les.grid_index)]
+        if columns_slab and len(extra_cols) > 0:
+            output_column_group = cdf_root.groups["columns"]
+            extra_cols = []
         for c in extra_cols:
             idx = c[0]
             cdf = cdf_root.groups[str(idx)]
             print "Warning: untested restart with extra output columns"
             output_column_cdf[idx] = cdf
     else:
-        cdf_root = open_netcdf(nc_name, oifs, les_models[0] if any(les_models) else None, datetime)
+        cdf_root = open_netcdf(nc_name, oifs, les_models[0] if any(les_models) else None, datetime, journal=journal)
+        open_streams(nc_name)
         for les in les_models:
             les.cdf = create_netcdf_les_subgroup(cdf_root, les, with_surf_vars=with_surf_vars)
+        if columns_slab and len(extra_cols) > 0:
+            output_column_group = create_netcdf_column_group(cdf_root, extra_cols, with_surf_vars=with_surf_vars)
+            extra_cols = []
         for c in extra_cols:
             idx = c[0]
             lat = c[1]
             lon = c[2]
             cdf = create_netcdf_subgroup(cdf_root, idx, lat, lon, with_surf_vars=with_surf_vars)
             output_column_cdf[idx] = cdf
+        if cluster_members:
+            cluster_group = create_netcdf_cluster_group(cdf_root, cluster_members)
     return cdf_root
 
 
+# Sets the I/O ranks to write the netCDF files. Files are assigned to them in turn, as they are opened.
+def set_io_ranks(comm, ranks):
+    global io_clients
+    import spiorank
+    io_clients = [spiorank.io_client(comm, rank) for rank in ranks]
+    log.info("Writing netCDF output on I/O ranks %s" % str(list(ranks)))
+
+
+# Lets the I/O ranks exit, after all files have been closed
+def stop_io_ranks():
+    global io_clients
+    for client in io_clients:
+        client.stop()
+    io_clients = []
+
+
+# Opens a netCDF file, on one of the I/O ranks if these are used, or the binary journal in its place
+def open_dataset(file_name, mode, journal=False):
+    global num_opened
+    if journal:
+        import spjournal
+        return spjournal.open_journal(file_name, mode)
+    num_opened += 1
+    if len(io_clients) > 0:
+        return io_clients[(num_opened - 1) % len(io_clients)].open_dataset(file_name, mode)
+    return netCDF4.Dataset(file_name, mode)
+
+
+# Stores run settings as global attributes of the netCDF file
+def set_attributes(**kwargs):
+    for name, value in kwargs.iteritems():
+        cdf_root.setncattr(name, value)
+
+
 # Updates NetCDF time variable (unlimited) with new time (in s)
 def update_time(t):
     global cdf_root, cdf_step
-    cdf_step = cdf_root.variables["Time"].shape[0]
+    wait_output_columns()
+    if cdf_resumed:
+        cdf_step += 1
+    else:
+        cdf_step = cdf_root.variables["Time"].shape[0]
     cdf_root.variables["Time"][cdf_step] = t.value_in(units.s)
+    for stream in output_streams.itervalues():
+        stream.next_step(t.value_in(units.s))
+
+
+# Continues writing at the given time step, e.g. when resuming from a checkpoint.
+# Later time steps already in the file are overwritten.
+def resume_at(step):
+    global cdf_step, cdf_resumed
+    cdf_step = step
+    cdf_resumed = True
 
 
 # Flushes the netcdf buffer to disc within thread lock
@@ -78,15 +204,18 @@ def sync_root():
     start = time.time()
     if cdf_root:
         cdf_root.sync()
+    for stream in output_streams.itervalues():
+        if stream.root is not None and stream.root is not cdf_root:
+            stream.root.sync()
     cdf_lock.release()
     walltime = time.time() - start
     log.info("netcdf.sync() - %3.1f s" % walltime)
 
 
 # Opens the new netCDF file
-def open_netcdf(nc_name, oifs, les, start_time):
+def open_netcdf(nc_name, oifs, les, start_time, journal=False):
     log.info("opening netcdf %s" % nc_name)
-    root_group = netCDF4.Dataset(nc_name, "w")
+    root_group = open_dataset(nc_name, "w", journal=journal)
 
     # dimensions
     if les:
@@ -147,8 +276,7 @@ def create_netcdf_les_subgroup(rootgrp, les, with_surf_vars=True):
                        ('qt_std', '1'),
                        ('qt_alpha', '1/s'),
                        ('qt_beta', '1')):
-        p = grp.createVariable(name, "f4", ("Time", "zf"))
-        p.units = unit
+        create_time_variable(grp, name, ("zf",), unit)
 
     # vertical profiles - using heights from OpenIFS
     for name, unit in (
@@ -159,8 +287,7 @@ def create_netcdf_les_subgroup(rootgrp, les, with_surf_vars=True):
             ('f_QL', '1/s'),
             ('f_QI', '1/s'),
             ('f_A', '1/s')):
-        p = grp.createVariable(name, "f4", ("Time", "oifs_height"))
-        p.units = unit
+        create_time_variable(grp, name, ("oifs_height",), unit)
 
     return grp
 
@@ -170,40 +297,14 @@ def create_netcdf_subgroup(rootgrp, subgroup, lat, lon, with_surf_vars=True):
     grp = rootgrp.createGroup(str(subgroup))
 
     # vertical profiles - using heights from OpenIFS
-    for name, unit in (('U', 'm/s'),
-                       ('V', 'm/s'),
-                       ('T', 'K'),
-                       ('SH', '1'),
-                       ('QL', '1'),
-                       ('QI', '1'),
-                       ('Pf', 'Pa'),
-                       ('Ph', 'Pa'),
-                       ('Tv', 'K'),
-                       ('Zf', 'm'),
-                       ('Zh', 'm'),
-                       ('THL', 'K'),
-                       ('QT', '1'),
-                       ('A', '1')):
-        p = grp.createVariable(name, "f4", ("Time", "oifs_height"))
-        p.units = unit
+    for name, unit in column_profile_vars:
+        create_time_variable(grp, name, ("oifs_height",), unit)
 
     # Surface fields (LES scalars)
-    srf = [('Psurf', 'Pa')]
-
-    if with_surf_vars:
-        srf += [('z0m', 'm')]
-        srf += [('z0h', 'm')]
-        srf += [('wthl', 'K m/s')]
-        srf += [('wqt', 'kg m/s')]
-        srf += [('TLflux', 'W/m^2')]
-        srf += [('TSflux', 'W/m^2')]
-        srf += [('SHflux', 'kg / m^2s')]
-        srf += [('QLflux', 'kg / m^2s')]
-        srf += [('QIflux', 'kg / m^2s')]
+    srf = column_surface_vars + (column_flux_vars if with_surf_vars else [])
 
     for name, unit in srf:
-        p = grp.createVariable(name, "f4", ("Time",))
-        p.units = unit
+        create_time_variable(grp, name, (), unit)
 
     # coordinates of this les instance.
     # NOTE for radiation etc in Dales, need to set these coordinates
@@ -217,18 +318,72 @@ def create_netcdf_subgroup(rootgrp, subgroup, lat, lon, with_surf_vars=True):
     return grp
 
 
+# Creates the group storing all extra output columns as arrays, with a column dimension.
+# columns is a list of tuples (index, lat, lon).
+def create_netcdf_column_group(rootgrp, columns, with_surf_vars=True):
+    grp = rootgrp.createGroup("columns")
+    grp.createDimension("column", len(columns))
+
+    index_ = grp.createVariable("index", "i4", ("column",))
+    lat_ = grp.createVariable("lat", "f4", ("column",))
+    lat_.units = 'deg'
+    lon_ = grp.createVariable("lon", "f4", ("column",))
+    lon_.units = 'deg'
+    index_[:] = [c[0] for c in columns]
+    lat_[:] = [c[1] for c in columns]
+    lon_[:] = [c[2] for c in columns]
+
+    for name, unit in column_profile_vars:
+        create_time_variable(grp, name, ("column", "oifs_height"), unit)
+
+    for name, unit in column_surface_vars + (column_flux_vars if with_surf_vars else []):
+        create_time_variable(grp, name, ("column",), unit)
+    return grp
+
+
+# Creates the group for the cluster assignments of the given columns (tuples (index, lat, lon)) sharing les instances
+def create_netcdf_cluster_group(rootgrp, members):
+    grp = rootgrp.createGroup("clusters")
+    grp.createDimension("member", len(members))
+
+    index_ = grp.createVariable("index", "i4", ("member",))
+    lat_ = grp.createVariable("lat", "f4", ("member",))
+    lat_.units = 'deg'
+    lon_ = grp.createVariable("lon", "f4", ("member",))
+    lon_.units = 'deg'
+    index_[:] = [c[0] for c in members]
+    lat_[:] = [c[1] for c in members]
+    lon_[:] = [c[2] for c in members]
+
+    representative = grp.createVariable("representative", "i4", ("Time", "member"))
+    representative.long_name = "grid index of the les column whose tendencies are applied, -1: none"
+    distance = grp.createVariable("distance", "f4", ("Time", "member"))
+    distance.long_name = "profile distance to the nearest les column, similar up to 1"
+    distance.units = '1'
+    return grp
+
+
+# Writes the cluster assignments of the columns sharing les instances at the current time step
+def write_cluster_assignment(representatives, distances):
+    with cdf_lock:
+        cluster_group.variables["representative"][cdf_step] = representatives
+        cluster_group.variables["distance"][cdf_step] = distances
+
+
+# Pass lock=True when writing concurrently with other threads. The lock is always taken
+# while the extra output columns are being written in the background, or concurrent_writes is set.
 def write_les_data(les, **kwargs):
     global cdf_lock
-    lock = kwargs.get("lock", False)
+    if les_data_sink is not None:
+        les_data_sink(les, dict((var, arr) for var, arr in kwargs.iteritems() if var != "lock"))
+        return
+    lock = kwargs.get("lock", False) or output_thread is not None or concurrent_writes
     if lock:
         cdf_lock.acquire()
     for var, arr in kwargs.iteritems():
         if var == "lock":
             continue  # variable argument list nonsense
-        ncvar = les.cdf.variables.get(var, None)
-        if ncvar:
-            ncvar[cdf_step] = kwargs[var]
-        else:
+        if not write_variable(les.cdf, var, arr, cdf_step):
             log.error("Attempt to write profile to uninitialized variable %s" % var)
     if lock:
         cdf_lock.release()
@@ -241,20 +396,262 @@ def write_netCDF_data(column_index, **kwargs):
     global cdf_lock
 
     cdf_handle = output_column_cdf[column_index]
-    lock = kwargs.get("lock", False)
+    lock = kwargs.get("lock", False) or output_thread is not None
     if lock:
         cdf_lock.acquire()
     for var, arr in kwargs.iteritems():
         if var == "lock": continue  # variable argument list nonsense
-        ncvar = cdf_handle.variables.get(var, None)
-
-        if ncvar:
-            try:
-                ncvar[cdf_step] = arr
-            except IndexError:
-                log.error("write_netCDF_data: Variable %s has length %d, should be %d" % (var, len(arr),
-                                                                                          len(ncvar[cdf_step])))
-        else:
-            log.error("Attempt to write profile to uninitialized variable %s" % var)
+        try:
+            if not write_variable(cdf_handle, var, arr, cdf_step):
+                log.error("Attempt to write profile to uninitialized variable %s" % var)
+        except IndexError:
+            log.error("write_netCDF_data: Variable %s has length %d, should be %d" % (var, len(arr),
+                                                                                      cdf_handle.variables[var].shape[-1]))
     if lock:
         cdf_lock.release()
+
+
+# Writes the extra output columns for the current time step. data maps the netCDF variable names to
+# arrays with one row per column, in the order of columns. If background is set, the data is written by
+# a separate thread, so that this can overlap with the les time stepping.
+def write_output_columns(columns, data, background=False):
+    global output_thread
+    wait_output_columns()
+    if background:
+        output_thread = threading.Thread(target=write_column_data, args=(columns, data, cdf_step),
+                                         name="column output")
+        output_thread.start()
+    else:
+        write_column_data(columns, data, cdf_step)
+
+
+# Waits until the background writing of the extra output columns is done
+def wait_output_columns():
+    global output_thread
+    if output_thread is not None:
+        output_thread.join()
+        output_thread = None
+
+
+# Writes the extra output columns at the given time step, either as a single slab or into their own groups
+def write_column_data(columns, data, step):
+    start = time.time()
+    with cdf_lock:
+        for var, arr in data.iteritems():
+            if output_column_group is not None:
+                if not write_variable(output_column_group, var, arr, step):
+                    log.error("Attempt to write output columns to uninitialized variable %s" % var)
+            else:
+                for i, column_index in enumerate(columns):
+                    if not write_variable(output_column_cdf[column_index], var, arr[i], step):
+                        log.error("Attempt to write output column %d to uninitialized variable %s" %
+                                  (column_index, var))
+    log.info("Writing %d output columns took %3.1f s" % (len(columns), time.time() - start))
+
+
+# Creates a time dependent variable in the given group, or in the output stream of the variable
+def create_time_variable(grp, name, dimensions, unit):
+    stream = variable_streams.get(name, None)
+    if stream is None:
+        ncvar = grp.createVariable(name, "f4", ("Time",) + dimensions)
+    else:
+        ncvar = stream.create_variable(grp, name, dimensions)
+    ncvar.units = unit
+    return ncvar
+
+
+# Returns the nr. of netCDF writes which the master has handed off but which are not done yet
+def queue_depth():
+    n = 1 if output_thread is not None and output_thread.is_alive() else 0
+    return n + sum(len(client.requests) for client in io_clients)
+
+
+# Returns the nr. of bytes of output buffered in the master, by the output streams and the journal record
+def buffer_nbytes():
+    n = 0
+    for stream in output_streams.itervalues():
+        n += sum(a.nbytes for a in stream.values.itervalues()) + sum(a.nbytes for a in stream.m2.itervalues())
+    current = getattr(cdf_root, "current", None)
+    if isinstance(current, numpy.ndarray):
+        n += current.nbytes
+    return n
+
+
+# Writes a variable of the given group at the time step, or passes it to the output stream of the variable.
+# Returns False if the variable does not exist.
+def write_variable(grp, name, value, step):
+    stream = variable_streams.get(name, None)
+    if stream is not None:
+        return stream.add(grp, name, value)
+    ncvar = grp.variables.get(name, None)
+    if ncvar is None:
+        return False
+    ncvar[step] = value
+    return True
+
+
+# Sets up the output streams from a dictionary mapping the stream name to its settings:
+#   "vars": list of variable names in the stream
+#   "every": nr. of gcm steps per record, default 1
+#   "reduce": None (sample the first step of every record), "mean", "min", "max" or "var" over the record steps
+#   "file": optional separate netCDF file for the stream, in the directory of the main output file
+# Must be called before init_netcdf.
+def init_streams(streams):
+    global output_streams, variable_streams
+    close_streams()
+    output_streams, variable_streams = {}, {}
+    for name, settings in streams.iteritems():
+        stream = output_stream(name, every=settings.get("every", 1), reduction=settings.get("reduce", None),
+                               file_name=settings.get("file", None))
+        for var in settings.get("vars", []):
+            if var in variable_streams:
+                raise Exception("Variable %s is assigned to output streams %s and %s" %
+                                (var, variable_streams[var].name, name))
+            variable_streams[var] = stream
+        output_streams[name] = stream
+        log.info("Output stream %s: every %d steps, reduction %s, variables %s" %
+                 (name, stream.every, stream.reduction, " ".join(settings.get("vars", []))))
+
+
+# Opens the output streams, in the main file or in their own files next to it
+def open_streams(nc_name, append=False):
+    for stream in output_streams.itervalues():
+        file_name = None
+        if stream.file_name is not None:
+            file_name = os.path.join(os.path.dirname(nc_name), stream.file_name)
+        stream.open(cdf_root, file_name, append)
+
+
+# Writes the remaining partial records of the output streams and closes the streams in separate files
+def close_streams():
+    for stream in output_streams.itervalues():
+        stream.close()
+
+
+# Returns the dimension with the given name visible in the group, and the group which defines it
+def find_dimension(grp, name):
+    while grp is not None:
+        if name in grp.dimensions:
+            return grp.dimensions[name], grp
+        grp = grp.parent
+    raise Exception("Dimension %s not found" % name)
+
+
+# Output stream: a set of variables written every few time steps, possibly reduced over the steps of each
+# record, and possibly to a separate file. Values are aggregated in memory until the record is complete.
+# Records are stamped with the time of their first step. Partial records are lost upon a restart.
+class output_stream(object):
+    reductions = [None, "mean", "min", "max", "var"]
+
+    def __init__(self, name, every=1, reduction=None, file_name=None):
+        if reduction not in output_stream.reductions:
+            raise Exception("Unsupported reduction %s for output stream %s" % (reduction, name))
+        self.name = name
+        self.every = max(int(every), 1)
+        self.reduction = reduction
+        self.file_name = file_name
+        self.time_dim = "Time" if file_name else "Time_" + name
+        self.root = None
+        self.record = 0
+        self.steps = 0
+        self.window_time = None
+        self.groups, self.values, self.counts, self.m2 = {}, {}, {}, {}
+
+    # Opens the stream in the main file, or in the given file
+    def open(self, main_root, file_name=None, append=False):
+        if file_name is None:
+            self.root = main_root
+        else:
+            self.root = open_dataset(file_name, "a" if append and os.path.exists(file_name) else "w")
+        if self.time_dim in self.root.dimensions:
+            self.record = len(self.root.dimensions[self.time_dim])
+        else:
+            self.root.createDimension(self.time_dim, None)
+            times = self.root.createVariable(self.time_dim, "f4", (self.time_dim,))
+            times.units = main_root.variables["Time"].units
+            times.steps_per_record = self.every
+            times.reduction = self.reduction if self.reduction else "sample"
+        self.steps, self.window_time = 0, None
+
+    # Returns the group in the stream output corresponding to the given group of the main file
+    def get_group(self, grp):
+        if self.root is grp or self.file_name is None:
+            return grp
+        target = self.root
+        for name in grp.path.split("/")[1:]:
+            if name:
+                target = target.groups[name] if name in target.groups else target.createGroup(name)
+        return target
+
+    def create_variable(self, grp, name, dimensions):
+        target = self.get_group(grp)
+        if name in target.variables:
+            return target.variables[name]
+        if target is not grp:
+            for dim_name in dimensions:
+                dim, dim_grp = find_dimension(grp, dim_name)
+                dim_target = self.get_group(dim_grp)
+                if dim_name not in dim_target.dimensions:
+                    dim_target.createDimension(dim_name, len(dim))
+        return target.createVariable(name, "f4", (self.time_dim,) + dimensions)
+
+    # Adds a value of a variable in the given group to the current record
+    def add(self, grp, name, value):
+        key = (grp.path, name)
+        x = numpy.array(value, dtype=numpy.float64)
+        if key not in self.values:
+            if self.reduction is None and self.steps > 0:
+                return True  # only the first step of the record is sampled
+            self.groups[key], self.values[key], self.counts[key] = grp, x, 1
+            if self.reduction == "var":
+                self.m2[key] = numpy.zeros_like(x)
+            return True
+        if self.reduction is None:
+            if self.steps == 0:
+                self.values[key] = x
+            return True
+        n = self.counts[key] + 1
+        self.counts[key] = n
+        acc = self.values[key]
+        if self.reduction == "min":
+            numpy.minimum(acc, x, out=acc)
+        elif self.reduction == "max":
+            numpy.maximum(acc, x, out=acc)
+        else:  # running mean and variance, using Welford's algorithm
+            delta = x - acc
+            acc += delta / n
+            if self.reduction == "var":
+                self.m2[key] += delta * (x - acc)
+        return True
+
+    # Moves the stream to the next time step (t in s), writing the record when it is complete
+    def next_step(self, t):
+        if self.window_time is not None:
+            self.steps += 1
+            if self.steps >= self.every:
+                self.write_record()
+        if self.steps == 0:
+            self.window_time = t
+
+    # Writes the aggregated values as a record, and starts a new one
+    def write_record(self):
+        if len(self.values) > 0:
+            self.root.variables[self.time_dim][self.record] = self.window_time
+            for key, acc in self.values.iteritems():
+                ncvar = self.get_group(self.groups[key]).variables.get(key[1], None)
+                if ncvar is None:
+                    log.error("Attempt to write output stream %s to uninitialized variable %s" % (self.name, key[1]))
+                    continue
+                ncvar[self.record] = self.m2[key] / self.counts[key] if self.reduction == "var" else acc
+            self.record += 1
+        self.groups, self.values, self.counts, self.m2 = {}, {}, {}, {}
+        self.steps = 0
+
+    def close(self):
+        if self.root is None:
+            return
+        if len(self.values) > 0:
+            self.write_record()
+        if self.file_name is not None:
+            self.root.close()
+        self.root = None
@@ -0,0 +1,276 @@
+import logging
+import threading
+
+import numpy
+
+# Output on dedicated I/O ranks, for the nospawn channel.
+#
+# The I/O ranks are launched together with the master and the model workers, and take over all
+# netCDF writing. The master works with proxies of the netCDF datasets, groups and variables, which
+# forward every operation as a message to the I/O rank owning the file. Writes are sent with
+# non-blocking sends and do not wait for the I/O rank, only reads (e.g. the length of the time
+# dimension) wait for a reply. Failures of requests without reply are sent back as error messages,
+# which the master checks for at every request with a reply and every sync. Each file is written by a
+# single I/O rank, so with several I/O ranks the main output file and the output stream files (see
+# spio.init_streams) are written in parallel.
+#
+# Note: netCDF4 parallel I/O requires writes extending the unlimited time dimension to be collective,
+# which would synchronize all writers at every record; whole files per rank avoid this.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# MPI message tags for requests to and replies from the I/O ranks
+request_tag = 4701
+reply_tag = 4702
+error_tag = 4703
+
+# Max. nr. of outstanding non-blocking sends per I/O rank
+max_pending = 256
+
+
+# Connection to an I/O rank, used from the master
+class io_client(object):
+
+    def __init__(self, comm, rank):
+        self.comm = comm
+        self.rank = rank
+        self.requests = []
+        self.num_files = 0
+        self.lock = threading.Lock()
+
+    # Sends a request without waiting for the I/O rank
+    def send(self, *msg):
+        with self.lock:
+            self.requests.append(self.comm.isend(msg, dest=self.rank, tag=request_tag))
+            if len(self.requests) > max_pending:
+                self.wait_sent()
+
+    # Sends a request and waits for the reply of the I/O rank
+    def call(self, *msg):
+        with self.lock:
+            self.requests.append(self.comm.isend(msg, dest=self.rank, tag=request_tag))
+            self.wait_sent()
+            reply = self.comm.recv(source=self.rank, tag=reply_tag)
+        self.check_errors()
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    # Raises the failures of requests without reply reported by the I/O rank so far, if any
+    def check_errors(self):
+        errors = []
+        with self.lock:
+            while self.comm.iprobe(source=self.rank, tag=error_tag):
+                errors.append(self.comm.recv(source=self.rank, tag=error_tag))
+        if any(errors):
+            raise Exception("Output requests failed on I/O rank %d: %s" % (self.rank, "; ".join(errors)))
+
+    # Completes the outstanding sends, call with the lock held
+    def wait_sent(self):
+        for request in self.requests:
+            request.wait()
+        self.requests = []
+
+    def flush(self):
+        with self.lock:
+            self.wait_sent()
+
+    # Opens a netCDF file on the I/O rank, returns the proxy of its root group
+    def open_dataset(self, file_name, mode):
+        fid = self.num_files
+        self.num_files += 1
+        structure = self.call("open", fid, file_name, mode)
+        log.info("Opened %s on I/O rank %d" % (file_name, self.rank))
+        return remote_dataset(self, fid, structure)
+
+    # Lets the I/O rank exit
+    def stop(self):
+        self.send("stop")
+        self.flush()
+
+
+# Proxy of a netCDF group on an I/O rank
+class remote_group(object):
+
+    def __init__(self, client, fid, path, parent, structure):
+        self.client = client
+        self.fid = fid
+        self.path = path
+        self.parent = parent
+        self.dimensions = dict((name, remote_dimension(self, name, size))
+                               for name, size in structure["dimensions"].iteritems())
+        self.variables = dict((name, remote_variable(self, name, var["dimensions"], var["attributes"]))
+                              for name, var in structure["variables"].iteritems())
+        self.groups = dict((name, remote_group(client, fid, self.child_path(name), self, sub))
+                           for name, sub in structure["groups"].iteritems())
+
+    def child_path(self, name):
+        return self.path.rstrip("/") + "/" + name
+
+    def createDimension(self, name, size=None):
+        self.client.send("dimension", self.fid, self.path, name, size)
+        self.dimensions[name] = remote_dimension(self, name, size)
+        return self.dimensions[name]
+
+    def createGroup(self, name):
+        self.client.send("group", self.fid, self.path, name)
+        self.groups[name] = remote_group(self.client, self.fid, self.child_path(name), self,
+                                         {"dimensions": {}, "variables": {}, "groups": {}})
+        return self.groups[name]
+
+    def createVariable(self, name, datatype, dimensions=()):
+        self.client.send("variable", self.fid, self.path, name, datatype, tuple(dimensions))
+        self.variables[name] = remote_variable(self, name, tuple(dimensions))
+        return self.variables[name]
+
+    def setncattr(self, name, value):
+        self.client.send("attribute", self.fid, self.path, None, name, value)
+
+    def __getitem__(self, name):
+        if name in self.variables:
+            return self.variables[name]
+        return self.groups[name]
+
+
+# Proxy of a netCDF file on an I/O rank
+class remote_dataset(remote_group):
+
+    def __init__(self, client, fid, structure):
+        super(remote_dataset, self).__init__(client, fid, "/", None, structure)
+
+    def sync(self):
+        self.client.send("sync", self.fid)
+        self.client.flush()
+        self.client.check_errors()
+
+    def close(self):
+        self.client.send("close", self.fid)
+        self.client.flush()
+        self.client.check_errors()
+
+
+# Proxy of a netCDF dimension on an I/O rank, the length of unlimited dimensions is requested from the I/O rank
+class remote_dimension(object):
+
+    def __init__(self, group, name, size):
+        self.group = group
+        self.name = name
+        self.size = size
+
+    def isunlimited(self):
+        return self.size is None
+
+    def __len__(self):
+        if self.size is None:
+            return self.group.client.call("dimension_length", self.group.fid, self.group.path, self.name)
+        return self.size
+
+
+# Proxy of a netCDF variable on an I/O rank. Attributes set on the proxy are set on the variable, the attributes of
+# variables in existing files are fetched when the file is opened.
+class remote_variable(object):
+
+    def __init__(self, group, name, dimensions, attributes=None):
+        self.__dict__.update(attributes or {})
+        self.__dict__.update(group=group, name=name, dimensions=dimensions)
+
+    def __setattr__(self, name, value):
+        self.group.client.send("attribute", self.group.fid, self.group.path, self.name, name, value)
+        self.__dict__[name] = value
+
+    def setncattr(self, name, value):
+        setattr(self, name, value)
+
+    def __setitem__(self, index, value):
+        self.group.client.send("put", self.group.fid, self.group.path, self.name, index, numpy.asarray(value))
+
+    def __getitem__(self, index):
+        return self.group.client.call("get", self.group.fid, self.group.path, self.name, index)
+
+    def __array__(self):
+        return numpy.asarray(self[:])
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def shape(self):
+        return self.group.client.call("shape", self.group.fid, self.group.path, self.name)
+
+
+# Returns the dimensions, variables and subgroups of a netCDF group, used to set up proxies of existing files
+def get_structure(grp):
+    return {"dimensions": dict((name, None if dim.isunlimited() else len(dim))
+                               for name, dim in grp.dimensions.iteritems()),
+            "variables": dict((name, {"dimensions": var.dimensions,
+                                      "attributes": dict((key, var.getncattr(key)) for key in var.ncattrs())})
+                              for name, var in grp.variables.iteritems()),
+            "groups": dict((name, get_structure(sub)) for name, sub in grp.groups.iteritems())}
+
+
+# Returns the group at the given path in the dataset
+def get_group(dataset, path):
+    grp = dataset
+    for name in path.split("/"):
+        if name:
+            grp = grp.groups[name]
+    return grp
+
+
+# Handles a single request on the I/O rank. Returns the reply, or None for requests without reply.
+def handle_request(files, msg):
+    import netCDF4
+    op = msg[0]
+    if op == "open":
+        fid, file_name, mode = msg[1:]
+        files[fid] = netCDF4.Dataset(file_name, mode)
+        return get_structure(files[fid])
+    if op == "sync":
+        files[msg[1]].sync()
+        return None
+    if op == "close":
+        files.pop(msg[1]).close()
+        return None
+    grp = get_group(files[msg[1]], msg[2])
+    if op == "dimension":
+        grp.createDimension(msg[3], msg[4])
+    elif op == "group":
+        grp.createGroup(msg[3])
+    elif op == "variable":
+        grp.createVariable(msg[3], msg[4], msg[5])
+    elif op == "attribute":
+        obj = grp if msg[3] is None else grp.variables[msg[3]]
+        obj.setncattr(msg[4], msg[5])
+    elif op == "put":
+        grp.variables[msg[3]][msg[4]] = msg[5]
+    elif op == "get":
+        return grp.variables[msg[3]][msg[4]]
+    elif op == "shape":
+        return grp.variables[msg[3]].shape
+    elif op == "dimension_length":
+        return len(grp.dimensions[msg[3]])
+    else:
+        raise Exception("Unknown I/O request %s" % op)
+    return None
+
+
+# Main loop of an I/O rank: executes the requests of the master until it sends stop
+def serve(comm, master=0):
+    files = {}
+    while True:
+        msg = comm.recv(source=master, tag=request_tag)
+        if msg[0] == "stop":
+            break
+        try:
+            reply = handle_request(files, msg)
+        except Exception as e:
+            log.error("I/O request %s failed: %s" % (msg[0], str(e)))
+            reply = e
+        if msg[0] in ["open", "get", "shape", "dimension_length"]:
+            comm.send(reply, dest=master, tag=reply_tag)
+        elif reply is not None:
+            comm.send("%s: %s" % (msg[0], str(reply)), dest=master, tag=error_tag)
+    for f in files.itervalues():
+        f.close()
+    log.info("I/O rank done")
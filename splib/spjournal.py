@@ -0,0 +1,374 @@
+import json
+import logging
+import os
+
+import numpy
+
+# Binary step journal, an alternative to the netCDF output file during the run.
+#
+# Offers the part of the netCDF4 Dataset interface used by spio. The file structure (groups,
+# dimensions, variables and attributes) and the variables without time dimension are kept in
+# a JSON layout file. Every time step is a fixed size record of float32 values, holding all
+# variables with the leading Time dimension at fixed offsets, and is appended to a memory mapped
+# journal file. A record starts with a marker which is set after its data, so records cut short
+# by a crash are recognized and dropped. Earlier records are never written again, unless writing
+# resumes at an earlier time step (spio.resume_at), which drops the later records.
+#
+# convert() produces the usual netCDF file from the journal, see journal2nc.py.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Nr. of float32 values in the record header: the valid marker
+header_size = 1
+
+# Value of the marker of complete records
+valid_marker = 1.
+
+# Nr. of records by which the journal file is extended at once
+chunk_records = 64
+
+
+# Returns the names of the journal and layout files for the given netCDF file name
+def journal_files(nc_name):
+    base = os.path.splitext(nc_name)[0]
+    return base + ".journal", base + ".journal.json"
+
+
+# Opens a journal in place of the given netCDF file, mode is "w" or "a"
+def open_journal(nc_name, mode):
+    journal_name, layout_name = journal_files(nc_name)
+    log.info("opening journal %s" % journal_name)
+    return journal_dataset(journal_name, layout_name, append=(mode == "a"))
+
+
+# Group in the journal
+class journal_group(object):
+
+    def __init__(self, dataset, path, parent):
+        self.dataset = dataset
+        self.path = path
+        self.parent = parent
+        self.dimensions = {}
+        self.variables = {}
+        self.groups = {}
+        self.attributes = {}
+
+    def child_path(self, name):
+        return self.path.rstrip("/") + "/" + name
+
+    def createDimension(self, name, size=None):
+        self.dimensions[name] = journal_dimension(self, name, size)
+        return self.dimensions[name]
+
+    def createGroup(self, name):
+        self.groups[name] = journal_group(self.dataset, self.child_path(name), self)
+        self.dataset.group_list.append(self.groups[name])
+        return self.groups[name]
+
+    def createVariable(self, name, datatype, dimensions=()):
+        var = journal_variable(self, name, datatype, tuple(dimensions))
+        self.variables[name] = var
+        if var.is_time_variable():
+            self.dataset.add_time_variable(var)
+        return var
+
+    def setncattr(self, name, value):
+        self.attributes[name] = value
+
+    def __getitem__(self, name):
+        if name in self.variables:
+            return self.variables[name]
+        return self.groups[name]
+
+    # Returns the size of the named dimension, looked up in this group and its parents
+    def dimension_size(self, name):
+        grp = self
+        while grp is not None:
+            if name in grp.dimensions:
+                return grp.dimensions[name].size
+            grp = grp.parent
+        raise Exception("Dimension %s not found" % name)
+
+
+# Dimension in the journal. Only the Time dimension of the root group may be unlimited.
+class journal_dimension(object):
+
+    def __init__(self, group, name, size):
+        self.group = group
+        self.name = name
+        self.size = size
+
+    def isunlimited(self):
+        return self.size is None
+
+    def __len__(self):
+        if self.size is None:
+            return self.group.dataset.num_steps()
+        return self.size
+
+
+# Variable in the journal. Attributes set on the variable are stored in the layout.
+class journal_variable(object):
+
+    def __init__(self, group, name, datatype, dimensions):
+        self.__dict__.update(group=group, name=name, datatype=datatype, dimensions=dimensions, attributes={},
+                             offset=None, data=None)
+        self.__dict__["var_shape"] = tuple(group.dimension_size(d) for d in dimensions if d != "Time")
+        self.__dict__["size"] = int(numpy.prod(self.var_shape))
+
+    def is_time_variable(self):
+        return len(self.dimensions) > 0 and self.dimensions[0] == "Time"
+
+    def __setattr__(self, name, value):
+        self.attributes[name] = value
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["attributes"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def setncattr(self, name, value):
+        self.attributes[name] = value
+
+    def __setitem__(self, index, value):
+        if not self.is_time_variable():
+            if self.data is None:
+                self.__dict__["data"] = numpy.full(self.var_shape, numpy.nan, dtype=numpy.float64)
+            if self.data.ndim == 0:
+                self.data[...] = value
+            else:
+                self.data[index] = value
+            return
+        step = index[0] if isinstance(index, tuple) else index
+        if not isinstance(step, (int, long, numpy.integer)) or (isinstance(index, tuple) and len(index) > 1):
+            raise Exception("Journal variable %s can only be written one full time step at a time" % self.name)
+        self.group.dataset.record_for(int(step))[self.offset:self.offset + self.size] = \
+            numpy.ravel(numpy.broadcast_to(value, self.var_shape))
+
+    def __getitem__(self, index):
+        if not self.is_time_variable():
+            return self.data[index]
+        values = self.group.dataset.all_records()[:, self.offset:self.offset + self.size]
+        return values.reshape((len(values),) + self.var_shape)[index]
+
+    def __array__(self):
+        return numpy.asarray(self[:])
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def shape(self):
+        if self.is_time_variable():
+            return (self.group.dataset.num_steps(),) + self.var_shape
+        return self.var_shape
+
+
+# Journal file and layout
+class journal_dataset(journal_group):
+
+    def __init__(self, journal_name, layout_name, append=False):
+        super(journal_dataset, self).__init__(self, "/", None)
+        self.journal_name = journal_name
+        self.layout_name = layout_name
+        self.group_list = [self]
+        self.time_variables = []
+        self.record_size = header_size
+        self.frozen = False
+        self.map = None
+        self.capacity = 0
+        self.num_records = 0  # complete records in the journal file
+        self.current_step = None  # time step of the record being filled
+        self.current = None
+        if append:
+            self.load()
+
+    def add_time_variable(self, var):
+        if self.frozen:
+            raise Exception("Cannot add variable %s to the journal after the first time step" % var.name)
+        var.__dict__["offset"] = self.record_size
+        self.record_size += var.size
+        self.time_variables.append(var)
+
+    # Fixes the record layout and creates the journal file
+    def freeze(self):
+        self.frozen = True
+        self.write_layout()
+        if not os.path.exists(self.journal_name) or self.num_records == 0:
+            open(self.journal_name, "wb").close()
+        self.remap(max(self.num_records, chunk_records))
+
+    # Maps the journal file, extended to the given nr. of records
+    def remap(self, capacity):
+        if self.map is not None:
+            self.map.flush()
+            self.map = None
+        with open(self.journal_name, "r+b") as f:
+            f.truncate(capacity * self.record_size * 4)
+        self.map = numpy.memmap(self.journal_name, dtype=numpy.float32, mode="r+",
+                                shape=(capacity, self.record_size))
+        self.capacity = capacity
+
+    def num_steps(self):
+        return self.num_records if self.current_step is None else self.current_step + 1
+
+    # Returns the record buffer of the given time step, appending the previous record to the journal
+    def record_for(self, step):
+        if not self.frozen:
+            self.freeze()
+        if step == self.current_step:
+            return self.current
+        if step < self.num_records:
+            # the record of this step is filled again, starting from its old values, later ones are dropped
+            log.warning("Rewriting journal from step %d, dropping %d later steps" % (step, self.num_records - step - 1))
+            self.current = numpy.array(self.map[step])
+            self.map[step:self.num_records, 0] = numpy.nan
+            self.current_step, self.num_records = step, step
+            return self.current
+        self.commit()
+        if step > self.num_records:
+            raise Exception("Journal records must be written in order, step %d follows %d" % (step, self.num_records))
+        self.current_step = step
+        self.current = numpy.full(self.record_size, numpy.nan, dtype=numpy.float32)
+        return self.current
+
+    # Appends the record being filled to the journal
+    def commit(self):
+        if self.current_step is None:
+            return
+        if self.num_records >= self.capacity:
+            self.remap(self.capacity + chunk_records)
+        self.current[0] = numpy.nan
+        self.map[self.num_records, :] = self.current
+        self.map[self.num_records, 0] = valid_marker
+        self.num_records += 1
+        self.current_step, self.current = None, None
+
+    # Returns all records, including the one being filled
+    def all_records(self):
+        if not self.frozen:
+            return numpy.zeros((0, self.record_size), dtype=numpy.float32)
+        records = numpy.array(self.map[:self.num_records])
+        if self.current_step is not None:
+            records = numpy.vstack((records, self.current[numpy.newaxis, :]))
+        return records
+
+    def sync(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        if not self.frozen:
+            self.freeze()
+        self.commit()
+        self.map.flush()
+        self.map = None
+        with open(self.journal_name, "r+b") as f:
+            f.truncate(self.num_records * self.record_size * 4)
+        self.write_layout()
+        log.info("closed journal %s with %d steps" % (self.journal_name, self.num_records))
+
+    # Writes the layout file, replacing it atomically
+    def write_layout(self):
+        layout = {"record_size": self.record_size, "header_size": header_size, "groups": []}
+        for grp in self.group_list:
+            layout["groups"].append({
+                "path": grp.path,
+                "attributes": dict((k, to_json(v)) for k, v in grp.attributes.iteritems()),
+                "dimensions": [[d.name, d.size] for d in grp.dimensions.itervalues()],
+                "variables": [{"name": v.name, "datatype": v.datatype, "dimensions": list(v.dimensions),
+                               "offset": v.offset,
+                               "attributes": dict((k, to_json(a)) for k, a in v.attributes.iteritems()),
+                               "data": None if v.data is None else v.data.tolist()}
+                              for v in grp.variables.itervalues()]})
+        tmp_name = self.layout_name + ".tmp"
+        with open(tmp_name, "w") as f:
+            json.dump(layout, f)
+        os.rename(tmp_name, self.layout_name)
+
+    # Restores the structure from the layout file and maps the existing records
+    def load(self):
+        layout = read_layout(self.layout_name)
+        for g in layout["groups"]:
+            parent = self.find_group(os.path.dirname(g["path"])) if g["path"] != "/" else None
+            grp = self if parent is None else parent.createGroup(os.path.basename(g["path"]))
+            grp.attributes.update(g["attributes"])
+            for name, size in g["dimensions"]:
+                grp.createDimension(name, size)
+            for v in g["variables"]:
+                var = grp.createVariable(v["name"], v["datatype"], v["dimensions"])
+                var.__dict__["offset"] = v["offset"]
+                var.attributes.update(v["attributes"])
+                if v["data"] is not None:
+                    var.__dict__["data"] = numpy.array(v["data"], dtype=numpy.float64)
+        self.record_size = layout["record_size"]
+        self.num_records = count_records(self.journal_name, self.record_size)
+        self.frozen = True
+        self.remap(max(self.num_records, chunk_records))
+
+    def find_group(self, path):
+        grp = self
+        for name in path.split("/"):
+            if name:
+                grp = grp.groups[name]
+        return grp
+
+
+# Converts numpy values of attributes to types json can store
+def to_json(value):
+    return value.tolist() if hasattr(value, "tolist") else value
+
+
+def read_layout(layout_name):
+    with open(layout_name) as f:
+        return json.load(f)
+
+
+# Returns the nr. of complete records at the start of the journal file
+def count_records(journal_name, record_size):
+    if not os.path.exists(journal_name):
+        return 0
+    n = os.path.getsize(journal_name) // (4 * record_size)
+    if n == 0:
+        return 0
+    markers = numpy.memmap(journal_name, dtype=numpy.float32, mode="r", shape=(n, record_size))[:, 0]
+    invalid = numpy.flatnonzero(markers != valid_marker)
+    return n if len(invalid) == 0 else int(invalid[0])
+
+
+# Converts the journal of the given netCDF file name into that netCDF file
+def convert(nc_name, journal_name=None, layout_name=None):
+    import netCDF4
+    default_journal, default_layout = journal_files(nc_name)
+    journal_name = journal_name or default_journal
+    layout_name = layout_name or default_layout
+    layout = read_layout(layout_name)
+    record_size = layout["record_size"]
+    n = count_records(journal_name, record_size)
+    records = numpy.memmap(journal_name, dtype=numpy.float32, mode="r", shape=(n, record_size)) if n > 0 else \
+        numpy.zeros((0, record_size), dtype=numpy.float32)
+    log.info("Converting %d steps from %s to %s" % (n, journal_name, nc_name))
+    with netCDF4.Dataset(nc_name, "w") as root:
+        for g in layout["groups"]:
+            grp = root
+            for name in g["path"].split("/"):
+                if name:
+                    grp = grp.groups[name] if name in grp.groups else grp.createGroup(name)
+            for name, size in g["dimensions"]:
+                grp.createDimension(name, size)
+            for name, value in g["attributes"].iteritems():
+                grp.setncattr(name, value)
+            for v in g["variables"]:
+                var = grp.createVariable(v["name"], v["datatype"], tuple(v["dimensions"]))
+                for name, value in v["attributes"].iteritems():
+                    var.setncattr(name, value)
+                if v["offset"] is not None and n > 0:
+                    shape = (n,) + var.shape[1:]
+                    size = int(numpy.prod(var.shape[1:]))
+                    values = records[:, v["offset"]:v["offset"] + size].reshape(shape)
+                    var[0:n] = numpy.ma.masked_invalid(values)
+                elif v["data"] is not None:
+                    var[...] = numpy.ma.masked_invalid(numpy.array(v["data"], dtype=numpy.float64))
+    return n
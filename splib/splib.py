@@ -13,7 +13,7 @@ import logging
 import os
 import shutil
 import threading
-from Queue import Queue  # note named queue in python 3
+from Queue import Queue, Empty  # note named queue in python 3
 
 import datetime
 import numpy
@@ -25,16 +25,23 @@ import spcpl
 import sputils
 import spio
 import spmpi
-import psutil
-
-print("splib.py - importing   from amuse.community import *")
-from amuse.community import *
-
-print("splib.py - importing from amuse.rfi import channel")
-from amuse.rfi import channel  # to query MPI threading support
-
-print("splib.py - importing from amuse.rfi.channel import AsyncRequestsPool")
-from amuse.rfi.channel import AsyncRequestsPool
+import spmux
+import spsched
+import spwatch
+import spckpt
+import spevents
+import spmetrics
+import spnode
+import spfailover
+import sphealth
+import spmask
+import spcluster
+import spskip
+
+from amuse.units import units
+
+# Note: the amuse channel module (loading the MPI bindings), psutil and the model backends are imported
+# where they are used, to keep the start of short runs (--help, --dryrun, netCDF replays) fast
 
 # Logger
 log = logging.getLogger(__name__)
@@ -50,24 +57,68 @@ gcm_redirect = "file"  # redirection for gcm
 gcm_forcing_factor = 1  # scale factor for forcings upon openifs
 les_type = "dales"
 les_dt = 60  # les time step (<0: adaptive)
+les_single_request = False  # evolve les instances over a gcm step in a single request instead of les_dt increments
 les_spinup = 0
 les_spinup_steps = 1
 les_spinup_forcing_factor = 1.
 les_exp_name = "test"  # les experiment name
 les_input_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../dales-input")  # les input directory
+les_overlay_files = []  # les input files copied into each les run directory instead of linked
 les_run_dir = "dales-work"  # les run directory
 les_num_procs = 1  # MPI tasks per les instance
 les_redirect = "file"  # redirection for les
 les_forcing_factor = 1  # scale factor for forcings upon les
 les_queue_threads = sys.maxint  # les run scheduling (1: all serial, > 1: nr. of concurrent worker threads)
+les_columns_per_worker = 1  # nr. of superparametrized columns multiplexed on a single les worker
+les_startup_threads = 1  # nr. of les instances started concurrently
+les_core_budget = 0  # nr. of cores for running les instances (0: no limit, < 0: all cores available to the master)
 max_num_les = -1  # Maximal number of LES instances
 init_les_state = True  # initialize les instances to the openifs column state
 output_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../spifs-output")  # Output folder
 output_name = "spifs.nc"  # output netcdf file name
+output_columns_slab = False  # store the extra output columns together in one netCDF group, with a column dimension
+output_columns_background = False  # write the extra output columns in a background thread, overlapping the les steps
+output_streams = {}  # output streams for reduced rate or time aggregated output, see spio.init_streams
+io_ranks = 0  # nr. of dedicated MPI ranks writing the netCDF output (nospawn channel only), see spio_rank.py
+output_journal = False  # write a binary step journal instead of the netCDF file, convert with journal2nc.py
+coupling_precision = "float64"  # precision of coupling buffers and fields in the master, "float32" for safe variables
+metrics_port = 0  # local http port serving run metrics in the Prometheus text format (0: off)
+metrics_file = None  # status file with the run metrics, rewritten after every step, relative to output_dir
+profile_steps = []  # gcm steps profiled with cProfile, dumps are written next to timing.txt
+profile_top = 30  # nr. of functions listed in the profile summary
 channel_type = "sockets"  # amuse communication type (choose from ["sockets","mpi"])
 dryrun = False  # if true, only start the GCM to examine the grid.
 async_evolve = True  # time step LES instances using asynchronous amuse calls instead of Python threads (experimental)
+event_driven = False  # drive the les instances from a single thread with the event orchestrator, see spevents
 restart = False  # restart an old run
+checkpoint_interval = 0  # nr. of gcm steps between coupler checkpoints (0: no checkpoints)
+checkpoint_name = "spifs-checkpoint.npz"  # coupler checkpoint file name, relative to output_dir, suffixed with the time
+les_restart_interval = 43200  # time (s) between les restart files
+async_coupling = False  # evolve les instances concurrently with the gcm, applying their tendencies one step later
+coupling_interval = 1  # nr. of gcm steps per exchange with the les, which evolve over all of them at once
+pipelined_coupling = False  # exchange data with every les in its own thread, overlapping it with other les steps
+les_nodes = 0  # nr. of node sub-coordinators owning the les instances, see spnode (0: the master drives all les)
+les_node_address = None  # host:port where the master waits for sub-coordinators on other nodes (None: start locally)
+les_stage_dir = None  # node-local directory where every sub-coordinator stages the les input once (None: output_dir)
+les_step_deadline = 0  # wall time (s) of the les instances per gcm step, after which they are late (0: no limit)
+les_call_deadline = 0  # wall time (s) of a single request to an les, after which it is late (0: no limit)
+les_straggler_factor = 0  # an les is also late when taking this many times the median les time of the step (0: off)
+les_deadline_policy = "wait"  # late les: "wait", "reuse" their last tendencies until they catch up, or "drop" them
+les_failover = False  # replace les instances failing during a step instead of ending the run, see spfailover
+health_checks = False  # check the les columns for diverging profiles and tendencies every step, see sphealth
+health_outlier_factor = 20  # a gcm tendency is an outlier at this many times the median over the columns (0: off)
+health_reset = False  # reset quarantined les to the state of their gcm column, instead of stopping them
+health_max_resets = 3  # nr. of resets of an les failing the health checks, after which it is stopped (0: no limit)
+dynamic_mask = False  # run les only in the columns whose gcm state crosses dynamic_mask_thresholds, see spmask
+dynamic_mask_thresholds = {"A": 0.05, "QL": 1e-5}  # indicators activating the les of a column, see spmask
+dynamic_mask_quiet_steps = 6  # nr. of quiet steps after which the les of a column is suspended
+dynamic_mask_retire = False  # stop the les of quiet columns instead of suspending them for reactivation
+les_clustering = False  # share the les of representative columns with similar columns of the region, see spcluster
+les_cluster_tolerance = {"Tv": 0.5, "QT": 5e-4, "U": 1., "V": 1.}  # rms profile differences of similar columns
+incremental_coupling = False  # skip the exchanges with les of quiet columns, see spskip
+incremental_tolerance = {"U": 0.1, "V": 0.1, "T": 0.05, "SH": 1e-5,  # changes of the gcm and les profiles of quiet
+                         "u": 0.1, "v": 0.1, "thl": 0.05, "qt": 1e-5}  # columns between exchanges
+incremental_refresh = 6  # nr. of steps after which the exchange with an les is forced
 cplsurf = False  # couple surface fields
 
 qt_forcing = "sp"
@@ -81,6 +132,15 @@ les_models = []
 output_column_indices = []
 output_columns = []  # tuple (index, lat, lon)
 
+les_budget = None  # core budget for scheduling the les instances
+les_input_files = None  # staged les input files, linked into each les run directory
+late_les = []  # les instances taken out of the coupling by the watchdog, see suspend_les
+dropped_les = []  # late les instances dropped from the superparametrization, see suspend_les
+quarantined_les = []  # stopped les instances of columns with masked tendencies, see quarantine_les
+suspended_les = []  # les instances of quiet columns, see update_dynamic_mask
+cluster_members = []  # tuples (index, lat, lon) of the columns sharing the les of a representative column
+cluster_assignment = {}  # the les shared by each member column in the current step, see update_clusters
+
 errorFlag = False  # flag raised when a worker thread generates an exception
 
 
@@ -96,10 +156,19 @@ def save_dryrun_info(lons, lats):
 
 # Initializes the system
 def initialize(config, geometries, output_geometries=None):
-    global gcm_model, les_models, output_name, async_evolve, output_column_indices, output_columns
+    global gcm_model, les_models, output_name, async_evolve, output_column_indices, output_columns, les_budget, \
+        les_input_files, pipelined_coupling, event_driven
 
     read_config(config)
 
+    spcpl.set_precision(coupling_precision)
+    if pipelined_coupling and not threads_supported():
+        log.warning("Pipelined coupling requires an MPI library with thread support - coupling les in turn")
+        pipelined_coupling = False
+    if les_core_budget != 0:
+        # leave one core for the master process when detecting the number of cores
+        les_budget = spsched.core_budget(les_core_budget if les_core_budget > 0 else spsched.detect_cores() - 1)
+
     # if output_name is a relative path (as by default),
     # treat it as relative to output_dir
     if not os.path.isabs(output_name):
@@ -107,14 +176,56 @@ def initialize(config, geometries, output_geometries=None):
 
     # TODO: validate input parameters
     run_dir = os.path.join(output_dir, gcm_run_dir)
+    if restart and les_columns_per_worker > 1:
+        raise Exception("Restarting runs with multiplexed les workers is not supported")
+    if les_columns_per_worker > 1 and any(spmux.check_setup(les_input_dir)):
+        raise Exception("Multiplexed les workers do not support time dependent les physics or state beyond the "
+                        "prognostic fields: %s" % ", ".join(spmux.check_setup(les_input_dir)))
+    if les_nodes > 0 and (async_coupling or les_spinup > 0 or channel_type == "nospawn"):
+        raise Exception("Node sub-coordinators do not support asynchronous coupling, les spinup or the nospawn channel")
+    if les_stage_dir is not None and les_nodes == 0:
+        raise Exception("Staging the les input on the nodes requires node sub-coordinators")
+    if les_failover and (les_nodes > 0 or les_columns_per_worker > 1):
+        raise Exception("Les failover is not supported with node sub-coordinators or multiplexed les workers")
+    if les_clustering and (restart or dynamic_mask or async_coupling):
+        raise Exception("Les clustering is not supported with restarts, the dynamic mask or asynchronous coupling")
+    if coupling_interval > 1 and async_coupling:
+        raise Exception("Coupling intervals of more than one gcm step are not supported with asynchronous coupling")
+    if coupling_interval > 1 and checkpoint_interval % coupling_interval != 0:
+        raise Exception("The checkpoint interval must be a multiple of the coupling interval, for restarts at an "
+                        "exchange with the les")
+    if have_deadline() and (event_driven or les_core_budget != 0 or les_queue_threads <= 1 or les_nodes > 0 or
+                            (pipelined_coupling and not async_coupling)):
+        raise Exception("Les step deadlines are not supported with the event orchestrator, a core budget, serial les "
+                        "steps, node sub-coordinators or pipelined coupling")
+    if incremental_coupling and les_nodes > 0:
+        raise Exception("Incremental coupling is not supported with node sub-coordinators")
+    if dynamic_mask and (les_nodes > 0 or les_columns_per_worker > 1 or async_coupling):
+        raise Exception("The dynamic mask is not supported with node sub-coordinators, multiplexed les workers or "
+                        "asynchronous coupling")
     if channel_type == "nospawn":
-        spmpi.send_model_colors(gcm_num_procs, les_num_procs, max_num_les)
+        ranks = spmpi.send_model_colors(gcm_num_procs, les_num_procs, num_les_workers(max_num_les), io_procs=io_ranks)
+        if io_ranks > 0:
+            from mpi4py import MPI
+            spio.set_io_ranks(MPI.COMM_WORLD, ranks)
         # TODO: Replace Dales and openifs channel factory methods...
+    elif io_ranks > 0:
+        log.warning("Dedicated I/O ranks require the nospawn channel, the master writes the output")
     gcm_model = gcm_init(gcm_type, gcm_input_dir, run_dir, couple_surface=cplsurf)
+    gcm_model.first_half_step_done = False
     les_models = []
+    del late_les[:], dropped_les[:], quarantined_les[:], suspended_les[:]
+    spfailover.clear_failures()
+    spskip.num_exchanges, spskip.num_skipped = 0, 0
+    if (dynamic_mask or les_clustering) and getattr(gcm_model, "reset_mask", None) is None:
+        raise Exception("The dynamic mask and les clustering require a gcm which can reset the superparametrization "
+                        "mask")
     lons = gcm_model.longitudes.value_in(units.deg)
     lats = gcm_model.latitudes.value_in(units.deg)
-    grid_indices = sputils.get_mask_indices(zip(lons, lats), geometries, max_num_les)
+    if les_clustering:
+        grid_indices = cluster_columns(sputils.get_mask_indices(zip(lons, lats), geometries), lats, lons)
+    else:
+        grid_indices = sputils.get_mask_indices(zip(lons, lats), geometries, max_num_les)
     output_geoms = [] if output_geometries is None else output_geometries
     output_column_indices = sputils.get_mask_indices(zip(lons, lats), output_geoms)
 
@@ -137,51 +248,69 @@ def initialize(config, geometries, output_geometries=None):
     local_les_input_dir = os.path.join(output_dir, 'les-input')
     if not restart:
         # Copy les input directory into run directory. Pass the local copy to the les model init.
-        shutil.copytree(les_input_dir, local_les_input_dir)
+        # Only new or changed files are copied, and the staged files are linked into every les run directory.
+        les_input_files = sputils.stage_dir(les_input_dir, local_les_input_dir)
 
     startdate = gcm_model.get_start_datetime() - datetime.timedelta(seconds=les_spinup)
 
     for i in grid_indices:
-        instance_run_dir = os.path.join(output_dir, les_run_dir + '-' + str(i))
-        les = les_init(les_type, local_les_input_dir, instance_run_dir, startdate, i)
         gcm_model.set_mask(i)  # tell GCM that a LES instance is present at this point
+
+    # on a fresh start, the first gcm half step can run while the les instances start up
+    first_half_step = None if restart or gcm_model.first_half_step_done else gcm_first_half_step
+    if les_nodes > 0:
+        spnode.start_nodes(les_nodes, dict((name, globals()[name]) for name in spnode.config_vars), les_node_address)
+        les_models = spnode.start_les(grid_indices, lats, lons, local_les_input_dir, startdate,
+                                      les_columns_per_worker, concurrent=first_half_step)
+    else:
+        les_models = les_startup(grid_indices, local_les_input_dir, startdate, concurrent=first_half_step)
+    for n, (les, i) in enumerate(zip(les_models, grid_indices)):
         les.grid_index = i
         les.lat, les.lon = lats[i], lons[i]
-        les_models.append(les)
+        les.position = n  # position in les_models, for les instances rejoining after a deadline
+        # with clustering, the gcm has parametrized the columns in the first half step
+        les.mask_pending = les_clustering
 
+    spio.init_streams(output_streams)
     spio.init_netcdf(output_name, gcm_model, les_models, startdate, output_columns, append=restart,
-                     with_surf_vars=cplsurf)
+                     with_surf_vars=cplsurf, columns_slab=output_columns_slab, journal=output_journal,
+                     cluster_members=cluster_members)
+    spio.set_attributes(coupling_lag=1 if async_coupling else 0)
     log.info("Successfully initialized GCM and %d LES instances" % len(les_models))
 
     # Switch off async in case any model doesn't support it
-    async_evolve = async_evolve and reduce(lambda p, q: p and q,
-                                           [getattr(m, "support_async", True) for m in [gcm_model] + les_models])
+    models_async = reduce(lambda p, q: p and q, [getattr(m, "support_async", True) for m in [gcm_model] + les_models])
+    async_evolve = async_evolve and models_async
+    if event_driven and not models_async:
+        raise Exception("The event orchestrator requires models supporting asynchronous requests")
 
     if channel_type != "sockets":
+        from amuse.rfi import channel
 
         # the actual thread level provided by the MPI library
         log.info(
             "MpiChannel.is_multithreading_supported(): %s" % (str(channel.MpiChannel.is_multithreading_supported())))
 
         if not channel.MpiChannel.is_multithreading_supported():
-            if not async_evolve and les_queue_threads > 1:
-                log.info(
-                    "Options are set to run Dales instances from separate python threads but the MPI in use does not "
-                    "support multithreading. Exit.")
-                sys.exit()
+            if not async_evolve and les_queue_threads > 1 and not event_driven:
+                if not models_async:
+                    log.info(
+                        "Options are set to run Dales instances from separate python threads but the MPI in use does "
+                        "not support multithreading. Exit.")
+                    sys.exit()
+                if have_deadline():
+                    raise Exception("The MPI in use does not support multithreading, which the les step deadlines "
+                                    "need: the event orchestrator does not support them")
+                log.info("The MPI in use does not support multithreading - driving the Dales instances from a single "
+                         "thread with the event orchestrator")
+                event_driven = True
 
-
-    gcm_model.first_half_step_done = False
     if not restart:
         numpy.random.seed(42)  # seed generator the same way every time - for repeatable simulation
 
         # do first half of first time step in openIFS now, so that U,V,T get initialized
-
-        log.info("gcm.evolve_model_until_cloud_scheme() - first step")
-        gcm_model.evolve_model_until_cloud_scheme()
-        log.info("gcm.evolve_model_cloud_scheme() - first step")
-        gcm_model.evolve_model_cloud_scheme()
-        gcm_model.first_half_step_done = True  # set flag here, to avoid repeating the half step
+        if not gcm_model.first_half_step_done:
+            gcm_first_half_step()
 
         # spio.update_time(gcm_model.get_model_time())
         spio.update_time(0 | units.s)
@@ -193,44 +322,244 @@ def initialize(config, geometries, output_geometries=None):
             # and then we can fetch them
 
             # get the state and apply it on les as initial state
-            for les in les_models:
-                u, v, thl, qt, ps, ql = spcpl.convert_profiles(les)
-                spcpl.set_les_state(les, u, v, thl, qt, ps)
+            set_initial_les_states()
         
             if les_spinup > 0:
                 run_spinup(les_models, gcm_model, les_spinup, les_spinup_steps)
 
+        if dynamic_mask:
+            # suspend the les in columns which are quiet from the start
+            spcpl.gather_gcm_data(gcm_model, les_models, False)
+            update_dynamic_mask(les_models[0].get_model_time() if any(les_models) else None, initial=True)
+
     else:  # we're doing a restart
         # The first time stepping that will happen next is by OpenIFS, to cloud scheme.
         # should we set the forcings on OpenIFS again, here?
         # the data to calculate those forcings may not be available now - they should be saved in the final step of the last run
         # they are saved in spifs.nc
 
+        checkpoint = os.path.join(output_dir, checkpoint_name)
+        # without a checkpoint at the restart time, the tendencies are read from spifs.nc
+        if not spckpt.restore_checkpoint(checkpoint, gcm_model, les_models):
+            if coupling_interval > 1:
+                # the step counter, and with it the position in the coupling interval, is only in the checkpoint
+                raise Exception("Restarts with a coupling interval require a checkpoint at the restart time")
+            ti = spcpl.get_restart_time_index(gcm_model)
+            for les in les_models:
+                spcpl.set_gcm_tendencies_from_file(gcm_model, les, ti)
+
+    return gcm_model, les_models
+
+
+# Does the first half of the first gcm time step
+def gcm_first_half_step():
+    log.info("gcm.evolve_model_until_cloud_scheme() - first step")
+    gcm_model.evolve_model_until_cloud_scheme()
+    log.info("gcm.evolve_model_cloud_scheme() - first step")
+    gcm_model.evolve_model_cloud_scheme()
+    gcm_model.first_half_step_done = True  # set flag here, to avoid repeating the half step
+
+
+# Calls func for every item from num_threads concurrent threads, while the optional function concurrent
+# runs in the calling thread. Exceptions raised in the threads are logged, and an exception is raised when
+# all threads are done.
+def run_concurrently(func, items, num_threads, concurrent=None):
+    work_queue = Queue()
+    for item in items:
+        work_queue.put(item)
+    failed = []
+
+    def work():
+        while True:
+            try:
+                item = work_queue.get_nowait()
+            except Empty:
+                return
+            try:
+                func(item)
+            except Exception as e:
+                log.error("Exception in thread %s: %s" % (threading.current_thread().name, str(e)))
+                failed.append(item)
+
+    threads = [threading.Thread(target=work, name="startup " + str(n)) for n in range(num_threads)]
+    for t in threads:
+        t.start()
+    if concurrent is not None:
+        concurrent()
+    for t in threads:
+        t.join()
+    if len(failed) > 0:
+        raise Exception("%d of %d concurrent tasks failed" % (len(failed), len(items)))
+
+
+# Returns the number of threads to use for starting up the given number of les instances
+def num_startup_threads(num_les):
+    num_threads = min(les_startup_threads, num_les)
+    if num_threads > 1 and not threads_supported():
+        log.info("The MPI in use does not support multithreading - starting les instances one by one")
+        return 1
+    return num_threads
+
+
+# Starts the les models in the given grid columns and returns them in the same order. With
+# les_startup_threads > 1, the instances are started concurrently, while the optional function concurrent
+# (e.g. the first gcm half step) runs in the calling thread. Startup times are written to startup.txt.
+def les_startup(grid_indices, inputdir, startdate, concurrent=None):
+    worker_indices = list(grid_indices)
+    if les_columns_per_worker > 1:
+        # a shared worker for every group of columns, named after its first column
+        worker_indices = worker_indices[::les_columns_per_worker]
+    workers, startup_times = {}, {}
+
+    def start_worker(i):
+        start = time.time()
+        instance_run_dir = os.path.join(output_dir, les_run_dir + '-' + str(i))
+        workers[i] = les_init(les_type, inputdir, instance_run_dir, startdate, i)
+        startup_times[i] = time.time() - start
+        log.info("Started les at index %d in %.2f s" % (i, startup_times[i]))
+
+    num_threads = num_startup_threads(len(worker_indices))
+    if num_threads > 1:
+        run_concurrently(start_worker, worker_indices, num_threads, concurrent)
+    else:
+        for i in worker_indices:
+            start_worker(i)
+        if concurrent is not None:
+            concurrent()
+
+    with open(os.path.join(output_dir, 'startup.txt'), 'a') as f:
+        for i in worker_indices:
+            f.write('%7d %6.2f\n' % (i, startup_times[i]))
+
+    les_list = []
+    mux = None
+    for n, i in enumerate(grid_indices):
+        if les_columns_per_worker > 1:
+            if n % les_columns_per_worker == 0:
+                mux = spmux.les_multiplexer(workers[i])
+            les_list.append(mux.add_column())
+        else:
+            les_list.append(workers[i])
+    return les_list
+
+
+# Sets the state of the gcm columns as initial state on the les models.
+# With les_startup_threads > 1, the fields are sent concurrently. Each les is then perturbed with its own
+# random generator, seeded from the global one, so the result does not depend on the thread scheduling.
+def set_initial_les_states():
+    num_threads = num_startup_threads(len(les_models))
+    if les_nodes > 0:
+        spnode.set_initial_states(les_models)
+    elif num_threads > 1:
+        seeds = numpy.random.randint(0, 2 ** 31 - 1, size=len(les_models))
+        profiles = [spcpl.convert_profiles(les) for les in les_models]
+
+        def set_state(n):
+            u, v, thl, qt, ps, ql = profiles[n]
+            fields = spcpl.perturbed_les_state(les_models[n], u, v, thl, qt, numpy.random.RandomState(seeds[n]))
+            spcpl.apply_les_state(les_models[n], fields, ps)
+
+        run_concurrently(set_state, range(len(les_models)), num_threads)
+    else:
         for les in les_models:
-            spcpl.set_gcm_tendencies_from_file(gcm_model, les)
-        
+            u, v, thl, qt, ps, ql = spcpl.convert_profiles(les)
+            spcpl.set_les_state(les, u, v, thl, qt, ps)
 
 
-        
-    return gcm_model, les_models
+# Returns the number of les workers needed for the given number of superparametrized columns
+def num_les_workers(num_les):
+    if les_columns_per_worker > 1 and num_les > 0:
+        return -(-num_les // les_columns_per_worker)
+    return num_les
 
 
 # Run loop: executes nsteps time steps of the super-parametrized GCM
 def run(nsteps):
+    import psutil
     current_process = psutil.Process(os.getpid())  # get current process, for resource usage measurement
     have_work_queue = 1 < les_queue_threads < len(les_models)
     # TODO: Check whether the gcm supports another nsteps steps
     work_queue, worker_threads = None, []
     if have_work_queue:
         work_queue, worker_threads = start_worker_threads(les_queue_threads)
+    if metrics_port > 0 or metrics_file:
+        spmetrics.start(metrics_port, os.path.join(output_dir, metrics_file) if metrics_file else None)
+        spmetrics.register_les([les.grid_index for les in les_models])
+    profiled, profile_dumps = set(profile_steps), []
     # timestep models together
     for s in range(nsteps):
-        step(work_queue)
+        profiler = start_profile() if gcm_model.step + 1 in profiled else None
+        step(work_queue, last=(s == nsteps - 1))
+        if profiler is not None:
+            profile_dumps.append(stop_profile(profiler, gcm_model.step))
+        if checkpoint_interval > 0 and gcm_model.step % checkpoint_interval == 0:
+            spckpt.write_checkpoint(os.path.join(output_dir, checkpoint_name), gcm_model, les_models)
         log.info('python master usage: %s' % str(current_process.memory_full_info()))
+        log_memory_report()
         log.info('System total: %s' % str(psutil.virtual_memory()))
+        if spmetrics.enabled():
+            spmetrics.publish(master_rss_bytes=current_process.memory_info().rss,
+                              output_queue_depth=spio.queue_depth(),
+                              worker_processes=count_child_processes(current_process),
+                              les_failovers=spfailover.num_failovers, active_les=len(les_models),
+                              skipped_exchanges=spskip.num_skipped)
         log.info('  ---- Time step done ---')
     if have_work_queue:
         stop_worker_threads(work_queue, worker_threads)
+    if any(profile_dumps):
+        write_profile_summary(profile_dumps)
+
+
+# Starts profiling the master. Note that only the main thread is profiled, les instances driven from
+# python threads and background output are not.
+def start_profile():
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+# Stops the profiler and writes its statistics next to the timing file, returns the file name
+def stop_profile(profiler, step_index):
+    profiler.disable()
+    file_name = os.path.join(output_dir, "profile-step%d.prof" % step_index)
+    profiler.dump_stats(file_name)
+    log.info("Wrote profile of step %d to %s" % (step_index, file_name))
+    return file_name
+
+
+# Writes the functions with the largest self time over the profiled steps to the profile summary
+def write_profile_summary(profile_dumps):
+    import pstats
+    file_name = os.path.join(output_dir, "profile-summary.txt")
+    with open(file_name, "w") as f:
+        f.write("Profiled steps: %s\n" % ", ".join(os.path.basename(d) for d in profile_dumps))
+        pstats.Stats(*profile_dumps, stream=f).sort_stats("tottime").print_stats(profile_top)
+    log.info("Wrote profile summary to %s" % file_name)
+
+
+# Returns the memory (bytes) held by the master in numpy arrays, per subsystem
+def memory_report():
+    profile_vars = spcpl.gcm_vars + spcpl.surf_vars + ["gcm_Zf", "gcm_Zh", "ql_ref"]
+    profiles, tendencies, states = 0, 0, 0
+    muxes = {}
+    for les in les_models:
+        profiles += sputils.array_nbytes([getattr(les, name, None) for name in profile_vars])
+        tendencies += sputils.array_nbytes(getattr(les, "gcm_tendencies", None))
+        mux = getattr(les, "mux", None)
+        if isinstance(mux, spmux.les_multiplexer):
+            states += sputils.array_nbytes(les.state)
+            muxes[id(mux)] = mux
+    states += sum(sputils.array_nbytes(mux.initial_state) for mux in muxes.itervalues())
+    return [("gcm profiles", profiles), ("gcm tendencies", tendencies), ("multiplexed les states", states),
+            ("output buffers", spio.buffer_nbytes())]
+
+
+# Logs the master memory per subsystem
+def log_memory_report():
+    report = memory_report()
+    log.info("master memory in %s precision: %s" % (coupling_precision,
+                                                    ", ".join("%s %.3f MB" % (name, n / 1.e6) for name, n in report)))
 
 
 # Spinup loop: executes nsteps time steps of the super-parametrized GCM
@@ -247,6 +576,7 @@ def run_spinup(les_list, gcm, spinup_length, spinup_steps=1):
             iteration_length = spinup_length - (spinup_steps - 1) * iteration_length
         step_spinup(les_list, work_queue, gcm, spinup_length=iteration_length)
 
+    import psutil
     log.info('System total: %s' % str(psutil.virtual_memory()))
     log.info('  ---- Spinup done ---')
     if have_work_queue:
@@ -258,7 +588,8 @@ timing_file = None
 
 # do one gcm time step
 # step les until it catches up
-def step(work_queue=None):
+# last signals the final step of the run, after which the gcm need not start a new step
+def step(work_queue=None, last=False):
     global timing_file
     if not timing_file:
         timing_file = open(output_dir + '/timing.txt', 'a')
@@ -276,6 +607,11 @@ def step(work_queue=None):
             gcm_model.evolve_model_until_cloud_scheme()
             log.info("gcm.evolve_model_cloud_scheme()")
             gcm_model.evolve_model_cloud_scheme()  # note: overwrites set tendencies
+            if async_coupling:
+                # re-apply the lagged tendencies, e.g. those restored at a restart
+                for les in les_models:
+                    if getattr(les, "gcm_tendencies", None) is not None:
+                        spcpl.apply_gcm_tendencies(gcm_model, les)
     except Exception as e:
         log.error("Exception when time-stepping openIFS: %s Exiting." % e.message)
         log.error(sys.exc_info())
@@ -288,35 +624,91 @@ def step(work_queue=None):
     t = gcm_model.get_model_time()
     log.info("gcm evolved to %s" % str(t))
 
+    if (gcm_model.step - 1) % coupling_interval != 0:
+        step_between_exchanges(starttime, gcm_walltime1)
+        return
+
+    resume_late_les()
+
     gather_gcm_data_walltime = -time.time()
-    spcpl.gather_gcm_data(gcm_model, les_models, cplsurf, output_column_indices)
+    spcpl.gather_gcm_data(gcm_model, les_models + suspended_les, cplsurf, output_column_indices,
+                          write_background=output_columns_background)
+    if dynamic_mask:
+        update_dynamic_mask(t + (les_spinup | units.s))
+    if incremental_coupling:
+        update_coupling_skips()
     gather_gcm_data_walltime += time.time()
     
-    delta_t = gcm_model.get_timestep().value_in(units.s)
+    # the les evolve over the coupling interval, with the forcings held
+    delta_t = coupling_interval * gcm_model.get_timestep().value_in(units.s)
+
+    # in the pipelined mode and with sub-coordinators, the les forcings and tendencies are part of the les phase
+    pipelined = les_nodes > 0 or (pipelined_coupling and not async_coupling)
 
     set_les_forcings_walltime = -time.time()
-    for les in les_models:
-        spcpl.set_les_forcings(les, gcm_model, dt_gcm=delta_t, factor=les_forcing_factor,
-                               couple_surface=cplsurf, qt_forcing=qt_forcing)
+    if not pipelined:
+        for les in les_models:
+            if spskip.skipping(les):
+                continue  # the les keeps its forcings
+            try:
+                spcpl.set_les_forcings(les, gcm_model, dt_gcm=delta_t, factor=les_forcing_factor,
+                                       couple_surface=cplsurf, qt_forcing=qt_forcing)
+            except Exception as e:
+                if not les_failover:
+                    raise
+                spfailover.record_failure(les, e)
     set_les_forcings_walltime += time.time()
         
-    # step les models to the end time of the current GCM step = t + delta_t
-    les_wall_times = step_les_models(t + (delta_t | units.s), work_queue, offset=les_spinup)
+    les_walltime = -time.time()
+    if async_coupling:
+        # The gcm finishes this step with the les tendencies of the previous step and does the first half of the
+        # next one, while the les models evolve. Their tendencies are then applied during the next gcm step.
+        gcm_walltime2 = -time.time()
+        les_wall_times = step_les_models_concurrent(t + (delta_t | units.s), work_queue,
+                                                    lambda: gcm_lagged_phase(not last))
+        gcm_walltime2 += time.time()
+    elif les_nodes > 0:
+        les_wall_times = spnode.step_les_models(les_models, t + (delta_t | units.s), delta_t)
+        record_les_times(les_wall_times)
+    elif pipelined:
+        les_wall_times = step_les_models_pipelined(t + (delta_t | units.s), delta_t)
+    else:
+        # step les models to the end time of the current GCM step = t + delta_t
+        les_wall_times = step_les_models(t + (delta_t | units.s), work_queue, offset=les_spinup)
+    replaced = failover_les(t + ((delta_t + les_spinup) | units.s), delta_t)
+    les_walltime += time.time()
 
     set_gcm_tendencies_walltime = -time.time()
     # get les state - for forcing on OpenIFS and les stats
-    for les in les_models:
-        spcpl.set_gcm_tendencies(gcm_model, les, factor=gcm_forcing_factor)
+    if not pipelined:
+        # should be the length of the NEXT time step, the tendencies are applied over the coupling interval
+        ft = coupling_interval * gcm_model.get_timestep().value_in(units.s)
+        for les in les_models:
+            if les not in replaced and not spskip.skipping(les):
+                compute_les_tendencies(les, ft)
+    if health_checks:
+        check_les_health([les for les in les_models if les not in replaced])
+    for les in les_models + late_les + quarantined_les:
+        if getattr(les, "mask_pending", False):
+            les.mask_pending = False  # the les was activated in this step, after the gcm parametrized its column
+            continue
+        spcpl.apply_gcm_tendencies(gcm_model, les)
+    if les_clustering:
+        update_clusters()
     set_gcm_tendencies_walltime += time.time()
-        
-    gcm_walltime2 = -time.time()
-    gcm_model.evolve_model_from_cloud_scheme()
-    gcm_walltime2 += time.time()
+
+    if not async_coupling:
+        gcm_walltime2 = -time.time()
+        gcm_model.evolve_model_from_cloud_scheme()
+        gcm_walltime2 += time.time()
 
     s = ('%10.2f %6.2f %6.2f %6.2f %6.2f %6.2f' % (starttime, gcm_walltime1, gather_gcm_data_walltime, set_les_forcings_walltime, set_gcm_tendencies_walltime, gcm_walltime2)
          + ' ' + ' '.join(['%6.2f' % t for t in les_wall_times]) + '\n')
     timing_file.write(s)
     timing_file.flush()
+    spmetrics.record_step([("gcm", gcm_walltime1 + gcm_walltime2), ("gather_gcm_data", gather_gcm_data_walltime),
+                           ("set_les_forcings", set_les_forcings_walltime), ("les", les_walltime),
+                           ("set_gcm_tendencies", set_gcm_tendencies_walltime), ("step", time.time() - starttime)])
 
     spio.update_time(gcm_model.get_model_time() + (les_spinup | units.s))
 
@@ -326,6 +718,63 @@ def step(work_queue=None):
         spio.sync_root()
 
 
+# Completes a gcm step without exchange with the les, applying their last tendencies once more
+def step_between_exchanges(starttime, gcm_walltime1):
+    set_gcm_tendencies_walltime = -time.time()
+    for les in les_models + late_les + quarantined_les:
+        if getattr(les, "gcm_tendencies", None) is not None:
+            spcpl.apply_gcm_tendencies(gcm_model, les)
+    for index, les in cluster_assignment.iteritems():
+        if les in les_models:
+            spcpl.apply_gcm_tendencies(gcm_model, les, index)
+    set_gcm_tendencies_walltime += time.time()
+
+    gcm_walltime2 = -time.time()
+    gcm_model.evolve_model_from_cloud_scheme()
+    gcm_walltime2 += time.time()
+
+    timing_file.write('%10.2f %6.2f %6.2f %6.2f %6.2f %6.2f' % (starttime, gcm_walltime1, 0., 0.,
+                                                             set_gcm_tendencies_walltime, gcm_walltime2)
+                      + ' ' + ' '.join(['%6.2f' % 0. for les in les_models]) + '\n')
+    timing_file.flush()
+    spmetrics.record_step([("gcm", gcm_walltime1 + gcm_walltime2),
+                           ("set_gcm_tendencies", set_gcm_tendencies_walltime), ("step", time.time() - starttime)])
+    spio.update_time(gcm_model.get_model_time() + (les_spinup | units.s))
+    spio.sync_root()
+
+
+# Completes the current gcm step and, unless next_step is False, does the first half of the next one.
+# Used in the asynchronous coupling mode, where this runs concurrently with the les models.
+def gcm_lagged_phase(next_step=True):
+    if les_budget is not None:
+        les_budget.reserve(gcm_num_procs)
+    try:
+        log.info("gcm.evolve_model_from_cloud_scheme()")
+        gcm_model.evolve_model_from_cloud_scheme()
+        if next_step:
+            log.info("gcm.evolve_model_until_cloud_scheme()")
+            gcm_model.evolve_model_until_cloud_scheme()
+            log.info("gcm.evolve_model_cloud_scheme()")
+            gcm_model.evolve_model_cloud_scheme()
+            gcm_model.first_half_step_done = True  # the les tendencies are set after the cloud scheme
+    finally:
+        if les_budget is not None:
+            les_budget.unreserve(gcm_num_procs)
+
+
+# Returns the nr. of running child processes of the process. Children exiting while they are counted are skipped.
+def count_child_processes(process):
+    import psutil
+    num_children = 0
+    for child in process.children(recursive=True):
+        try:
+            if child.status() != psutil.STATUS_ZOMBIE:
+                num_children += 1
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+    return num_children
+
+
 # Initialization function
 def step_spinup(les_list, work_queue, gcm, spinup_length):
     global timing_file
@@ -347,6 +796,10 @@ def step_spinup(les_list, work_queue, gcm, spinup_length):
         
     # step les models
     les_wall_times = step_les_models(t_les + (spinup_length | units.s), work_queue, offset=0)
+    if any(spfailover.failed):
+        failed = spfailover.clear_failures()
+        raise Exception("Les instances failed during the spinup at points %s" % str([les.grid_index
+                                                                                    for les, _ in failed]))
 
     set_gcm_tendencies_walltime = -time.time() # assign the profile writing time to the same slot as setting gcm tendencies
     for les in les_list:
@@ -378,13 +831,22 @@ def finalize():
     except Exception as e:
         log.error("Exception while stopping gcm: %s" % e.message)
     log.info("Stopping LES instances...")
-    for les in les_models:
+    if any(late_les + dropped_les):
+        log.warning("Not stopping the late les instances at points %s" %
+                    str([les.grid_index for les in late_les + dropped_les]))
+    for les in les_models + suspended_les:
         try:
             les.cleanup_code()
             les.stop()
         except Exception as e:
             log.error("Exception while stopping LES at index %d: %s" % (les.grid_index, e.message))
+    spnode.stop_nodes()
+    spio.wait_output_columns()
+    spio.close_streams()
     spio.cdf_root.close()
+    spio.cdf_root = None
+    spio.stop_io_ranks()
+    spmetrics.stop()
     log.info("spifs cleanup done")
 
 
@@ -437,8 +899,8 @@ def gcm_init(gcmtype, inputdir, workdir, couple_surface):
     return model
 
 
-# Creates and initialized a LES model
-def les_init(lestype, inputdir, workdir, starttime, index):
+# Creates and initialized a LES model. restart_les overrides the restart setting, e.g. for replacing a failed les.
+def les_init(lestype, inputdir, workdir, starttime, index, restart_les=None):
     typekey = lestype
     if lestype == modfac.dummy_type:
         typekey = modfac.dummy_les_type
@@ -448,10 +910,13 @@ def les_init(lestype, inputdir, workdir, starttime, index):
                                 nprocs=les_num_procs,
                                 redirect=les_redirect,
                                 channel_type=channel_type,
-                                restart=restart,
+                                restart=restart if restart_les is None else restart_les,
                                 starttime=starttime,
                                 index=index,
-                                qt_forcing=qt_forcing)
+                                qt_forcing=qt_forcing,
+                                trestart=les_restart_interval,
+                                files=les_input_files,
+                                overlay=les_overlay_files)
     model.initialize_code()
     model.commit_parameters()
     model.commit_grid()
@@ -474,12 +939,16 @@ def worker(work_queue, i):
     global errorFlag
     while True:
         les, model_time, offset = work_queue.get()
+        if isinstance(les, spwatch.queued_step):  # an les step watched by the watchdog, see step_les_models
+            les.run()
+            work_queue.task_done()
+            continue
         if les is None:
             log.info("Worker thread %d exiting" % i)
-            work_queue.put((None, None))  # put the special quit work back into the queue
+            work_queue.put((None, None, None))  # put the special quit work back into the queue
             return  # stop this thread
         log.info("Worker thread %d evolves les at index %d to time %s" % (i, les.grid_index, model_time))
-        step_les(les, model_time, offset)
+        step_les_isolated(les, model_time, offset)
         work_queue.task_done()
         log.info("Worker thread %d is done." % i)
 
@@ -487,7 +956,7 @@ def worker(work_queue, i):
 # Signals and waits for all worker threads to stop.
 def stop_worker_threads(work_queue, worker_threads):
     log.info("Signalling worker threads to quit...")
-    work_queue.put((None, None))  # special work - signals the worker_threads to quit.
+    work_queue.put((None, None, None))  # special work - signals the worker_threads to quit.
     log.info("Waiting for worker threads to quit...")
     for w in worker_threads:  # wait for the worker threads to quit
         w.join()
@@ -500,28 +969,41 @@ def step_les_models(model_time, work_queue, offset=les_spinup):
     les_wall_times = []
     if not any(les_models):
         return les_wall_times
+    if event_driven:
+        return step_les_models_events(model_time, offset)
+    if les_budget is not None:  # Step dales models as their MPI tasks fit into the core budget
+        return step_les_models_scheduled(model_time, offset)
     if les_queue_threads >= len(les_models):  # Step all dales models in parallel
         if async_evolve:  # evolve all dales models with asynchronous Amuse calls
             reqs = []
+            start = time.time()
+            from amuse.rfi.channel import AsyncRequestsPool
             pool = AsyncRequestsPool()
             for les in les_models:
                 req = les.evolve_model.async(model_time + (offset | units.s), exactEnd=True)
                 reqs.append(req)
-                pool.add_request(req)
+                if not have_deadline():
+                    pool.add_request(req)
             # now while the dales threads are working, sync the netcdf to disk
             spio.sync_root()
+            if have_deadline():
+                return wait_les_steps([spwatch.request_step(r) for r in reqs], start)
             # wait for all threads
             pool.waitall()
-            try:
-                les_wall_times = [r.result().value_in(units.s) for r in reqs]
-                log.info("async step_les_models() done. Elapsed times:" + str(['%5.1f' % t for t in les_wall_times]))
-            except Exception as e:
-                log.error("Exception caught while gathering results: %s" % e.message)
+            les_wall_times = gather_les_results(reqs, start)
+            log.info("async step_les_models() done. Elapsed times:" + str(['%5.1f' % t for t in les_wall_times]))
 
+        elif have_deadline():  # evolve all dales models using python threads, watched by the watchdog
+            start = time.time()
+            steps = [spwatch.thread_step(step_les_isolated, (les, model_time, offset), str(les.grid_index), les=les)
+                     for les in les_models]
+            spio.sync_root()
+            return wait_les_steps(steps, start)
         else:  # evolve all dales models using python threads
             threads = []
             for les in les_models:
-                t = threading.Thread(target=step_les, args=(les, model_time, offset), name=str(les.grid_index))
+                t = threading.Thread(target=step_les_isolated, args=(les, model_time, offset),
+                                     name=str(les.grid_index))
                 # t.setDaemon(True)
                 threads.append(t)
                 t.start()
@@ -532,9 +1014,16 @@ def step_les_models(model_time, work_queue, offset=les_spinup):
                 # log.info("Waiting to join thread %s..." % t.name)
                 t.join()
             # log.info("joined thread %s" % t.name)
+    elif les_queue_threads > 1 and have_deadline():  # queue the les steps, watched by the watchdog
+        start = time.time()
+        steps = [spwatch.queued_step(step_les_isolated, (les, model_time, offset), les=les) for les in les_models]
+        for les_step in steps:
+            work_queue.put((les_step, None, None))
+        spio.sync_root()
+        return wait_les_steps(steps, start)
     elif les_queue_threads > 1:
         for les in les_models:
-            work_queue.put((les, model_time))  # enqueue all dales instances
+            work_queue.put((les, model_time, offset))  # enqueue all dales instances
         # now while the dales threads are working, sync the netcdf to disk
         spio.sync_root()
         work_queue.join()  # wait for all dales work to be completed
@@ -546,7 +1035,521 @@ def step_les_models(model_time, work_queue, offset=les_spinup):
             sys.exit(1)
     else:  # sequential version
         for les in les_models:
-            step_les(les, model_time, offset)
+            step_les_isolated(les, model_time, offset)
+    return les_wall_times
+
+
+# Records the wall times of asynchronous les evolves, in the order of les_models
+def record_les_times(les_wall_times):
+    for les, walltime in zip(les_models, les_wall_times):
+        spmetrics.record_les(les.grid_index, walltime)
+
+
+# Returns whether the les steps have a deadline
+def have_deadline():
+    return les_step_deadline > 0 or les_straggler_factor > 0 or les_call_deadline > 0
+
+
+# Waits for the les steps, in the order of les_models, until they are done or late, and applies the deadline
+# policy to the late les instances. Returns the les wall times, late les get the time they were waited for.
+def wait_les_steps(steps, start):
+    late = spwatch.wait_steps(steps, start, les_step_deadline, les_straggler_factor, call_deadline=les_call_deadline)
+    les_list = list(les_models)
+    for index in late:
+        les = les_list[index]
+        log.warning("Les at point %d (lat %.2f, lon %.2f) is late after %.1f s, previous step took %.1f s - %s" %
+                    (les.grid_index, les.lat, les.lon, time.time() - start, getattr(les, "last_walltime", 0.),
+                     {"wait": "waiting", "reuse": "reusing its last tendencies", "drop": "dropping it"}.get(
+                         les_deadline_policy, les_deadline_policy)))
+    les_wall_times = []
+    for index, (les, les_step) in enumerate(zip(les_list, steps)):
+        if index in late and les_deadline_policy != "wait":
+            les_wall_times.append(time.time() - start)
+            suspend_les(les, les_step)
+            continue
+        try:
+            walltime = les_step.finish()
+            les.last_walltime = walltime.value_in(units.s) if hasattr(walltime, "value_in") else walltime
+        except Exception as e:
+            les.last_walltime = les_step_failed(les, e, start)
+        les_wall_times.append(les.last_walltime)
+        spmetrics.record_les(les.grid_index, les.last_walltime)
+    return les_wall_times
+
+
+# Takes a late les out of the coupling, keeping its unfinished step. With the reuse policy, its last tendencies
+# are applied to the gcm until the step completes and the les rejoins (see resume_late_les). With the drop
+# policy, the column is handed back to the gcm parametrizations if the gcm supports it and the les is kept in
+# dropped_les, otherwise it gets zero tendencies for the rest of the run.
+def suspend_les(les, les_step):
+    les_models.remove(les)
+    les.pending_step = les_step
+    les.dropped = les_deadline_policy == "drop"
+    if les.dropped:
+        reset_mask = getattr(gcm_model, "reset_mask", None)
+        if reset_mask is not None:
+            reset_mask(les.grid_index)
+            dropped_les.append(les)
+            return
+        log.warning("The gcm cannot reset the superparametrization mask, applying zero tendencies at point %d" %
+                    les.grid_index)
+        les.gcm_tendencies = None
+    if getattr(les, "gcm_tendencies", None) is None:
+        les.gcm_tendencies = dict((name, numpy.zeros(gcm_model.ktot)) for name in spcpl.gcm_tendency_vars)
+    late_les.append(les)
+
+
+# Lets late les instances whose step has completed rejoin the coupling
+def resume_late_les():
+    for les in list(late_les):
+        if les.dropped or not les.pending_step.done():
+            continue
+        try:
+            les.pending_step.finish()
+        except Exception as e:
+            log.error("Exception caught while gathering result of les at index %d: %s" % (les.grid_index, str(e)))
+        log.info("Les at point %d caught up, it rejoins the coupling" % les.grid_index)
+        late_les.remove(les)
+        les.pending_step = None
+        les_models.append(les)
+    les_models.sort(key=lambda les: les.position)
+
+
+# Checks the numerical health of the les columns with their freshly computed tendencies, see sphealth. Failing
+# columns are quarantined, and listed in health.txt.
+def check_les_health(les_list):
+    profiles, tendencies = {}, {}
+    for name in sphealth.bounds:
+        values = sphealth.stack([getattr(les, "les_profiles", {}).get(name) for les in les_list])
+        if values is not None:
+            profiles[name] = values
+    for name in sphealth.outlier_floors:
+        values = sphealth.stack([(getattr(les, "gcm_tendencies", None) or {}).get(name) for les in les_list])
+        if values is not None:
+            tendencies[name] = values
+    if len(les_list) == 0 or len(profiles) + len(tendencies) == 0:
+        return
+    failing = sphealth.check_columns(profiles, tendencies, health_outlier_factor)
+    if len(failing) == 0:
+        return
+    with open(os.path.join(output_dir, 'health.txt'), 'a') as f:
+        for row, reasons in sorted(failing.iteritems()):
+            action = quarantine_les(les_list[row], reasons)
+            f.write('%10.2f %6d %7d %-10s %s\n' % (time.time(), gcm_model.step, les_list[row].grid_index, action,
+                                                   ', '.join(reasons)))
+
+
+# Masks the tendencies of an les column failing the health checks. With health_reset, the les is reset to the
+# state of its gcm column and continues, at most health_max_resets times. Otherwise it is stopped, and the column is
+# handed back to the gcm parametrizations if the gcm supports it, or gets zero tendencies for the rest of the run.
+# Returns the action.
+def quarantine_les(les, reasons):
+    log.error("Les at point %d (lat %.2f, lon %.2f) failed the health checks: %s" %
+              (les.grid_index, les.lat, les.lon, ', '.join(reasons)))
+    les.gcm_tendencies = dict((name, numpy.zeros(gcm_model.ktot)) for name in spcpl.gcm_tendency_vars)
+    les.health_resets = getattr(les, "health_resets", 0)
+    if health_reset and (health_max_resets <= 0 or les.health_resets < health_max_resets):
+        u, v, thl, qt, ps, ql = spcpl.convert_profiles(les, write=False)
+        spcpl.set_les_state(les, u, v, thl, qt, ps)
+        spskip.invalidate(les)
+        les.health_resets += 1
+        return "reset"
+    les_models.remove(les)
+    try:
+        les.cleanup_code()
+        les.stop()
+    except Exception as e:
+        log.error("Exception while stopping LES at index %d: %s" % (les.grid_index, str(e)))
+    reset_mask = getattr(gcm_model, "reset_mask", None)
+    if reset_mask is not None:
+        reset_mask(les.grid_index)
+        return "unmasked"
+    quarantined_les.append(les)
+    return "quarantine"
+
+
+# Computes the tendencies of an les upon its gcm column, keeping the exchanged profiles for incremental coupling
+def compute_les_tendencies(les, ft):
+    spcpl.compute_gcm_tendencies(les, ft, factor=gcm_forcing_factor)
+    if incremental_coupling:
+        spskip.exchanged(les, incremental_tolerance)
+
+
+# Decides which les skip their exchange with the gcm in the current step, see spskip. The nr. of skipped exchanges
+# is listed in skip.txt.
+def update_coupling_skips():
+    skipped = spskip.update_skips(les_models, incremental_tolerance, incremental_refresh)
+    if skipped > 0:
+        log.info("Incremental coupling: skipped the exchange with %d of %d les" % (skipped, len(les_models)))
+    with open(os.path.join(output_dir, 'skip.txt'), 'a') as f:
+        f.write('%10.2f %6d %6d %6d %8d %8d\n' % (time.time(), gcm_model.step, len(les_models), skipped,
+                                                 spskip.num_skipped, spskip.num_exchanges))
+
+
+# Updates the dynamic superparametrization mask from the gcm profiles gathered for the active and suspended les
+# instances, see spmask. The les of a column which stays quiet for dynamic_mask_quiet_steps steps (or is quiet at
+# the start of the run) is suspended, or stopped with dynamic_mask_retire, and its column is handed back to the gcm
+# parametrizations. A suspended les whose column becomes active is reset to the state of the column, at the les
+# model time les_time. Changes are listed in mask.txt.
+def update_dynamic_mask(les_time, initial=False):
+    candidates = les_models + suspended_les
+    if len(candidates) == 0:
+        return
+    profiles = dict((name, numpy.vstack([getattr(les, name) for les in candidates])) for name in spcpl.gcm_vars)
+    active = spmask.active_columns(spmask.column_indicators(profiles), dynamic_mask_thresholds)
+    activated, suspended = [], []
+    for les, is_active in zip(candidates, active):
+        if les in suspended_les:
+            if is_active:
+                activated.append(activate_les(les, les_time))
+            continue
+        les.quiet_steps = 0 if is_active else getattr(les, "quiet_steps", 0) + 1
+        if not is_active and (initial or les.quiet_steps >= dynamic_mask_quiet_steps):
+            suspend_quiet_les(les)
+            suspended.append(les)
+    les_models.sort(key=lambda les: les.position)
+    if any(activated) or any(suspended):
+        log.info("Dynamic mask: activated les at points %s, suspended les at points %s, %d les active" %
+                 (str([les.grid_index for les in activated]), str([les.grid_index for les in suspended]),
+                  len(les_models)))
+    with open(os.path.join(output_dir, 'mask.txt'), 'a') as f:
+        f.write('%10.2f %6d %6d %6d %6d\n' % (time.time(), gcm_model.step, len(les_models), len(activated),
+                                              len(suspended)))
+
+
+# Lets a suspended les rejoin the coupling, reset to the state of its gcm column at the les model time les_time.
+# Its tendencies are applied from the next step on, the gcm has parametrized the column in the current step.
+def activate_les(les, les_time):
+    suspended_les.remove(les)
+    active = spfailover.shift_clock(les, les_time)
+    u, v, thl, qt, ps, ql = spcpl.convert_profiles(active, write=False)
+    spcpl.set_les_state(active, u, v, thl, qt, ps)
+    gcm_model.set_mask(active.grid_index)
+    active.mask_pending = True
+    active.quiet_steps = 0
+    spskip.invalidate(active)
+    les_models.append(active)
+    return active
+
+
+# Takes the les of a quiet column out of the coupling and hands the column back to the gcm parametrizations.
+# The cloud scheme of the current step has already skipped the column, so it gets the last les tendencies once more.
+def suspend_quiet_les(les):
+    les_models.remove(les)
+    if getattr(les, "gcm_tendencies", None) is not None:
+        spcpl.apply_gcm_tendencies(gcm_model, les)
+    gcm_model.reset_mask(les.grid_index)
+    if not dynamic_mask_retire:
+        suspended_les.append(les)
+        return
+    try:
+        les.cleanup_code()
+        les.stop()
+    except Exception as e:
+        log.error("Exception while stopping LES at index %d: %s" % (les.grid_index, str(e)))
+
+
+# Reassigns the members of representatives which left the coupling in this step: to the les replacing them after a
+# failover, or to the late les instance still running. Other members are handed back to the gcm parametrizations,
+# with the last tendencies of their representative for the current step.
+def remap_cluster_members():
+    current = dict((les.grid_index, les) for les in les_models + late_les)
+    for index, les in cluster_assignment.items():
+        if les in les_models:
+            continue
+        if les.grid_index in current:
+            cluster_assignment[index] = current[les.grid_index]
+            continue
+        if getattr(les, "gcm_tendencies", None) is not None:
+            spcpl.apply_gcm_tendencies(gcm_model, les, index)
+        gcm_model.reset_mask(index)
+        del cluster_assignment[index]
+
+
+# Selects the representative columns of the region with les instances, at most max_num_les, see spcluster.
+# The other columns of the region become cluster members. The gcm state is needed, so this does the first gcm
+# half step. Returns the grid indices of the representatives.
+def cluster_columns(region, lats, lons):
+    global cluster_members
+    gcm_first_half_step()
+    if len(region) == 0:
+        cluster_members = []
+        return region
+    features = spcluster.profile_features(spcluster.gather_profiles(gcm_model, region))
+    representatives = [region[i] for i in spcluster.select_representatives(features, les_cluster_tolerance,
+                                                                            max_num_les)]
+    selected = set(representatives)
+    cluster_members = [(i, lats[i], lons[i]) for i in region if i not in selected]
+    cluster_assignment.clear()
+    log.info("Les clustering: %d representative columns for %d columns" % (len(representatives), len(region)))
+    return representatives
+
+
+# Applies the tendencies of the les instances to the member columns sharing them, then assigns the members to the
+# les of their most similar column for the next step. Assigned members are superparametrized from the next step on,
+# as the gcm has already done the cloud scheme of this step.
+def update_clusters():
+    remap_cluster_members()
+    for index, les in cluster_assignment.iteritems():
+        spcpl.apply_gcm_tendencies(gcm_model, les, index)
+    if len(cluster_members) == 0:
+        return
+    indices = [c[0] for c in cluster_members]
+    member_features = spcluster.profile_features(spcluster.gather_profiles(gcm_model, indices))
+    les_features = spcluster.profile_features(dict(
+        (name, numpy.vstack([getattr(les, name) for les in les_models]) if any(les_models) else numpy.zeros((0, 1)))
+        for name in spcluster.profile_names))
+    nearest, distances = spcluster.assign(member_features, les_features, les_cluster_tolerance)
+    for index, n in zip(indices, nearest):
+        les = les_models[n] if n >= 0 else None
+        if les is not None and index not in cluster_assignment:
+            gcm_model.set_mask(index)
+        elif les is None and index in cluster_assignment:
+            gcm_model.reset_mask(index)
+        if les is None:
+            cluster_assignment.pop(index, None)
+        else:
+            cluster_assignment[index] = les
+    spio.write_cluster_assignment([les_models[n].grid_index if n >= 0 else -1 for n in nearest], distances)
+    log.info("Les clustering: %d of %d member columns share an les" % (len(cluster_assignment), len(indices)))
+
+
+# Replaces the les instances that failed in the current step, evolved to stop_time, see spfailover. Restart files
+# more than coupling_time (s) old are not used. Returns the replacements, which apply their last known tendencies
+# to the gcm in this step.
+def failover_les(stop_time, coupling_time):
+    if not any(spfailover.failed):
+        return []
+    startdate = gcm_model.get_start_datetime() - datetime.timedelta(seconds=les_spinup)
+    inputdir = os.path.join(output_dir, 'les-input')
+
+    def start_les(workdir, index, restart):
+        return les_init(les_type, inputdir, workdir, startdate, index, restart_les=restart)
+
+    return spfailover.failover(les_models, stop_time, gcm_model, start_les, output_dir,
+                               os.path.join(output_dir, les_run_dir), coupling_time)
+
+
+# Steps an les like step_les. With les failover, an exception is recorded as the failure of the les instead of
+# being raised, and the les is replaced after the les phase.
+def step_les_isolated(les, stoptime, offset=0):
+    try:
+        return step_les(les, stoptime, offset)
+    except Exception as e:
+        if not les_failover:
+            raise
+        spfailover.record_failure(les, e)
+        return 0.
+
+
+# Records an exception raised by the step of an les, and returns its wall time
+def les_step_failed(les, error, start):
+    if les_failover:
+        spfailover.record_failure(les, error)
+    else:
+        log.error("Exception caught while gathering result of les at index %d: %s" % (les.grid_index, str(error)))
+    return time.time() - start
+
+
+# Returns the wall times of asynchronous evolve requests, in the order of les_models
+def gather_les_results(reqs, start):
+    les_wall_times = []
+    for les, r in zip(les_models, reqs):
+        try:
+            les_wall_times.append(r.result().value_in(units.s))
+        except Exception as e:
+            les_wall_times.append(les_step_failed(les, e, start))
+    record_les_times(les_wall_times)
+    return les_wall_times
+
+
+# Returns whether les models may be driven from python threads with the channel in use
+def threads_supported():
+    from amuse.rfi import channel
+    return channel_type == "sockets" or channel.MpiChannel.is_multithreading_supported()
+
+
+# Steps the les models while running the given gcm phase concurrently.
+# The les are driven from a separate thread if the channel permits, otherwise with asynchronous requests only.
+def step_les_models_concurrent(model_time, work_queue, gcm_phase):
+    les_wall_times = []
+    if event_driven:
+        les_wall_times = step_les_models_events(model_time, les_spinup, concurrent=gcm_phase)
+    elif threads_supported():
+        les_step = spwatch.thread_step(step_les_models, (model_time, work_queue, les_spinup), "les driver")
+        try:
+            gcm_phase()
+        except Exception:
+            les_step.thread.join()  # no les requests are in flight when the gcm error propagates
+            raise
+        les_wall_times = les_step.finish()  # raises the exception of the les driver, if any
+    elif async_evolve and les_budget is None:
+        reqs = []
+        start = time.time()
+        from amuse.rfi.channel import AsyncRequestsPool
+        pool = AsyncRequestsPool()
+        for les in les_models:
+            req = les.evolve_model.async(model_time + (les_spinup | units.s), exactEnd=True)
+            reqs.append(req)
+            if not have_deadline():
+                pool.add_request(req)
+        gcm_phase()
+        spio.sync_root()
+        if have_deadline():
+            return wait_les_steps([spwatch.request_step(r) for r in reqs], start)
+        pool.waitall()
+        les_wall_times = gather_les_results(reqs, start)
+    else:
+        log.warning("Cannot run the gcm concurrently with the les models with this channel - running them in turn")
+        les_wall_times = step_les_models(model_time, work_queue, offset=les_spinup)
+        gcm_phase()
+    return les_wall_times
+
+
+# Couples and steps every les in a thread of its own: sets its forcings, evolves it and computes its tendencies
+# upon the gcm as soon as it is done. The data exchange with one les then overlaps with the time stepping of the
+# others, instead of the master exchanging data with all les instances in turn before and after the les phase.
+# The calls upon the gcm are left to the main thread.
+def step_les_models_pipelined(model_time, delta_t):
+    les_wall_times = [0.] * len(les_models)
+    widths = [getattr(les, "number_of_workers", les_num_procs) for les in les_models]
+
+    def couple_les(index):
+        les = les_models[index]
+        skip = spskip.skipping(les)
+        try:
+            if not skip:
+                spcpl.set_les_forcings(les, gcm_model, dt_gcm=delta_t, factor=les_forcing_factor,
+                                       couple_surface=cplsurf, qt_forcing=qt_forcing)
+            if les_budget is not None:
+                les_budget.acquire(widths[index])
+            try:
+                les_wall_times[index] = step_les(les, model_time, les_spinup)
+            finally:
+                if les_budget is not None:
+                    les_budget.release(widths[index])
+            if not skip:
+                compute_les_tendencies(les, delta_t)
+        except Exception as e:
+            if not les_failover:
+                raise
+            spfailover.record_failure(les, e)  # the les keeps its last tendencies
+
+    spio.concurrent_writes = True
+    try:
+        # while the les instances are working, sync the netcdf to disk
+        run_concurrently(couple_les, range(len(les_models)), min(les_queue_threads, len(les_models)),
+                         concurrent=spio.sync_root)
+    except Exception as e:
+        log.error("Pipelined les step failed: %s - exiting ..." % e.message)
+        finalize()
+        sys.exit(1)
+    finally:
+        spio.concurrent_writes = False
+    return les_wall_times
+
+
+# Steps the les models with the event orchestrator, from the calling thread only. Every les evolves in the
+# same increments as in step_les, each increment being requested when the previous one completes. At most
+# les_queue_threads les instances run at a time, within the core budget if there is one. The optional
+# function concurrent (e.g. a gcm phase) runs while the les instances evolve.
+def step_les_models_events(model_time, offset, concurrent=None):
+    les_wall_times = [0.] * len(les_models)
+    start_times = [None] * len(les_models)
+    stop_time = model_time + (offset | units.s)
+    step_dt = les_dt | units.s
+    epsilon = 1 | units.s  # tolerance for fp comparison
+    incremental = les_dt > 0 and not les_single_request
+    events = spevents.orchestrator(les_queue_threads, les_budget)
+
+    def evolve_task(index, t):
+        les = les_models[index]
+        target = t + step_dt if incremental else stop_time
+
+        def start():
+            if start_times[index] is None:
+                start_times[index] = time.time()
+            return les.evolve_model.async(target, exactEnd=True)
+
+        def done(result):
+            if incremental and target < stop_time - epsilon:
+                return evolve_task(index, target)
+            les_wall_times[index] = time.time() - start_times[index]
+            spmetrics.record_les(les.grid_index, les_wall_times[index])
+            log.info("Les at point %d evolved to %.0f s - elapsed %f s" % (les.grid_index, target.value_in(units.s),
+                                                                          les_wall_times[index]))
+            return None
+
+        def failed(error):
+            les_wall_times[index] = les_step_failed(les, error, start_times[index] or time.time())
+
+        return spevents.task(str(les.grid_index), start, done, width=getattr(les, "number_of_workers", les_num_procs),
+                             failed=failed if les_failover else None)
+
+    for i, les in enumerate(les_models):
+        t = les.get_model_time()
+        if not incremental or t < stop_time - epsilon:
+            events.submit(evolve_task(i, t))
+    try:
+        # while the first les instances are working, sync the netcdf to disk
+        events.run(concurrent=spio.sync_root if concurrent is None else lambda: (spio.sync_root(), concurrent()))
+    except spevents.task_error as e:
+        log.error("Event-driven les step failed: %s - exiting ..." % e.message)
+        finalize()
+        sys.exit(1)
+    return les_wall_times
+
+
+# Steps the les models, starting each one only when its MPI tasks fit into the core budget
+def step_les_models_scheduled(model_time, offset):
+    les_wall_times = [0.] * len(les_models)
+    widths = [getattr(les, "number_of_workers", les_num_procs) for les in les_models]
+    if async_evolve:  # admit asynchronous evolve requests as cores become available
+        from amuse.rfi.channel import AsyncRequestsPool
+        pool = AsyncRequestsPool()
+
+        def evolve_done(request, index):
+            les_budget.release(widths[index])
+            try:
+                les_wall_times[index] = request.result().value_in(units.s)
+                spmetrics.record_les(les_models[index].grid_index, les_wall_times[index])
+            except Exception as e:
+                les_wall_times[index] = les_step_failed(les_models[index], e, start)
+
+        pending = range(len(les_models))
+        synced = False
+        start = time.time()
+        while len(pending) > 0 or len(pool) > 0:
+            while len(pending) > 0 and les_budget.try_acquire(widths[pending[0]]):
+                index = pending.pop(0)
+                req = les_models[index].evolve_model.async(model_time + (offset | units.s), exactEnd=True)
+                pool.add_request(req, evolve_done, args=(index,))
+            if not synced:
+                # now while the first dales instances are working, sync the netcdf to disk
+                spio.sync_root()
+                synced = True
+            if len(pool) > 0:
+                pool.wait()
+            elif len(pending) > 0:  # nothing runs, wait until the gcm releases its reserved cores
+                les_budget.wait_fits(widths[pending[0]])
+        log.info("scheduled step_les_models() done. Elapsed times:" + str(['%5.1f' % t for t in les_wall_times]))
+    else:  # evolve using python threads, each one waiting for its cores
+        def scheduled_step_les(index):
+            les_budget.acquire(widths[index])
+            try:
+                les_wall_times[index] = step_les_isolated(les_models[index], model_time, offset)
+            finally:
+                les_budget.release(widths[index])
+
+        threads = []
+        for i, les in enumerate(les_models):
+            t = threading.Thread(target=scheduled_step_les, args=(i,), name=str(les.grid_index))
+            threads.append(t)
+            t.start()
+        # now while the dales threads are working, sync the netcdf to disk
+        spio.sync_root()
+        for t in threads:
+            t.join()
     return les_wall_times
 
 
@@ -556,8 +1559,10 @@ def step_les(les, stoptime, offset=0):
     # small les time steps for cloud field gathering
     step_dt = les_dt | units.s
     epsilon = 1 | units.s  # tolerance for fp comparison
-    if not les_dt > 0:
+    if not les_dt > 0 or les_single_request:
         # simply step until caught up
+        # in single-request mode, statistics in between are left to the les' own output
+        spwatch.start_call(les)
         les.evolve_model(stoptime + (offset | units.s), exactEnd=1)
     else:
         # fixed-length stepping intervals to save statistics during the les run
@@ -566,7 +1571,10 @@ def step_les(les, stoptime, offset=0):
             les.grid_index, t.value_in(units.s), stoptime.value_in(units.s), offset))
         while t < stoptime - epsilon + (offset | units.s):
             t += step_dt
+            spwatch.start_call(les)
             les.evolve_model(t, exactEnd=1)
     t = les.get_model_time()
     walltime = time.time() - start
     log.info("Les at point %d evolved to %.0f s - elapsed %f s" % (les.grid_index, t.value_in(units.s), walltime))
+    spmetrics.record_les(les.grid_index, walltime)
+    return walltime
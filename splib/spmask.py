@@ -0,0 +1,54 @@
+import logging
+
+import numpy
+import sputils
+
+# Dynamic superparametrization mask.
+#
+# The columns selected at startup are candidates for superparametrization. Every step, indicators of convective
+# activity are computed from the gcm profiles of all candidate columns together, and compared with thresholds.
+# The master suspends the les of columns which stay quiet and hands these columns back to the gcm
+# parametrizations, and reactivates suspended les when their column becomes active, see splib.update_dynamic_mask.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Indicators of a column, see column_indicators
+indicator_names = ["A", "QL", "instability"]
+
+# Minimal pressure (Pa) of the levels considered for the instability indicator, the lower troposphere
+instability_top = 50000.
+
+
+# Returns the heights (m) of the full levels of gcm columns, from profiles with one row per column
+def full_level_heights(T, SH, QL, QI, Pf, Ph):
+    c = sputils.rv / sputils.rd - 1
+    Tv = T * (1 + c * SH - (QL + QI))
+    dZ = sputils.rd * Tv / (sputils.grav * Pf) * (Ph[:, 1:] - Ph[:, :-1])
+    Zh = numpy.cumsum(dZ[:, ::-1], axis=1)[:, ::-1]  # heights of the lower half levels, the gcm levels start at the top
+    return Zh - 0.5 * dZ
+
+
+# Computes the indicators of gcm columns, from profiles with one row per column (see spcpl.gcm_vars):
+#   A: the maximal cloud fraction
+#   QL: the maximal condensate (liquid and ice) specific humidity, kg/kg
+#   instability: the excess of the moist static energy of the lowest level over its minimum in the lower
+#                troposphere, in K - a proxy for the energy available to convection
+def column_indicators(profiles):
+    T, SH, QL, QI, Pf, Ph, A = (numpy.asarray(profiles[name], dtype=numpy.float64)
+                                for name in ["T", "SH", "QL", "QI", "Pfull", "Phalf", "A"])
+    mse = sputils.cp * T + sputils.grav * full_level_heights(T, SH, QL, QI, Pf, Ph) + sputils.rlv * SH
+    lower = numpy.where(Pf >= instability_top, mse, numpy.inf)
+    return {"A": A.max(axis=1),
+            "QL": (QL + QI).max(axis=1),
+            "instability": (mse[:, -1] - lower.min(axis=1)) / sputils.cp}
+
+
+# Returns which columns are active: those with an indicator above its threshold
+def active_columns(indicators, thresholds):
+    active = numpy.zeros(len(indicators.values()[0]), dtype=bool)
+    for name, threshold in thresholds.iteritems():
+        if name not in indicators:
+            raise Exception("Unknown dynamic mask indicator %s, choose from %s" % (name, str(indicator_names)))
+        active |= indicators[name] > threshold
+    return active
@@ -0,0 +1,209 @@
+import BaseHTTPServer
+import collections
+import logging
+import os
+import threading
+import time
+
+# Run metrics of the master, for watching the throughput of long coupled runs.
+#
+# The metrics are rendered in the Prometheus text format, served on a local http page and/or
+# written to a status file which is rewritten after every time step.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Upper bounds (s) of the latency histogram buckets
+buckets = [0.1, 0.5, 1., 2., 5., 10., 30., 60., 120., 300., 600., 1800., float("inf")]
+
+# Nr. of recent steps used for the step rate
+rate_window = 10
+
+# Descriptions of the gauges published by the master
+gauge_help = {"active_les": "Les instances in the coupling, see the dynamic superparametrization mask",
+              "les_failovers": "Les instances replaced after failing, see spfailover",
+              "master_rss_bytes": "Resident memory of the master process",
+              "output_queue_depth": "Pending netCDF writes of the master (background column writes, "
+                                    "unfinished sends to I/O ranks)",
+              "skipped_exchanges": "Les exchanges skipped by the incremental coupling, see spskip",
+              "worker_processes": "Running child processes of the master (model workers)"}
+
+lock = threading.Lock()
+server = None
+status_file = None
+
+
+# Latency histogram with fixed buckets
+class histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    # Returns the cumulative bucket counts
+    def cumulative(self):
+        total, result = 0, []
+        for n in self.counts:
+            total += n
+            result.append(total)
+        return result
+
+
+# State of the metrics, updated by the master
+class run_metrics(object):
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.steps = 0
+        self.step_times = collections.deque(maxlen=rate_window + 1)
+        self.phases = collections.OrderedDict()
+        self.les_times = {}
+        self.les_last_seen = {}
+        self.gauges = collections.OrderedDict()
+
+    # Returns the nr. of steps per hour over the recent steps
+    def step_rate(self):
+        if len(self.step_times) < 2 or self.step_times[-1] <= self.step_times[0]:
+            return 0.
+        return 3600. * (len(self.step_times) - 1) / (self.step_times[-1] - self.step_times[0])
+
+
+metrics = run_metrics()
+
+
+# Resets the metrics, and starts the http page on the given local port and/or the status file
+def start(port=0, file_name=None):
+    global metrics, server, status_file
+    with lock:
+        metrics = run_metrics()
+        metrics.step_times.append(metrics.start_time)
+    status_file = file_name
+    if port > 0:
+        server = BaseHTTPServer.HTTPServer(("localhost", port), metrics_handler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics server")
+        thread.daemon = True
+        thread.start()
+        log.info("Serving run metrics on http://localhost:%d/metrics" % port)
+    if status_file:
+        log.info("Writing run metrics to %s" % status_file)
+
+
+def stop():
+    global server, status_file
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        server = None
+    status_file = None
+
+
+# Returns whether metrics are published
+def enabled():
+    return server is not None or bool(status_file)
+
+
+# Registers the les instances, so that instances which never respond show up in the liveness metrics
+def register_les(grid_indices):
+    now = time.time()
+    with lock:
+        for index in grid_indices:
+            metrics.les_last_seen.setdefault(index, now)
+
+
+# Records the wall time of an les evolve
+def record_les(grid_index, walltime):
+    with lock:
+        metrics.les_times[grid_index] = walltime
+        metrics.les_last_seen[grid_index] = time.time()
+
+
+# Records a completed time step with the wall times of its phases
+def record_step(phase_times):
+    with lock:
+        metrics.steps += 1
+        metrics.step_times.append(time.time())
+        for phase, walltime in phase_times:
+            metrics.phases.setdefault(phase, histogram()).observe(walltime)
+
+
+# Sets the current values of gauges, e.g. the memory usage of the master, and writes the status file
+def publish(**gauges):
+    with lock:
+        metrics.gauges.update(gauges)
+    if status_file:
+        write_status_file(status_file)
+
+
+# Renders the metrics in the Prometheus text format
+def render():
+    now = time.time()
+    lines = []
+
+    def add(name, kind, description, samples):
+        lines.append("# HELP spifs_%s %s" % (name, description))
+        lines.append("# TYPE spifs_%s %s" % (name, kind))
+        for labels, value in samples:
+            label = "{%s}" % ",".join('%s="%s"' % kv for kv in labels) if labels else ""
+            lines.append("spifs_%s%s %s" % (name, label, repr(float(value))))
+
+    with lock:
+        add("uptime_seconds", "gauge", "Wall time since the start of the run", [((), now - metrics.start_time)])
+        add("steps_total", "counter", "Completed gcm time steps", [((), metrics.steps)])
+        add("step_rate_per_hour", "gauge", "Gcm time steps per wall clock hour over the last %d steps" % rate_window,
+            [((), metrics.step_rate())])
+        lines.extend(format_histogram("phase_seconds", "Wall time of the phases of a time step", "phase",
+                                      metrics.phases))
+        add("les_evolve_seconds", "gauge", "Wall time of the last evolve of each les instance",
+            [((("les", index),), t) for index, t in sorted(metrics.les_times.iteritems())])
+        add("les_last_seen_seconds", "gauge", "Wall time since each les instance last completed an evolve",
+            [((("les", index),), now - t) for index, t in sorted(metrics.les_last_seen.iteritems())])
+        for name, value in metrics.gauges.iteritems():
+            add(name, "gauge", gauge_help.get(name, name), [((), value)])
+    return "\n".join(lines) + "\n"
+
+
+# Formats the bucket, sum and count samples of histograms, labeled by their keys
+def format_histogram(name, description, label, histograms):
+    lines = ["# HELP spifs_%s %s" % (name, description), "# TYPE spifs_%s histogram" % name]
+    for key, hist in histograms.iteritems():
+        for bound, n in zip(buckets, hist.cumulative()):
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append('spifs_%s_bucket{%s="%s",le="%s"} %d' % (name, label, key, le, n))
+        lines.append('spifs_%s_sum{%s="%s"} %s' % (name, label, key, repr(hist.sum)))
+        lines.append('spifs_%s_count{%s="%s"} %d' % (name, label, key, hist.count))
+    return lines
+
+
+# Rewrites the status file, through a temporary file so that readers never see a partial page
+def write_status_file(file_name):
+    tmp_name = file_name + ".tmp"
+    with open(tmp_name, "w") as f:
+        f.write(render())
+    os.rename(tmp_name, file_name)
+
+
+class metrics_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path not in ["/", "/metrics"]:
+            self.send_error(404)
+            return
+        page = render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    # Keeps scrapes out of the log
+    def log_message(self, format, *args):
+        pass
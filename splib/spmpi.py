@@ -8,13 +8,14 @@ log = logging.getLogger(__name__)
 
 # This method broadcasts the process types to all MPI tasks,
 # allowing them to set up model communicators
-def send_model_colors(gcm_procs, les_procs, num_les):
+# The last io_procs tasks are dedicated I/O ranks (see spiorank), their world ranks are returned.
+def send_model_colors(gcm_procs, les_procs, num_les, io_procs=0):
     from mpi4py import MPI
     worldcomm = MPI.COMM_WORLD
     procs = worldcomm.Get_size()
-    if 1 + gcm_procs + num_les * les_procs > procs:
+    if 1 + gcm_procs + num_les * les_procs + io_procs > procs:
         raise Exception("Too few processes launched for requested model configuration")
-    if 1 + gcm_procs + num_les * les_procs < procs:
+    if 1 + gcm_procs + num_les * les_procs + io_procs < procs:
         log.warning("Too many processes launched for requested model configuration")
     # We assume the process has been launched as mpiexec -n1 spmaster.py -nx gcm_worker -ny les_worker
     # colors = numpy.repeat(-1,procs)
@@ -24,6 +25,8 @@ def send_model_colors(gcm_procs, les_procs, num_les):
     for i in range(num_les):
         offset = 1 + gcm_procs + i * les_procs
         colors[offset:offset + les_procs] = 3 + i
+    io_offset = 1 + gcm_procs + num_les * les_procs
+    colors[io_offset:io_offset + io_procs] = 3 + num_les
     log.info("Master process scattering color array " + str(colors))
 
     rec = numpy.zeros(procs, dtype=numpy.int32)
@@ -31,6 +34,20 @@ def send_model_colors(gcm_procs, les_procs, num_les):
     log.info("Master process received " + str(rec))
 
     worldcomm.Split(colors[0], 0)
+    return range(io_offset, io_offset + io_procs)
+
+
+# Entry point of the dedicated I/O ranks: receives the color from the master, and writes netCDF output
+# until the master is done
+def run_io_rank():
+    from mpi4py import MPI
+    import spiorank
+    worldcomm = MPI.COMM_WORLD
+    rec = numpy.zeros(worldcomm.Get_size(), dtype=numpy.int32)
+    worldcomm.Scatter(None, [rec, 1, MPI.INT32_T], root=0)
+    worldcomm.Split(rec[0], worldcomm.Get_rank())
+    log.info("I/O rank %d started" % worldcomm.Get_rank())
+    spiorank.serve(worldcomm, master=0)
 
 
     # moved this into amuse/src/amuse/rfi/channel.py
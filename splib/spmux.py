@@ -0,0 +1,214 @@
+from __future__ import division
+
+import glob
+import logging
+import os
+import re
+import threading
+
+import spcpl
+
+# Multiplexing of several superparametrized columns on a single LES worker.
+#
+# The worker holds the state of one column at a time. Every column keeps its
+# prognostic fields, its model time and the tendencies and settings last sent
+# to it in the master, and these are swapped into the worker when the column
+# is used. This trades a few field transfers per step for one worker process
+# and channel per group of columns, which pays off for small, cheap LES.
+#
+# Note: the worker clock advances with the time integrated by all of its
+# columns, while each column keeps its own model time in the master. Anything
+# in the LES depending on the absolute model time (e.g. the solar zenith angle
+# of interactive radiation) is only consistent for the first column of a group,
+# so les setups with time dependent physics are rejected, see check_setup.
+# Only state reachable through the field getters and setters is swapped: the
+# prognostic fields below, the surface pressure and the optional fields the
+# worker supports. Internal state of the les, e.g. its random generator or the
+# state of an interactive land surface, is shared by the columns of a worker.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Prognostic 3d fields swapped in and out of the worker
+state_fields = ["U", "V", "W", "THL", "QT"]
+
+# Prognostic 3d fields swapped in and out of the worker if it supports them: subgrid turbulent kinetic energy,
+# rain water and rain drop number
+optional_state_fields = ["E12", "QR", "NR"]
+
+# Les namelist settings making the column state depend on the absolute model time or on unswapped state, with a
+# check of the value of the setting
+unsupported_settings = {"iradiation": lambda v: v != "0",
+                        "ltimedep": lambda v: v.strip(".").lower().startswith("t"),
+                        "isurf": lambda v: v == "1"}
+
+
+# Returns the les namelist settings which cannot be multiplexed, as strings, from the namoptions files of the les
+# input directory
+def check_setup(inputdir):
+    problems = []
+    for path in glob.glob(os.path.join(inputdir, "namoptions*")):
+        with open(path) as f:
+            for line in f:
+                match = re.match(r"\s*(\w+)\s*=\s*([^\s,!]+)", line)
+                if match is None:
+                    continue
+                name, value = match.group(1).lower(), match.group(2)
+                if name in unsupported_settings and unsupported_settings[name](value):
+                    problems.append("%s = %s" % (name, value))
+    return problems
+
+
+# Setters that change the column state rather than a persistent setting
+state_setters = ["set_field", "set_surface_pressure"]
+
+
+# A LES worker shared by several columns
+class les_multiplexer(object):
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.columns = []
+        self.active = None
+        self.initial_state = None
+        self.fields = None
+        self.lock = threading.RLock()
+        self.stopped = False
+
+    # Adds a column to this worker, returns the column object to be used by the coupler
+    def add_column(self):
+        column = les_column(self)
+        self.columns.append(column)
+        return column
+
+    # Returns the fields swapped in and out of the worker: the prognostic fields, and the optional ones the worker
+    # can get and set
+    def swapped_fields(self):
+        if self.fields is None:
+            self.fields = list(state_fields)
+            for name in optional_state_fields:
+                try:
+                    values = self.worker.get_field(name)
+                    if values is None:
+                        continue
+                    self.worker.set_field(name, values)
+                    self.fields.append(name)
+                except Exception as e:
+                    log.info("Les field %s is not swapped between multiplexed columns: %s" % (name, str(e)))
+        return self.fields
+
+    # Retrieves the current column state from the worker
+    def get_state(self):
+        state = dict((name, spcpl.to_coupling_precision(name, self.worker.get_field(name)))
+                     for name in self.swapped_fields())
+        state["surface_pressure"] = self.worker.get_surface_pressure()
+        return state
+
+    # Loads the state and settings of the given column into the worker
+    def activate(self, column):
+        if self.active is column:
+            return
+        if self.initial_state is None:
+            self.initial_state = self.get_state()
+        if self.active is not None:
+            self.active.state = self.get_state()
+        state = dict(self.initial_state)
+        if column.state is not None:
+            state.update(column.state)
+        for name in self.swapped_fields():
+            self.worker.set_field(name, state[name])
+        self.worker.set_surface_pressure(state["surface_pressure"])
+        for name, (args, kwargs) in column.settings.iteritems():
+            getattr(self.worker, name)(*args, **kwargs)
+        column.state = None
+        self.active = column
+
+    # Evolves the given column to its stop time, advancing the worker clock by the same interval
+    def evolve_column(self, column, stop_time, exactEnd):
+        with self.lock:
+            self.activate(column)
+            start = self.worker.get_model_time()
+            self.worker.evolve_model(start + (stop_time - column.model_time), exactEnd=exactEnd)
+            column.model_time += self.worker.get_model_time() - start
+
+    # Removes a stopped column from this worker, the worker is stopped with its last column
+    def detach(self, column):
+        with self.lock:
+            if column in self.columns:
+                self.columns.remove(column)
+            if self.active is column:
+                self.active = None
+            if len(self.columns) == 0:
+                self.stop()
+
+    def cleanup_code(self):
+        with self.lock:
+            if not self.stopped:
+                self.worker.cleanup_code()
+
+    def stop(self):
+        with self.lock:
+            if not self.stopped:
+                self.worker.stop()
+                self.stopped = True
+
+
+# A superparametrized column hosted by a multiplexed LES worker. Offers the same
+# interface as a LES model: unknown attributes and methods are forwarded to the worker
+# after the column has been swapped in.
+class les_column(object):
+
+    def __init__(self, mux):
+        self.mux = mux
+        self.state = None
+        self.settings = {}
+        self.model_time = mux.worker.get_model_time()
+        self.support_async = False
+        self.cleaned_up = False
+
+    def __getattr__(self, name):
+        if name == "mux":
+            raise AttributeError(name)
+        attr = getattr(self.mux.worker, name)
+        if not callable(attr):
+            return attr
+        if name.startswith("set_") and name not in state_setters:
+            return self.setting_method(name)
+        return self.column_method(name)
+
+    # Returns a method that swaps in this column before forwarding the call to the worker
+    def column_method(self, name):
+        def method(*args, **kwargs):
+            with self.mux.lock:
+                self.mux.activate(self)
+                return getattr(self.mux.worker, name)(*args, **kwargs)
+
+        return method
+
+    # Returns a setter that is stored with the column, and only forwarded to the worker
+    # when this column is the active one. Stored settings are replayed upon activation.
+    def setting_method(self, name):
+        def method(*args, **kwargs):
+            with self.mux.lock:
+                self.settings[name] = (args, kwargs)
+                if self.mux.active is self:
+                    return getattr(self.mux.worker, name)(*args, **kwargs)
+
+        return method
+
+    def get_model_time(self):
+        return self.model_time
+
+    def evolve_model(self, stop_time, exactEnd=True):
+        self.mux.evolve_column(self, stop_time, exactEnd)
+
+    # Stopping a column leaves the other columns of its worker running. The worker is cleaned up when all of its
+    # columns are, and stopped with its last column.
+    def cleanup_code(self):
+        with self.mux.lock:
+            self.cleaned_up = True
+            if all(c.cleaned_up for c in self.mux.columns):
+                self.mux.cleanup_code()
+
+    def stop(self):
+        self.mux.detach(self)
@@ -0,0 +1,317 @@
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+
+import numpy
+import spcpl
+import spio
+import sputils
+
+from amuse.units import units
+
+# Hierarchical coupling with a sub-coordinator per node.
+#
+# Every sub-coordinator is a python process owning the les instances of its node. It sets their forcings,
+# steps them and computes their tendencies upon the gcm locally. Per step, the master exchanges one message
+# with every sub-coordinator, holding the gcm profiles of its columns, and receives the tendencies and
+# the les output of all its columns in the reply. The master keeps a proxy (node_les) for every les,
+# holding the profiles, tendencies and the grid properties needed for the netCDF output.
+#
+# Sub-coordinators are started with spnode_coordinator.py. By default the master launches them as local
+# processes. For multi-node runs, the master listens on les_node_address and the job script starts a
+# sub-coordinator on every node, connecting to that address. Master and sub-coordinators share the key
+# in the environment variable SPIFS_NODE_KEY. The sub-coordinators get the settings of the master (config_vars)
+# in their first message, and start and step their les instances with the functions of the driver passed to serve.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Environment variable holding the authentication key of the connections
+key_variable = "SPIFS_NODE_KEY"
+
+# Settings of the master passed to the sub-coordinators
+config_vars = ["les_type", "les_dt", "les_single_request", "les_spinup", "les_exp_name", "les_overlay_files",
+               "les_run_dir", "les_num_procs", "les_redirect", "les_forcing_factor", "les_queue_threads",
+               "les_columns_per_worker", "les_startup_threads", "gcm_forcing_factor", "output_dir",
+               "channel_type", "restart", "les_restart_interval", "cplsurf", "qt_forcing", "coupling_precision",
+               "les_input_files", "les_stage_dir"]
+
+# Grid properties of the les instances, sent to the master for the netCDF output
+grid_properties = ["itot", "jtot", "k", "dx", "dy", "xsize", "ysize", "zf", "zh"]
+
+listener = None
+nodes = []
+processes = []
+
+
+# Proxy of an les instance owned by a sub-coordinator
+class node_les(object):
+
+    def __init__(self, node, grid_index, properties):
+        self.__dict__.update(properties)
+        self.node = node
+        self.grid_index = grid_index
+        self.support_async = False
+
+    # the les instances are stopped by their sub-coordinator
+    def cleanup_code(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+# Connection to a sub-coordinator, used from the master
+class node_client(object):
+
+    def __init__(self, conn, index):
+        self.conn = conn
+        self.index = index
+
+    def send(self, *msg):
+        self.conn.send(msg)
+
+    def receive(self):
+        reply = self.conn.recv()
+        if isinstance(reply, Exception):
+            raise Exception("Sub-coordinator %d failed: %s" % (self.index, str(reply)))
+        return reply
+
+
+# Returns the authentication key, generating one for local sub-coordinators if it is not set
+def get_key():
+    if key_variable not in os.environ:
+        os.environ[key_variable] = os.urandom(16).encode("hex")
+    return os.environ[key_variable]
+
+
+# Starts num_nodes local sub-coordinators, or waits for num_nodes sub-coordinators to connect to the
+# given "host:port" address, and sends them the settings in config (see config_vars)
+def start_nodes(num_nodes, config, address=None):
+    global listener, nodes, processes
+    key = get_key()
+    if address is None:
+        listener = Listener(("localhost", 0), authkey=key)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spnode_coordinator.py")
+        host, port = listener.address
+        processes = [subprocess.Popen([sys.executable, script, "%s:%d" % (host, port)]) for _ in range(num_nodes)]
+    else:
+        host, port = address.rsplit(":", 1)
+        listener = Listener((host, int(port)), authkey=key)
+        log.info("Waiting for %d sub-coordinators on %s" % (num_nodes, address))
+    nodes = [node_client(listener.accept(), i) for i in range(num_nodes)]
+    for node in nodes:
+        node.send("config", config)
+    for node in nodes:
+        node.receive()
+    log.info("Connected to %d sub-coordinators" % num_nodes)
+
+
+# Lets the sub-coordinators stop their les instances and exit
+def stop_nodes():
+    global listener, nodes, processes
+    for node in nodes:
+        try:
+            node.send("stop")
+            node.receive()
+        except Exception as e:
+            log.error("Exception while stopping sub-coordinator %d: %s" % (node.index, str(e)))
+    for p in processes:
+        p.wait()
+    if listener is not None:
+        listener.close()
+    listener, nodes, processes = None, [], []
+
+
+# Splits the columns into contiguous blocks, one per sub-coordinator. With multiplexed les workers,
+# the blocks consist of whole workers.
+def split_columns(grid_indices, num_nodes, block=1):
+    num_blocks = -(-len(grid_indices) // block)
+    bounds = [block * (num_blocks * i // num_nodes) for i in range(num_nodes + 1)]
+    return [grid_indices[bounds[i]:bounds[i + 1]] for i in range(num_nodes)]
+
+
+# Starts the les instances on the sub-coordinators and returns their proxies, in the order of grid_indices.
+# The columns of a multiplexed les worker stay on one sub-coordinator. The optional function concurrent
+# (e.g. the first gcm half step) runs while the les instances start.
+def start_les(grid_indices, lats, lons, inputdir, startdate, columns_per_worker=1, concurrent=None):
+    blocks = split_columns(list(grid_indices), len(nodes), columns_per_worker)
+    for node, block in zip(nodes, blocks):
+        node.send("start", block, [lats[i] for i in block], [lons[i] for i in block], inputdir, startdate)
+    if concurrent is not None:
+        concurrent()
+    les_list = []
+    for node, block in zip(nodes, blocks):
+        for i, properties in zip(block, node.receive()):
+            les_list.append(node_les(node, i, properties))
+            log.info("Les at index %d runs on sub-coordinator %d" % (i, node.index))
+    return les_list
+
+
+# Returns the gcm profiles of the les proxies of a node, as set by spcpl.gather_gcm_data
+def get_profiles(les_list, node):
+    names = spcpl.gcm_vars + spcpl.surf_vars
+    return dict((les.grid_index, dict((name, getattr(les, name)) for name in names if hasattr(les, name)))
+                for les in les_list if les.node is node)
+
+
+# Writes the les output returned by a sub-coordinator
+def write_output(les_list, output):
+    for les in les_list:
+        for data in output.get(les.grid_index, []):
+            spio.write_les_data(les, **data)
+
+
+# Sets the state of the gcm columns as initial state on the les instances. As with concurrent startup
+# threads, every les is perturbed with its own random generator, seeded from the global one.
+def set_initial_states(les_list):
+    seeds = dict(zip([les.grid_index for les in les_list],
+                     numpy.random.randint(0, 2 ** 31 - 1, size=len(les_list))))
+    for node in nodes:
+        node.send("init_states", get_profiles(les_list, node), seeds)
+    for node in nodes:
+        write_output(les_list, node.receive())
+
+
+# Couples and steps the les instances of all sub-coordinators to stop_time. Stores the tendencies upon
+# the gcm with the les proxies, to be applied by the master. Returns the les wall times.
+def step_les_models(les_list, stop_time, delta_t):
+    for node in nodes:
+        node.send("step", stop_time.value_in(units.s), delta_t, get_profiles(les_list, node))
+    # now while the les instances are working, sync the netcdf to disk
+    spio.sync_root()
+    tendencies, wall_times = {}, {}
+    for node in nodes:
+        node_tendencies, output, node_wall_times = node.receive()
+        tendencies.update(node_tendencies)
+        wall_times.update(node_wall_times)
+        write_output(les_list, output)
+    for les in les_list:
+        les.gcm_tendencies = tendencies[les.grid_index]
+    return [wall_times[les.grid_index] for les in les_list]
+
+
+# Sub-coordinator state: the les instances of the node and their output. The driver provides the functions
+# starting and stepping les instances, see splib: read_config, les_startup, step_les, run_concurrently and
+# threads_supported.
+class coordinator(object):
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.config = {}
+        self.les_list = []
+        self.output = {}
+        self.lock = threading.Lock()
+
+    # Collects the les output instead of writing it, see spio.les_data_sink
+    def collect(self, les, data):
+        with self.lock:
+            self.output.setdefault(les.grid_index, []).append(data)
+
+    # Returns and clears the collected output
+    def take_output(self):
+        with self.lock:
+            output, self.output = self.output, {}
+        return output
+
+    def set_profiles(self, profiles):
+        for les in self.les_list:
+            for name, value in profiles[les.grid_index].iteritems():
+                setattr(les, name, value)
+
+    # Applies the settings of the master
+    def configure(self, config):
+        self.config = config
+        self.driver.read_config(config)
+        spcpl.set_precision(config["coupling_precision"])
+
+    # Starts the les instances of the node. With a node-local stage directory, the les input is copied there once
+    # and the les run directories link to the node-local copies, so that the les instances do not read their input
+    # from the shared file system.
+    def start(self, grid_indices, lats, lons, inputdir, startdate):
+        stagedir = self.config.get("les_stage_dir", None)
+        if stagedir is not None and not self.config["restart"]:
+            self.driver.read_config({"les_input_files": sputils.stage_dir(inputdir, stagedir)})
+            inputdir = stagedir
+        self.les_list = self.driver.les_startup(grid_indices, inputdir, startdate)
+        for les, i, lat, lon in zip(self.les_list, grid_indices, lats, lons):
+            les.grid_index = i
+            les.lat, les.lon = lat, lon
+        return [dict((name, getattr(les, name)) for name in grid_properties) for les in self.les_list]
+
+    # Sets the initial les states, perturbed with the given random seeds, one per les
+    def init_states(self, profiles, seeds):
+        self.set_profiles(profiles)
+        for les in self.les_list:
+            u, v, thl, qt, ps, ql = spcpl.convert_profiles(les)
+            fields = spcpl.perturbed_les_state(les, u, v, thl, qt, numpy.random.RandomState(seeds[les.grid_index]))
+            spcpl.apply_les_state(les, fields, ps)
+        return self.take_output()
+
+    def step(self, stop_time, delta_t, profiles):
+        self.set_profiles(profiles)
+        wall_times = {}
+
+        config = self.config
+
+        def couple_les(les):
+            spcpl.set_les_forcings(les, None, dt_gcm=delta_t, factor=config["les_forcing_factor"],
+                                   couple_surface=config["cplsurf"], qt_forcing=config["qt_forcing"])
+            wall_times[les.grid_index] = self.driver.step_les(les, stop_time | units.s, config["les_spinup"])
+            spcpl.compute_gcm_tendencies(les, delta_t, factor=config["gcm_forcing_factor"])
+
+        num_threads = min(config["les_queue_threads"], len(self.les_list))
+        if num_threads > 1 and self.driver.threads_supported():
+            self.driver.run_concurrently(couple_les, self.les_list, num_threads)
+        else:
+            for les in self.les_list:
+                couple_les(les)
+        tendencies = dict((les.grid_index, les.gcm_tendencies) for les in self.les_list)
+        return tendencies, self.take_output(), wall_times
+
+    def stop(self):
+        for les in self.les_list:
+            try:
+                les.cleanup_code()
+                les.stop()
+            except Exception as e:
+                log.error("Exception while stopping LES at index %d: %s" % (les.grid_index, e.message))
+
+
+# Main loop of a sub-coordinator: connects to the master at "host:port" and executes its requests until it
+# sends stop. The les instances are driven with the functions of driver, see coordinator.
+def serve(address, driver):
+    host, port = address.rsplit(":", 1)
+    conn = Client((host, int(port)), authkey=get_key())
+    node = coordinator(driver)
+    spio.les_data_sink = node.collect
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            log.error("Lost the connection to the master, stopping the les instances")
+            node.stop()
+            break
+        op, args = msg[0], msg[1:]
+        start = time.time()
+        try:
+            if op == "config":
+                node.configure(args[0])
+                reply = None
+            elif op == "stop":
+                node.stop()
+                reply = None
+            else:
+                reply = getattr(node, op)(*args)
+        except Exception as e:
+            log.error("Sub-coordinator request %s failed: %s" % (op, str(e)))
+            reply = e
+        conn.send(reply)
+        log.info("Sub-coordinator request %s took %.2f s" % (op, time.time() - start))
+        if op == "stop":
+            break
+    conn.close()
@@ -0,0 +1,71 @@
+import logging
+import threading
+
+# Logger
+log = logging.getLogger(__name__)
+
+
+# Returns the number of cores this process may run on
+def detect_cores():
+    import psutil
+    try:
+        return len(psutil.Process().cpu_affinity())
+    except (AttributeError, NotImplementedError):
+        return psutil.cpu_count()
+
+
+# Core budget shared by the les instances. Codes are admitted only when their MPI width fits into the
+# cores that are not in use, so that the node is never oversubscribed. Cores of other codes running
+# concurrently (e.g. the gcm) can be reserved temporarily.
+class core_budget(object):
+
+    def __init__(self, total):
+        self.total = total
+        self.used = 0
+        self.reserved = 0
+        self.condition = threading.Condition()
+        log.info("Les core budget: %d cores" % total)
+
+    def available(self):
+        return self.total - self.reserved - self.used
+
+    # A code which is wider than the whole budget is admitted when nothing else is running and no cores are
+    # reserved, otherwise it would never start
+    def fits(self, ncores):
+        return ncores <= self.available() or (self.used == 0 and self.reserved == 0)
+
+    # Claims cores for a code without waiting, returns False if they are not available
+    def try_acquire(self, ncores):
+        with self.condition:
+            if not self.fits(ncores):
+                return False
+            self.used += ncores
+            return True
+
+    # Claims cores for a code, blocks the calling thread until they are available
+    def acquire(self, ncores):
+        with self.condition:
+            while not self.fits(ncores):
+                self.condition.wait()
+            self.used += ncores
+
+    # Blocks the calling thread until a code fits, without claiming its cores
+    def wait_fits(self, ncores):
+        with self.condition:
+            while not self.fits(ncores):
+                self.condition.wait()
+
+    def release(self, ncores):
+        with self.condition:
+            self.used -= ncores
+            self.condition.notify_all()
+
+    # Reserves cores for codes outside the budget, e.g. the gcm while it runs concurrently with les instances
+    def reserve(self, ncores):
+        with self.condition:
+            self.reserved += ncores
+
+    def unreserve(self, ncores):
+        with self.condition:
+            self.reserved -= ncores
+            self.condition.notify_all()
@@ -0,0 +1,66 @@
+import logging
+
+import numpy
+
+# Change-driven coupling of quiet columns.
+#
+# At every exchange, the gcm profiles sent to an les and the les profiles fetched from it are kept. In the next
+# step, the exchange is skipped when the gcm profiles changed less than the tolerances since the last exchange, and
+# the les profiles changed less than the tolerances between the last two exchanges: the les keeps its forcings and
+# the gcm gets the last tendencies of the column again. An exchange is forced every refresh steps.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Gcm profiles (see spcpl.gcm_vars) and les profiles (see spcpl.compute_gcm_tendencies) compared between exchanges
+gcm_names = ["U", "V", "T", "SH"]
+les_names = ["u", "v", "thl", "qt"]
+
+num_exchanges = 0  # exchanges done
+num_skipped = 0  # exchanges skipped
+
+
+# Returns the maximal change of the profiles, relative to the tolerances. Infinite when there are no old profiles.
+def relative_change(new, old, names, tolerance):
+    if old is None:
+        return numpy.inf
+    return max(numpy.abs(numpy.asarray(new[name]) - numpy.asarray(old[name])).max() / tolerance[name]
+               for name in names)
+
+
+# Decides for every les whether its exchange is skipped in the current step, after the gcm profiles have been
+# gathered. Sets les.skip_exchange and returns the nr. of skipped exchanges.
+def update_skips(les_list, tolerance, refresh):
+    global num_exchanges, num_skipped
+    skipped = 0
+    for les in les_list:
+        gcm_profiles = dict((name, getattr(les, name)) for name in gcm_names)
+        les.skip_exchange = (getattr(les, "steps_skipped", 0) < refresh - 1 and
+                             getattr(les, "les_change", numpy.inf) <= 1. and
+                             relative_change(gcm_profiles, getattr(les, "exchanged_gcm", None), gcm_names,
+                                             tolerance) <= 1.)
+        if les.skip_exchange:
+            les.steps_skipped = getattr(les, "steps_skipped", 0) + 1
+            skipped += 1
+    num_exchanges += len(les_list) - skipped
+    num_skipped += skipped
+    return skipped
+
+
+# Keeps the profiles of an exchange with the les, after its tendencies upon the gcm have been computed
+def exchanged(les, tolerance):
+    les.les_change = relative_change(les.les_profiles, getattr(les, "exchanged_les", None), les_names, tolerance)
+    les.exchanged_les = dict((name, numpy.array(les.les_profiles[name])) for name in les_names)
+    les.exchanged_gcm = dict((name, numpy.array(getattr(les, name))) for name in gcm_names)
+    les.steps_skipped = 0
+
+
+# Forces an exchange with the les in the next step, e.g. after its state was reset
+def invalidate(les):
+    les.exchanged_gcm, les.exchanged_les, les.les_change = None, None, numpy.inf
+    les.skip_exchange = False
+
+
+# Returns whether the exchange with the les is skipped in the current step
+def skipping(les):
+    return getattr(les, "skip_exchange", False)
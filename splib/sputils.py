@@ -1,5 +1,6 @@
 import numpy
 import os
+import shutil
 import logging
 import haversine
 import shapely.geometry
@@ -71,8 +72,52 @@ def get_mask_indices(points, mask_geoms, nmax=-1):
 
 
 # Links contents of input directory
-def link_dir(files, workdir):
+# files whose names are in copies are copied instead, e.g. when they are modified per instance
+# The links point into a staged input tree (see stage_dir), copied once per run or, with node sub-coordinators,
+# once per node onto node-local storage.
+def link_dir(files, workdir, copies=()):
     os.makedirs(workdir)
     for f in files:
         fname = os.path.basename(f)
-        os.symlink(os.path.abspath(f), os.path.join(workdir, fname))
+        if fname in copies:
+            shutil.copy(f, workdir)
+        else:
+            os.symlink(os.path.abspath(f), os.path.join(workdir, fname))
+
+
+# Copies the contents of the input directory into the staging directory. Files already present there with the
+# same size and modification time are not copied again. Returns the paths of the staged files.
+def stage_dir(inputdir, stagedir):
+    if not os.path.isdir(stagedir):
+        os.makedirs(stagedir)
+    staged = []
+    for fname in sorted(os.listdir(inputdir)):
+        src, dst = os.path.join(inputdir, fname), os.path.join(stagedir, fname)
+        if os.path.isdir(src):
+            stage_dir(src, dst)
+        elif not is_same_file(src, dst):
+            shutil.copy2(src, dst)
+        staged.append(dst)
+    return staged
+
+
+# Returns whether the destination file exists with the size and modification time of the source file
+def is_same_file(src, dst):
+    if not os.path.isfile(dst):
+        return False
+    src_stat, dst_stat = os.stat(src), os.stat(dst)
+    return src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+
+# Returns the nr. of bytes in the numpy arrays held by the object, looking into quantities,
+# dictionaries, lists and tuples
+def array_nbytes(obj):
+    if isinstance(obj, numpy.ndarray):
+        return obj.nbytes
+    if hasattr(obj, "number") and hasattr(obj, "unit"):
+        return array_nbytes(obj.number)
+    if isinstance(obj, dict):
+        return sum(array_nbytes(v) for v in obj.itervalues())
+    if isinstance(obj, (list, tuple)):
+        return sum(array_nbytes(v) for v in obj)
+    return 0
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+
+import numpy
+
+# Watchdog for the les time steps of a gcm step.
+#
+# The les steps run as asynchronous requests or python threads. Instead of waiting for all of them without
+# limit, the master polls them until they are done or late: after a deadline, or when an les takes much
+# longer than the other ones of the same step, or when a single request to an les takes longer than the call
+# deadline. What happens with late les instances is up to the caller.
+
+# Logger
+log = logging.getLogger(__name__)
+
+# Minimal wall time (s) of an les step before it can count as a straggler
+min_straggler_time = 10.
+
+
+# Records the start of a request to an les, for the call deadline of the step driving it
+def start_call(les):
+    les.call_start = time.time()
+
+
+# Les step running as an asynchronous amuse request, a single call
+class request_step(object):
+
+    def __init__(self, request):
+        self.request = request
+        self.start = time.time()
+
+    def done(self):
+        return self.request.is_result_available()
+
+    def finish(self):
+        return self.request.result()
+
+    def call_started(self):
+        return self.start
+
+
+# Les step running in a python thread. The start of its current call is taken from the les, see start_call.
+class thread_step(object):
+
+    def __init__(self, target, args, name, les=None):
+        self.result, self.error = None, None
+        self.les = les
+        self.thread = threading.Thread(target=self.run, args=(target, args), name=name)
+        self.thread.start()
+
+    def run(self, target, args):
+        try:
+            self.result = target(*args)
+        except Exception as e:
+            self.error = e
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def finish(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def call_started(self):
+        return getattr(self.les, "call_start", None)
+
+
+# Les step queued for a pool of worker threads, which call run
+class queued_step(object):
+
+    def __init__(self, target, args, les=None):
+        self.target, self.args = target, args
+        self.result, self.error = None, None
+        self.les = les
+        self.event = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.target(*self.args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def finish(self):
+        self.event.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def call_started(self):
+        return getattr(self.les, "call_start", None)
+
+
+# Waits until all steps are done, or the others are late: deadline seconds after start or, with a straggler
+# factor, taking that many times the median wall time of the finished steps once half of them are done.
+# With a call deadline, a step is also late when its current call started more than call_deadline seconds ago;
+# such hung steps are not waited for, but the other ones are. Returns the indices of the late steps.
+def wait_steps(steps, start, deadline=0, straggler_factor=0, poll_interval=0.1, min_time=None, call_deadline=0):
+    min_time = min_straggler_time if min_time is None else min_time
+    done_times = {}
+    hung = []
+    while True:
+        now = time.time()
+        for i, step in enumerate(steps):
+            if i not in done_times and step.done():
+                done_times[i] = now - start
+        remaining = [i for i in range(len(steps)) if i not in done_times]
+        if all(i in hung for i in remaining):
+            return remaining
+        elapsed = now - start
+        if 0 < deadline < elapsed:
+            log.warning("%d les steps missed the deadline of %.1f s" % (len(remaining), deadline))
+            return remaining
+        if call_deadline > 0:
+            new_hung = [i for i in remaining if i not in hung and
+                        now - (steps[i].call_started() or now) > call_deadline]
+            if len(new_hung) > 0:
+                log.warning("%d les requests take over the call deadline of %.1f s" % (len(new_hung), call_deadline))
+                hung.extend(new_hung)
+                continue
+        if straggler_factor > 0 and 2 * len(done_times) >= len(steps):
+            median = numpy.median(done_times.values())
+            if elapsed > max(straggler_factor * median, min_time):
+                log.warning("%d les steps take over %.1f times the median les wall time of %.1f s" %
+                            (len(remaining), straggler_factor, median))
+                return remaining
+        time.sleep(poll_interval)
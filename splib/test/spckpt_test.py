@@ -0,0 +1,66 @@
+import os
+import tempfile
+import numpy
+from splib import spckpt
+from splib import spdummy
+
+
+class Testspckpt(object):
+
+    class column(object):
+        def __init__(self, index, ktot):
+            self.grid_index = index
+            self.gcm_tendencies = dict((v, numpy.random.uniform(size=ktot)) for v in spckpt.spcpl.gcm_tendency_vars)
+
+    def test_restore(self):
+        gcm = spdummy.dummy_gcm(1)
+        gcm.step = 7
+        gcm.first_half_step_done = True
+        les_models = [self.column(i, gcm.ktot) for i in [12, 3, 40]]
+        path = os.path.join(tempfile.mkdtemp(), "checkpoint.npz")
+        spckpt.write_checkpoint(path, gcm, les_models)
+        draw = numpy.random.uniform()
+
+        restarted = [self.column(i, gcm.ktot) for i in [3, 12, 40]]
+        gcm.step = 0
+        spckpt.restore_checkpoint(path, gcm, restarted)
+        assert gcm.step == 7
+        assert numpy.random.uniform() == draw
+        for les in restarted:
+            original = [l for l in les_models if l.grid_index == les.grid_index][0]
+            for varname in spckpt.spcpl.gcm_tendency_vars:
+                assert numpy.array_equal(les.gcm_tendencies[varname], original.gcm_tendencies[varname])
+
+    def test_time_mismatch(self):
+        gcm = spdummy.dummy_gcm(1)
+        gcm.step = 7
+        gcm.first_half_step_done = False
+        les_models = [self.column(i, gcm.ktot) for i in [12, 3]]
+        path = os.path.join(tempfile.mkdtemp(), "checkpoint.npz")
+        spckpt.write_checkpoint(path, gcm, les_models)
+        gcm.evolve_model_single_step()
+        spckpt.write_checkpoint(path, gcm, les_models)
+        assert spckpt.checkpoint_times(path) == [0, 600]
+        gcm.evolve_model_single_step()
+
+        restarted = [self.column(i, gcm.ktot) for i in [3, 12]]
+        tendencies = [les.gcm_tendencies for les in restarted]
+        gcm.step = 0
+        assert not spckpt.restore_checkpoint(path, gcm, restarted)
+        assert gcm.step == 0
+        assert [les.gcm_tendencies for les in restarted] == tendencies
+
+    def test_pick_restart_time(self):
+        gcm = spdummy.dummy_gcm(1)
+        gcm.first_half_step_done = False
+        les_models = [self.column(i, gcm.ktot) for i in [3, 12]]
+        path = os.path.join(tempfile.mkdtemp(), "checkpoint.npz")
+        for step in [7, 8]:
+            gcm.step = step
+            spckpt.write_checkpoint(path, gcm, les_models)
+            gcm.evolve_model_single_step()
+
+        gcm.model_time = gcm.get_timestep()
+        gcm.step = 0
+        assert spckpt.restore_checkpoint(path, gcm, [self.column(i, gcm.ktot) for i in [3, 12]])
+        assert gcm.step == 8
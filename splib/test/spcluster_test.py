@@ -0,0 +1,42 @@
+import numpy
+
+from splib import spcluster
+
+
+class Testspcluster(object):
+
+    tolerance = {"Tv": 0.5, "QT": 5e-4, "U": 1., "V": 1.}
+
+    @staticmethod
+    def features(ncols, nlev, seed=1):
+        rng = numpy.random.RandomState(seed)
+        return {"Tv": 280. + rng.normal(0., 0.5, (ncols, nlev)), "QT": 0.01 + rng.normal(0., 5e-4, (ncols, nlev)),
+                "U": rng.normal(0., 1., (ncols, nlev)), "V": rng.normal(0., 1., (ncols, nlev))}
+
+    def test_distances(self):
+        a, b = self.features(4, 10), self.features(3, 10, seed=2)
+        d = spcluster.distances(a, b, self.tolerance)
+        for i in range(4):
+            for j in range(3):
+                expected = max(numpy.sqrt(numpy.mean((a[name][i] - b[name][j]) ** 2)) / self.tolerance[name]
+                               for name in spcluster.feature_names)
+                assert abs(d[i, j] - expected) < 1e-6
+
+    def test_clustering(self):
+        base = self.features(3, 10)
+        base["Tv"] += numpy.array([[0.], [10.], [20.]])  # three distinct clusters
+        columns = dict((name, numpy.repeat(values, 2, axis=0)) for name, values in base.iteritems())
+        columns["U"][1::2] += 0.1  # the second column of every pair is similar to the first
+        assert spcluster.select_representatives(columns, self.tolerance) == [0, 2, 4]
+        assert spcluster.select_representatives(columns, self.tolerance, max_num=2) == [0, 2]
+        representatives = dict((name, values[[0, 2]]) for name, values in columns.iteritems())
+        members = dict((name, values[[1, 3, 5]]) for name, values in columns.iteritems())
+        nearest, distances = spcluster.assign(members, representatives, self.tolerance)
+        assert list(nearest) == [0, 1, -1]
+        assert distances[0] < 1 and distances[2] > 1
+
+    def test_no_representatives(self):
+        members = self.features(2, 5)
+        nearest, distances = spcluster.assign(members, dict((name, v[:0]) for name, v in members.iteritems()),
+                                              self.tolerance)
+        assert list(nearest) == [-1, -1] and numpy.all(numpy.isinf(distances))
@@ -14,3 +14,28 @@ class Testspcpl(object):
         A = spcpl.get_cloud_fraction(les)
         assert abs(A[0] - (0.5 + 0.2*numpy.cos(6.*(1. - les.k)/les.k))) < self.tolerance
         assert abs(A[-1] - (0.5 + 0.2)) < self.tolerance
+
+
+    def test_output_column_conversion_batch(self):
+        ncols, nlev = 3, 10
+        Ph = numpy.array([numpy.linspace(1000., 100000. + 500. * i, nlev + 1) for i in range(ncols)])
+        profiles = {"T": numpy.array([numpy.linspace(220., 300. + i, nlev) for i in range(ncols)]),
+                    "SH": numpy.full((ncols, nlev), 0.01), "QL": numpy.full((ncols, nlev), 1.e-4),
+                    "QI": numpy.full((ncols, nlev), 1.e-5), "Ph": Ph, "Pf": 0.5 * (Ph[:, 1:] + Ph[:, :-1])}
+        batch = dict((k, v.copy()) for k, v in profiles.iteritems())
+        spcpl.output_column_conversion(batch)
+        for i in range(ncols):
+            column = dict((k, v[i].copy()) for k, v in profiles.iteritems())
+            spcpl.output_column_conversion(column)
+            for k in ["Tv", "Zh", "Psurf", "Ph", "THL", "QT"]:
+                assert numpy.allclose(batch[k][i], column[k], rtol=self.tolerance)
+
+    def test_coupling_precision(self):
+        values = numpy.linspace(0., 1., 10)
+        spcpl.set_precision("float32")
+        try:
+            assert spcpl.to_coupling_precision("QT", values).dtype == numpy.float32
+            assert spcpl.to_coupling_precision("THL", values).dtype == numpy.float64
+        finally:
+            spcpl.set_precision("float64")
+        assert spcpl.to_coupling_precision("QT", values) is values
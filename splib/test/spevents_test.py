@@ -0,0 +1,70 @@
+import pytest
+from splib import spevents
+
+
+# Completed request with a given result, or raising the given exception
+class fake_request(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value
+
+
+# Request pool completing the requests in the order they were issued
+class fake_pool(object):
+
+    def __init__(self):
+        self.requests = []
+        self.max_len = 0
+
+    def add_request(self, request, callback, args=()):
+        self.requests.append((request, callback, args))
+        self.max_len = max(self.max_len, len(self.requests))
+
+    def wait(self):
+        request, callback, args = self.requests.pop(0)
+        callback(request, *args)
+
+    def __len__(self):
+        return len(self.requests)
+
+
+class Testspevents(object):
+
+    @staticmethod
+    def chain(name, steps, log, fail_at=None):
+        def start():
+            value = ValueError("step %d" % steps) if steps == fail_at else steps
+            return fake_request(value)
+
+        def done(result):
+            log.append((name, result))
+            return Testspevents.chain(name, steps + 1, log, fail_at) if steps < 3 else None
+
+        return spevents.task(name, start, done)
+
+    def test_chains(self):
+        pool, log = fake_pool(), []
+        events = spevents.orchestrator(max_pending=2, pool=pool)
+        for name in "abc":
+            events.submit(self.chain(name, 1, log))
+        events.run()
+        assert pool.max_len == 2
+        assert sorted(log) == [(name, i) for name in "abc" for i in range(1, 4)]
+        # chains a and b run to completion before c starts
+        assert log.index(("c", 1)) > log.index(("a", 3))
+
+    def test_failure_cancels(self):
+        pool, log = fake_pool(), []
+        events = spevents.orchestrator(max_pending=1, pool=pool)
+        events.submit(self.chain("a", 1, log, fail_at=2))
+        events.submit(self.chain("b", 1, log))
+        with pytest.raises(spevents.task_error) as e:
+            events.run()
+        assert e.value.name == "a"
+        assert e.value.num_cancelled == 1
+        assert log == [("a", 1)]
@@ -0,0 +1,30 @@
+import numpy
+
+from splib import sphealth
+
+
+class Testsphealth(object):
+
+    def test_check_columns(self):
+        ncols, nlev = 5, 10
+        profiles = {"thl": numpy.full((ncols, nlev), 300.), "qt": numpy.full((ncols, nlev), 0.01)}
+        tendencies = {"T": numpy.full((ncols, nlev), 1e-4), "SH": numpy.full((ncols, nlev), 1e-8)}
+        assert sphealth.check_columns(profiles, tendencies, outlier_factor=20) == {}
+        profiles["thl"][1, 3] = numpy.nan
+        profiles["qt"][2, 0] = 0.5
+        tendencies["T"][4, 7] = 0.1
+        failing = sphealth.check_columns(profiles, tendencies, outlier_factor=20)
+        assert sorted(failing.keys()) == [1, 2, 4]
+        assert failing[1] == ["thl not finite"]
+        assert failing[2][0].startswith("qt out of bounds")
+        assert failing[4][0].startswith("f_T magnitude outlier")
+        assert 4 not in sphealth.check_columns(profiles, tendencies, outlier_factor=0)
+
+    def test_outlier_floor(self):
+        tendencies = {"T": numpy.array([[0.], [0.], [1e-4]])}
+        assert sphealth.check_columns({}, tendencies, outlier_factor=20) == {}
+
+    def test_stack(self):
+        assert sphealth.stack([numpy.zeros(3), numpy.ones(3)]).shape == (2, 3)
+        assert sphealth.stack([numpy.zeros(3), None]) is None
+        assert sphealth.stack([numpy.zeros(3), numpy.ones(4)]) is None
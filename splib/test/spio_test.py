@@ -0,0 +1,82 @@
+import os
+import tempfile
+
+import netCDF4
+import numpy
+from amuse.units import units
+from splib import spio
+
+
+class Testspio(object):
+
+    @staticmethod
+    def open_output(streams):
+        nc_name = os.path.join(tempfile.mkdtemp(), "spifs.nc")
+        spio.init_streams(streams)
+        spio.cdf_root = netCDF4.Dataset(nc_name, "w")
+        spio.cdf_root.createDimension("Time", None)
+        spio.cdf_root.createDimension("zf", 3)
+        spio.cdf_root.createVariable("Time", "f4", ("Time",)).units = "s"
+        spio.open_streams(nc_name)
+        grp = spio.cdf_root.createGroup("1")
+        for name in ["thl", "qt", "ql"]:
+            spio.create_time_variable(grp, name, ("zf",), "1")
+        spio.cdf_step = -1
+        spio.cdf_resumed = False
+        return nc_name, grp
+
+    @staticmethod
+    def run_steps(grp, nsteps):
+        for i in range(nsteps):
+            spio.update_time(i * 900 | units.s)
+            for name in ["thl", "qt", "ql"]:
+                spio.write_variable(grp, name, numpy.full(3, float(i)), spio.cdf_step)
+        spio.update_time(nsteps * 900 | units.s)
+        spio.close_streams()
+        spio.cdf_root.close()
+        spio.cdf_root = None
+
+    def test_streams(self):
+        nc_name, grp = self.open_output({"mean": {"vars": ["thl"], "every": 4, "reduce": "mean"},
+                                         "sample": {"vars": ["qt"], "every": 4, "file": "sample.nc"}})
+        self.run_steps(grp, 10)
+        with netCDF4.Dataset(nc_name) as d:
+            assert d["1"]["ql"].shape == (11, 3)
+            assert list(d["Time_mean"][:]) == [0., 3600., 7200.]
+            assert list(d["1"]["thl"][:, 0]) == [1.5, 5.5, 8.5]
+            assert "qt" not in d["1"].variables
+        with netCDF4.Dataset(os.path.join(os.path.dirname(nc_name), "sample.nc")) as d:
+            assert list(d["1"]["qt"][:, 0]) == [0., 4., 8.]
+            assert d["Time"].reduction == "sample"
+
+    def test_variance(self):
+        nc_name, grp = self.open_output({"var": {"vars": ["thl"], "every": 5, "reduce": "var"}})
+        self.run_steps(grp, 5)
+        with netCDF4.Dataset(nc_name) as d:
+            assert abs(d["1"]["thl"][0, 0] - numpy.var(numpy.arange(5.))) < 1.e-6
+
+    def test_output_columns(self, caplog):
+        nc_name, grp = self.open_output({})
+        spio.update_time(0 | units.s)
+        spio.output_column_group = spio.cdf_root.createGroup("columns")
+        spio.output_column_group.createDimension("column", 3)
+        spio.create_time_variable(spio.output_column_group, "thl", ("column", "zf"), "K")
+        data = {"thl": numpy.ones((3, 3)), "qt": numpy.ones((3, 3))}
+        try:
+            spio.write_output_columns([5, 7, 9], data, background=True)
+            spio.wait_output_columns()
+            assert numpy.all(spio.output_column_group["thl"][0] == 1.)
+            assert "uninitialized variable qt" in caplog.text
+
+            spio.output_column_group = None
+            spio.output_column_cdf = dict((i, spio.cdf_root.createGroup(str(i))) for i in [5, 7, 9])
+            for i in [5, 9]:
+                spio.create_time_variable(spio.output_column_cdf[i], "qt", ("zf",), "1")
+            caplog.clear()
+            spio.write_output_columns([5, 7, 9], data)
+            assert spio.output_column_cdf[9]["qt"][0, 0] == 1.
+            assert "output column 7 to uninitialized variable qt" in caplog.text
+        finally:
+            spio.output_column_group, spio.output_column_cdf = None, {}
+            spio.cdf_root.close()
+            spio.cdf_root = None
@@ -0,0 +1,98 @@
+import cPickle
+import os
+import tempfile
+import threading
+from Queue import Queue
+
+import netCDF4
+import numpy
+import pytest
+from amuse.units import units
+from splib import spio
+from splib import spiorank
+
+
+# In-process stand-in for the MPI communicator between the master and an I/O rank
+class loopback_comm(object):
+
+    class request(object):
+        def wait(self):
+            pass
+
+    def __init__(self):
+        self.queues = {spiorank.request_tag: Queue(), spiorank.reply_tag: Queue(), spiorank.error_tag: Queue()}
+
+    def isend(self, msg, dest, tag):
+        self.send(msg, dest, tag)
+        return loopback_comm.request()
+
+    def send(self, msg, dest, tag):
+        self.queues[tag].put(cPickle.dumps(msg))
+
+    def recv(self, source, tag):
+        return cPickle.loads(self.queues[tag].get(timeout=10))
+
+    def iprobe(self, source, tag):
+        return not self.queues[tag].empty()
+
+
+class Testspiorank(object):
+
+    def test_remote_output(self):
+        comm = loopback_comm()
+        server = threading.Thread(target=spiorank.serve, args=(comm,))
+        server.start()
+        spio.io_clients = [spiorank.io_client(comm, 1)]
+        try:
+            nc_name = os.path.join(tempfile.mkdtemp(), "spifs.nc")
+            spio.init_streams({"mean": {"vars": ["thl"], "every": 2, "reduce": "mean", "file": "mean.nc"}})
+            spio.cdf_root = spio.open_dataset(nc_name, "w")
+            spio.cdf_root.createDimension("Time", None)
+            spio.cdf_root.createDimension("zf", 3)
+            spio.cdf_root.createVariable("Time", "f4", ("Time",)).units = "s"
+            spio.open_streams(nc_name)
+            grp = spio.cdf_root.createGroup("1")
+            for name in ["thl", "qt"]:
+                spio.create_time_variable(grp, name, ("zf",), "1")
+            spio.cdf_step = -1
+            spio.cdf_resumed = False
+            for i in range(4):
+                spio.update_time(i * 900 | units.s)
+                for name in ["thl", "qt"]:
+                    spio.write_variable(grp, name, numpy.full(3, float(i)), spio.cdf_step)
+            assert spio.cdf_root.variables["Time"].shape == (4,)
+            spio.update_time(3600 | units.s)
+            spio.close_streams()
+            spio.cdf_root.close()
+            spio.cdf_root = None
+        finally:
+            spio.stop_io_ranks()
+            server.join()
+        with netCDF4.Dataset(nc_name) as d:
+            assert list(d["1"]["qt"][:4, 0]) == [0., 1., 2., 3.]
+            assert d["1"]["qt"].units == "1"
+        with netCDF4.Dataset(os.path.join(os.path.dirname(nc_name), "mean.nc")) as d:
+            assert list(d["1"]["thl"][:, 0]) == [0.5, 2.5]
+
+    def test_append_and_errors(self):
+        nc_name = os.path.join(tempfile.mkdtemp(), "spifs.nc")
+        with netCDF4.Dataset(nc_name, "w") as d:
+            d.createDimension("Time", None)
+            d.createVariable("Time", "f4", ("Time",)).units = "s"
+        comm = loopback_comm()
+        server = threading.Thread(target=spiorank.serve, args=(comm,))
+        server.start()
+        client = spiorank.io_client(comm, 1)
+        try:
+            root = client.open_dataset(nc_name, "a")
+            assert root.variables["Time"].units == "s"
+            root.variables["Time"][0] = 0.
+            root.createVariable("x", "f4", ("nodim",))
+            # the failure is reported with the next reply of the I/O rank
+            with pytest.raises(Exception) as e:
+                root.variables["Time"].shape
+            assert "variable" in str(e.value)
+            root.close()
+        finally:
+            client.stop()
+            server.join()
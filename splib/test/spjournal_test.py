@@ -0,0 +1,52 @@
+import os
+import tempfile
+
+import netCDF4
+import numpy
+from splib import spjournal
+
+
+class Testspjournal(object):
+
+    @staticmethod
+    def write_journal(nc_name, nsteps):
+        root = spjournal.open_journal(nc_name, "w")
+        root.createDimension("Time", None)
+        root.createDimension("zf", 3)
+        root.createVariable("Time", "f4", ("Time",)).units = "s"
+        grp = root.createGroup("7")
+        grp.createVariable("thl", "f4", ("Time", "zf")).units = "K"
+        grp.createVariable("lat", "f4")[:] = 12.5
+        for i in range(nsteps):
+            root.variables["Time"][i] = 60. * i
+            grp.variables["thl"][i] = numpy.arange(3.) + i
+        return root
+
+    def test_convert(self):
+        nc_name = os.path.join(tempfile.mkdtemp(), "spifs.nc")
+        root = self.write_journal(nc_name, 5)
+        assert root.variables["Time"].shape == (5,)
+        assert root["7"]["thl"][4, 2] == 6.
+        root.close()
+        assert spjournal.convert(nc_name) == 5
+        with netCDF4.Dataset(nc_name) as d:
+            assert list(d["Time"][:]) == [0., 60., 120., 180., 240.]
+            assert d["7"]["thl"].units == "K"
+            assert numpy.allclose(d["7"]["thl"][:, 1], numpy.arange(5.) + 1)
+            assert d["7"]["lat"][...] == 12.5
+
+    def test_partial_record_dropped(self):
+        nc_name = os.path.join(tempfile.mkdtemp(), "spifs.nc")
+        root = self.write_journal(nc_name, 3)
+        root.sync()  # two records complete, the third one is still being filled
+        journal_name, layout_name = spjournal.journal_files(nc_name)
+        assert spjournal.count_records(journal_name, root.record_size) == 2
+        # continue after a crash
+        root = spjournal.open_journal(nc_name, "a")
+        assert root.variables["Time"].shape == (2,)
+        root.variables["Time"][2] = 600.
+        root.close()
+        assert spjournal.convert(nc_name) == 3
+        with netCDF4.Dataset(nc_name) as d:
+            assert list(d["Time"][:]) == [0., 60., 600.]
+            assert d["7"]["thl"][2].mask.all()
@@ -1,11 +1,34 @@
+import copy
 import numpy
+import pytest
 import os
+import threading
+import time
+import tempfile
 import shapely.geometry
 import netCDF4
 from amuse.community import units
 from splib import splib
 from splib import spdummy
 
+# Returns the configuration and state variables of a module, e.g. the settings read by splib.read_config
+def module_state(module):
+    return dict((name, copy.copy(value)) for name, value in vars(module).iteritems()
+                if not name.startswith("__") and isinstance(value, (bool, int, long, float, str, list, dict, tuple,
+                                                                    type(None))))
+
+
+# Restores the module variables of splib and its coupling state after every test, so that the configuration of a
+# test does not leak into the next one
+@pytest.fixture(autouse=True)
+def restore_splib():
+    modules = [splib, splib.spfailover, splib.spskip]
+    saved = [(module, module_state(module)) for module in modules]
+    yield
+    for module, state in saved:
+        vars(module).update(state)
+
+
 class Testsplib(object):
 
     def test_lwp_after_run(self):
@@ -19,3 +42,340 @@ class Testsplib(object):
         for group in output.groups:
             print output.variables.keys(),output[str(group) + "/lwp"].shape
             assert output[str(group) + "/lwp"].shape[0] == steps * splib.gcm_model.get_timestep().value_in(units.s) / lesdt
+
+    def test_async_coupling(self):
+        steps = 3
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 200, "init_les_state": False,
+                  "async_coupling": True, "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0)])
+        splib.run(steps)
+        splib.finalize()
+        output = netCDF4.Dataset(os.path.join(splib.output_dir, splib.output_name), 'r')
+        assert output.coupling_lag == 1
+        for les in splib.les_models:
+            assert les.get_model_time() == steps * splib.gcm_model.get_timestep()
+
+    def test_concurrent_errors(self, monkeypatch):
+        monkeypatch.setattr(splib, "event_driven", False)
+        monkeypatch.setattr(splib, "channel_type", "sockets")
+
+        def les_fail(*args):
+            raise Exception("les driver failed")
+
+        monkeypatch.setattr(splib, "step_les_models", les_fail)
+        with pytest.raises(Exception) as e:
+            splib.step_les_models_concurrent(None, None, lambda: None)
+        assert "les driver failed" in str(e.value)
+
+        done = []
+
+        def les_slow(*args):
+            time.sleep(0.2)
+            done.append(True)
+            return [0.2]
+
+        def gcm_fail():
+            raise Exception("gcm failed")
+
+        monkeypatch.setattr(splib, "step_les_models", les_slow)
+        with pytest.raises(Exception) as e:
+            splib.step_les_models_concurrent(None, None, gcm_fail)
+        assert "gcm failed" in str(e.value) and done == [True]
+
+    def test_count_child_processes(self):
+        import psutil
+
+        class Child(object):
+            def __init__(self, status):
+                self.child_status = status
+
+            def status(self):
+                if self.child_status is None:
+                    raise psutil.NoSuchProcess(1)
+                return self.child_status
+
+        class Process(object):
+            def children(self, recursive=False):
+                return [Child(psutil.STATUS_RUNNING), Child(None), Child(psutil.STATUS_ZOMBIE)]
+
+        assert splib.count_child_processes(Process()) == 1
+
+    def test_pipelined_coupling(self):
+        steps = 3
+        tendencies = []
+        for pipelined in [False, True]:
+            config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 200, "init_les_state": False,
+                      "pipelined_coupling": pipelined, "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+            splib.initialize(config, [shapely.geometry.Point(50.0, 2.0)])
+            splib.run(steps)
+            splib.finalize()
+            with netCDF4.Dataset(os.path.join(splib.output_dir, splib.output_name), 'r') as output:
+                tendencies.append([output[group]["f_T"][...] for group in output.groups])
+        for f, f_pipelined in zip(*tendencies):
+            assert numpy.allclose(f, f_pipelined)
+
+    def test_les_nodes(self):
+        steps = 2
+        points = [shapely.geometry.Point(50.0, 2.0), shapely.geometry.Point(20.0, 30.0)]
+        tendencies = []
+        for nodes in [0, 2]:
+            config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 200, "init_les_state": False,
+                      "les_nodes": nodes, "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+            splib.initialize(config, points)
+            assert len(splib.les_models) == 2
+            splib.run(steps)
+            splib.finalize()
+            with netCDF4.Dataset(os.path.join(splib.output_dir, splib.output_name), 'r') as output:
+                tendencies.append([output[group]["f_T"][...] for group in sorted(output.groups)])
+        for f, f_nodes in zip(*tendencies):
+            assert numpy.allclose(f, f_nodes)
+
+    def test_les_stage_dir(self):
+        stagedir = os.path.join(tempfile.mkdtemp(), "les-input")
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 200, "init_les_state": False,
+                  "les_stage_dir": stagedir, "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        with pytest.raises(Exception):
+            splib.initialize(config, [shapely.geometry.Point(50.0, 2.0)])
+        config["les_nodes"] = 1
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0)])
+        splib.finalize()
+        assert sorted(os.listdir(stagedir)) == sorted(os.listdir(splib.les_input_dir))
+
+    def test_late_les_reuse(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 900, "init_les_state": False,
+                  "les_step_deadline": 0.5, "les_deadline_policy": "reuse",
+                  "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0), shapely.geometry.Point(20.0, 30.0)])
+        slow = splib.les_models[1]
+        released = threading.Event()
+        evolve = slow.evolve_model
+
+        def slow_evolve(stop_time, exactEnd):
+            released.wait(10)
+            evolve(stop_time, exactEnd)
+
+        slow.evolve_model = slow_evolve
+        try:
+            splib.run(1)
+            assert splib.les_models == [splib.les_models[0]] and splib.late_les == [slow]
+            released.set()
+            time.sleep(0.2)
+            splib.run(1)
+            assert len(splib.les_models) == 2 and splib.les_models[1] is slow and splib.late_les == []
+        finally:
+            released.set()
+            splib.finalize()
+
+    def test_late_les_drop_queued(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 900, "init_les_state": False,
+                  "les_step_deadline": 0.3, "les_deadline_policy": "drop", "les_queue_threads": 2, "max_num_les": 3,
+                  "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0)])  # the 3 nearest columns
+        slow = splib.les_models[0]
+        evolve = slow.evolve_model
+
+        def slow_evolve(stop_time, exactEnd):
+            time.sleep(1.)
+            evolve(stop_time, exactEnd)
+
+        slow.evolve_model = slow_evolve
+        try:
+            assert len(splib.les_models) == 3
+            splib.run(1)
+            assert slow not in splib.les_models and splib.dropped_les == [slow] and splib.late_les == []
+            assert slow.grid_index not in splib.gcm_model.mask
+        finally:
+            splib.finalize()
+
+    def test_deadline_unsupported(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_call_deadline": 10, "les_queue_threads": 1,
+                  "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        with pytest.raises(Exception):
+            splib.initialize(config, [shapely.geometry.Point(50.0, 2.0)])
+
+    def test_les_failover(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 900, "init_les_state": False,
+                  "les_failover": True, "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0), shapely.geometry.Point(20.0, 30.0)])
+        crashed = splib.les_models[1]
+
+        def crash(stop_time, exactEnd):
+            raise Exception("worker crashed")
+
+        crashed.evolve_model = crash
+        try:
+            splib.run(1)
+            replacement = splib.les_models[1]
+            assert replacement is not crashed and replacement.grid_index == crashed.grid_index
+            assert replacement.get_model_time() == splib.gcm_model.get_model_time()
+            splib.run(1)
+            assert splib.les_models[1] is replacement
+            assert replacement.get_model_time() >= splib.gcm_model.get_model_time()
+            with open(os.path.join(splib.output_dir, "failover.txt")) as f:
+                lines = f.readlines()
+            assert len(lines) == 1 and "reinit" in lines[0] and "worker crashed" in lines[0]
+        finally:
+            splib.finalize()
+
+    def test_les_failover_restart(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 600, "init_les_state": False,
+                  "les_failover": True, "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0), shapely.geometry.Point(20.0, 30.0)])
+        crashed = splib.les_models[1]
+        crashed.workdir = tempfile.mkdtemp()
+        open(os.path.join(crashed.workdir, "initd00h00m000.001"), "w").close()
+
+        def crash(stop_time, exactEnd):
+            raise Exception("worker crashed")
+
+        crashed.evolve_model = crash
+        try:
+            splib.run(1)
+            # the restarted les starts at time zero, one step behind, and catches up during the failover
+            replacement = splib.les_models[1]
+            assert replacement is not crashed
+            assert replacement.get_model_time() == splib.gcm_model.get_model_time()
+            with open(os.path.join(splib.output_dir, "failover.txt")) as f:
+                assert "restart" in f.read()
+        finally:
+            splib.finalize()
+
+    def test_les_failover_old_restart(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 600, "init_les_state": False,
+                  "les_failover": True, "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0), shapely.geometry.Point(20.0, 30.0)])
+        crashed = splib.les_models[1]
+        crashed.workdir = tempfile.mkdtemp()
+        open(os.path.join(crashed.workdir, "initd00h00m000.001"), "w").close()
+        try:
+            splib.run(1)
+
+            def crash(stop_time, exactEnd):
+                raise Exception("worker crashed")
+
+            crashed.evolve_model = crash
+            splib.run(1)
+            # the restarted les would start at time zero, two steps behind
+            replacement = splib.les_models[1]
+            assert replacement.get_model_time() == splib.gcm_model.get_model_time()
+            with open(os.path.join(splib.output_dir, "failover.txt")) as f:
+                assert "reinit" in f.read()
+        finally:
+            splib.finalize()
+
+    def test_health_quarantine(self, monkeypatch):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 900, "init_les_state": False,
+                  "health_checks": True, "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0), shapely.geometry.Point(20.0, 30.0)])
+        monkeypatch.setattr(splib.sphealth, "bounds", {"thl": (150., 500.)})  # the dummy humidity is unphysical
+        diverged = splib.les_models[1]
+        diverged.get_profile_THL = lambda: numpy.full(diverged.k, numpy.nan) | units.K
+        try:
+            splib.run(1)
+            assert diverged not in splib.les_models and len(splib.les_models) == 1
+            with open(os.path.join(splib.output_dir, "health.txt")) as f:
+                lines = f.readlines()
+            assert len(lines) == 1 and "thl not finite" in lines[0]
+        finally:
+            splib.finalize()
+
+    def test_health_reset_escalation(self, monkeypatch):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 600, "init_les_state": False,
+                  "health_checks": True, "health_reset": True, "health_max_resets": 1,
+                  "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0), shapely.geometry.Point(20.0, 30.0)])
+        monkeypatch.setattr(splib.sphealth, "bounds", {"thl": (150., 500.)})
+        diverged = splib.les_models[1]
+        diverged.get_profile_THL = lambda: numpy.full(diverged.k, numpy.nan) | units.K
+        try:
+            splib.run(1)
+            assert diverged in splib.les_models and diverged.health_resets == 1
+            splib.run(1)
+            assert diverged not in splib.les_models
+            with open(os.path.join(splib.output_dir, "health.txt")) as f:
+                actions = [line.split()[3] for line in f]
+            assert actions == ["reset", "unmasked"]
+        finally:
+            splib.finalize()
+
+    def test_dynamic_mask(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 600, "init_les_state": False,
+                  "dynamic_mask": True, "dynamic_mask_thresholds": {"A": 1.298}, "dynamic_mask_quiet_steps": 2,
+                  "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0), shapely.geometry.Point(20.0, 30.0)])
+        try:
+            # the maximal cloud fractions of the dummy gcm columns are 1.2967 and 1.3
+            assert len(splib.les_models) == 1 and len(splib.suspended_les) == 1
+            quiet = splib.suspended_les[0]
+            assert quiet.grid_index not in splib.gcm_model.mask
+            splib.run(1)
+            splib.dynamic_mask_thresholds = {"A": 1.}
+            splib.run(1)
+            assert len(splib.les_models) == 2 and splib.suspended_les == []
+            assert quiet.grid_index in splib.gcm_model.mask
+            assert splib.les_models[1].get_model_time() == splib.les_models[0].get_model_time()
+            splib.dynamic_mask_thresholds = {"A": 2.}
+            splib.run(2)
+            assert splib.les_models == [] and len(splib.suspended_les) == 2 and len(splib.gcm_model.mask) == 0
+        finally:
+            splib.finalize()
+
+    def test_coupling_interval(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 600, "init_les_state": False,
+                  "coupling_interval": 3, "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0), shapely.geometry.Point(20.0, 30.0)])
+        try:
+            les = splib.les_models[0]
+            for step in range(4):
+                splib.run(1)
+                # the les evolve over the coupling interval in its first step
+                ahead = [1200, 600, 0][step % 3]
+                assert les.get_model_time() == splib.gcm_model.get_model_time() + (ahead | units.s)
+            assert les.gcm_tendencies is not None
+        finally:
+            splib.finalize()
+
+    def test_coupling_interval_checkpoints(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "coupling_interval": 3, "checkpoint_interval": 4,
+                  "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        with pytest.raises(Exception):
+            splib.initialize(config, [shapely.geometry.Point(50.0, 2.0)])
+
+    def test_incremental_coupling(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 600, "init_les_state": False,
+                  "incremental_coupling": True, "incremental_refresh": 3,
+                  "incremental_tolerance": dict((name, 1e6) for name in ["U", "V", "T", "SH", "u", "v", "thl", "qt"]),
+                  "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.Point(50.0, 2.0), shapely.geometry.Point(20.0, 30.0)])
+        try:
+            # exchanges in the first two steps to compare the les profiles, then two skips before a forced refresh
+            splib.run(5)
+            assert splib.spskip.num_skipped == 2 * len(splib.les_models)
+            assert splib.spskip.num_exchanges == 3 * len(splib.les_models)
+            assert all(les.get_model_time() == splib.gcm_model.get_model_time() for les in splib.les_models)
+        finally:
+            splib.finalize()
+        skips = numpy.loadtxt(os.path.join(splib.output_dir, "skip.txt"), ndmin=2)
+        assert list(skips[:, 3]) == [0, 0, 2, 2, 0]
+
+    def test_les_clustering(self):
+        config = {"gcm_type": "dummy", "les_type": "dummy", "les_dt": 600, "init_les_state": False,
+                  "les_clustering": True, "les_cluster_tolerance": {"Tv": 1e3, "QT": 1e3, "U": 1e3, "V": 1e3},
+                  "output_dir": tempfile.mkdtemp(), "output_name": "spifs.nc"}
+        splib.initialize(config, [shapely.geometry.box(40., -10., 70., 10.)])
+        try:
+            assert len(splib.les_models) == 1 and len(splib.cluster_members) > 0
+            representative = splib.les_models[0]
+            splib.run(2)
+            members = [c[0] for c in splib.cluster_members]
+            assert sorted(splib.cluster_assignment.keys()) == sorted(members)
+            assert set(members + [representative.grid_index]) <= splib.gcm_model.mask
+            # members of a stopped representative are handed back to the gcm
+            splib.quarantine_les(representative, ["test"])
+            splib.update_clusters()
+            assert splib.cluster_assignment == {} and not set(members) & splib.gcm_model.mask
+        finally:
+            splib.finalize()
+        with netCDF4.Dataset(os.path.join(splib.output_dir, splib.output_name)) as ds:
+            assignments = ds.groups["clusters"].variables["representative"][:]
+            assert numpy.all(assignments[1] == representative.grid_index)
@@ -0,0 +1,37 @@
+import numpy
+import pytest
+
+from splib import spmask
+
+
+class Testspmask(object):
+
+    @staticmethod
+    def columns(ncols, nlev):
+        Ph = numpy.array([numpy.linspace(1000., 100000., nlev + 1)] * ncols)
+        return {"T": numpy.array([numpy.linspace(220., 290., nlev)] * ncols),
+                "SH": numpy.array([numpy.linspace(1e-5, 0.008, nlev)] * ncols),
+                "QL": numpy.zeros((ncols, nlev)), "QI": numpy.zeros((ncols, nlev)), "A": numpy.zeros((ncols, nlev)),
+                "Phalf": Ph, "Pfull": 0.5 * (Ph[:, 1:] + Ph[:, :-1])}
+
+    def test_indicators(self):
+        profiles = self.columns(3, 20)
+        profiles["A"][1, 10] = 0.4
+        profiles["QL"][1, 10] = 1e-4
+        profiles["SH"][2, -1] = 0.02  # moist surface layer, potentially unstable
+        indicators = spmask.column_indicators(profiles)
+        assert numpy.allclose(indicators["A"], [0., 0.4, 0.])
+        assert numpy.allclose(indicators["QL"], [0., 1e-4, 0.])
+        assert indicators["instability"][2] > 10 and indicators["instability"][2] > indicators["instability"][0]
+        assert list(spmask.active_columns(indicators, {"A": 0.05})) == [False, True, False]
+        assert list(spmask.active_columns(indicators, {"QL": 1e-5, "instability": 10})) == [False, True, True]
+
+    def test_unknown_indicator(self):
+        indicators = spmask.column_indicators(self.columns(2, 5))
+        with pytest.raises(Exception):
+            spmask.active_columns(indicators, {"CAPE": 100})
+
+    def test_heights(self):
+        profiles = self.columns(1, 20)
+        Zf = spmask.full_level_heights(*(profiles[name] for name in ["T", "SH", "QL", "QI", "Pfull", "Phalf"]))
+        assert numpy.all(numpy.diff(Zf[0]) < 0) and 0 < Zf[0, -1] < 500
@@ -0,0 +1,27 @@
+import os
+import tempfile
+
+from splib import spmetrics
+
+
+class Testspmetrics(object):
+
+    def test_status_file(self):
+        file_name = os.path.join(tempfile.mkdtemp(), "metrics.txt")
+        spmetrics.start(file_name=file_name)
+        spmetrics.register_les([3, 7])
+        for i in range(3):
+            spmetrics.record_les(3, 1.5)
+            spmetrics.record_step([("gcm", 0.3), ("les", 4. * i)])
+        spmetrics.publish(master_rss_bytes=1.e9, output_queue_depth=2)
+        spmetrics.stop()
+        assert not spmetrics.enabled()
+        with open(file_name) as f:
+            page = f.read().splitlines()
+        assert "spifs_steps_total 3.0" in page
+        assert 'spifs_phase_seconds_bucket{phase="les",le="5.0"} 2' in page
+        assert 'spifs_phase_seconds_bucket{phase="les",le="+Inf"} 3' in page
+        assert 'spifs_phase_seconds_sum{phase="gcm"} ' + repr(0.3 * 3) in page
+        assert 'spifs_les_evolve_seconds{les="3"} 1.5' in page
+        assert any(line.startswith('spifs_les_last_seen_seconds{les="7"}') for line in page)
+        assert "spifs_output_queue_depth 2.0" in page
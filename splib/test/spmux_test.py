@@ -0,0 +1,62 @@
+import os
+import tempfile
+from amuse.community import units
+from splib import spmux
+from splib import spdummy
+
+
+class Testspmux(object):
+
+    @staticmethod
+    def dummy_worker():
+        les = spdummy.dummy_les(1)
+        les.commit_grid()
+        return les
+
+    def test_column_times(self):
+        mux = spmux.les_multiplexer(self.dummy_worker())
+        columns = [mux.add_column() for i in range(3)]
+        for c in columns:
+            c.evolve_model(600 | units.s, exactEnd=True)
+        for c in columns:
+            assert c.get_model_time() == 600 | units.s
+        assert mux.worker.get_model_time() == 1800 | units.s
+
+    def test_settings_replayed(self):
+        mux = spmux.les_multiplexer(self.dummy_worker())
+        a, b = mux.add_column(), mux.add_column()
+        a.set_tendency_U([1.])
+        assert a.settings["set_tendency_U"] == (([1.],), {})
+        assert mux.active is None
+        b.get_profile_U()
+        assert mux.active is b
+        a.evolve_model(60 | units.s)
+        assert mux.active is a
+
+    def test_stop_single_column(self):
+        mux = spmux.les_multiplexer(self.dummy_worker())
+        a, b = mux.add_column(), mux.add_column()
+        a.evolve_model(60 | units.s)
+        a.cleanup_code()
+        a.stop()
+        assert not mux.stopped and mux.columns == [b] and mux.active is None
+        b.evolve_model(60 | units.s)
+        assert b.get_model_time() == 60 | units.s
+        b.cleanup_code()
+        b.stop()
+        assert mux.stopped
+
+    def test_optional_fields(self):
+        mux = spmux.les_multiplexer(self.dummy_worker())
+        fields = {"E12": [1.]}
+        mux.worker.get_field = lambda name: fields.get(name, [0.])
+        swapped = []
+        mux.worker.set_field = lambda name, values: swapped.append(name) if name != "NR" else 1 / 0
+        assert mux.swapped_fields() == spmux.state_fields + ["E12", "QR"]
+
+    def test_check_setup(self):
+        inputdir = tempfile.mkdtemp()
+        with open(os.path.join(inputdir, "namoptions.001"), "w") as f:
+            f.write("&PHYSICS\nisurf      =  4\niradiation =  4\nltimedep = .true.\n/\n")
+        assert spmux.check_setup(inputdir) == ["iradiation = 4", "ltimedep = .true."]
+        assert spmux.check_setup(os.path.join(os.path.dirname(__file__), "../../dales-input")) == []
@@ -0,0 +1,37 @@
+from splib import spsched
+
+
+class Testspsched(object):
+
+    def test_budget_admission(self):
+        budget = spsched.core_budget(4)
+        assert budget.try_acquire(2)
+        assert budget.try_acquire(2)
+        assert not budget.try_acquire(1)
+        budget.release(2)
+        assert budget.try_acquire(1)
+        assert budget.available() == 1
+
+    def test_wide_code_admitted_alone(self):
+        budget = spsched.core_budget(2)
+        assert budget.try_acquire(3)
+        assert not budget.try_acquire(1)
+        budget.release(3)
+        assert budget.available() == 2
+
+    def test_reserve(self):
+        budget = spsched.core_budget(4)
+        budget.reserve(3)
+        assert budget.try_acquire(1)
+        assert not budget.try_acquire(1)
+        budget.unreserve(3)
+        assert budget.try_acquire(3)
+
+    def test_wide_code_waits_for_reserved(self):
+        budget = spsched.core_budget(4)
+        budget.reserve(3)
+        assert not budget.try_acquire(4)
+        assert budget.available() == 1
+        budget.unreserve(3)
+        budget.wait_fits(4)
+        assert budget.try_acquire(4)
@@ -0,0 +1,51 @@
+import numpy
+
+from splib import spskip
+
+
+class Column(object):
+    pass
+
+
+class Testspskip(object):
+    tolerance = {"U": 0.1, "V": 0.1, "T": 0.05, "SH": 1e-5, "u": 0.1, "v": 0.1, "thl": 0.05, "qt": 1e-5}
+
+    @staticmethod
+    def column(nlev, t=280.):
+        les = Column()
+        les.U, les.V, les.T, les.SH = numpy.ones(nlev), numpy.zeros(nlev), numpy.full(nlev, t), numpy.full(nlev, 1e-3)
+        les.les_profiles = {"u": numpy.ones(nlev), "v": numpy.zeros(nlev), "thl": numpy.full(nlev, 300.),
+                            "qt": numpy.full(nlev, 1e-3), "ql": numpy.zeros(nlev)}
+        return les
+
+    def test_relative_change(self):
+        new = {"T": numpy.array([280., 281.]), "SH": numpy.array([1e-3, 1e-3])}
+        old = {"T": numpy.array([280., 280.]), "SH": numpy.array([1e-3, 1.02e-3])}
+        assert numpy.isclose(spskip.relative_change(new, old, ["T", "SH"], self.tolerance), 20.)
+        assert numpy.isclose(spskip.relative_change(new, old, ["SH"], self.tolerance), 2.)
+        assert spskip.relative_change(new, None, ["T"], self.tolerance) == numpy.inf
+
+    def test_skips(self):
+        quiet, active = self.column(5), self.column(5)
+        for step in range(2):
+            assert spskip.update_skips([quiet, active], self.tolerance, 3) == 0
+            for les in [quiet, active]:
+                spskip.exchanged(les, self.tolerance)
+        active.T = active.T + 1.
+        assert spskip.update_skips([quiet, active], self.tolerance, 3) == 1
+        assert spskip.skipping(quiet) and not spskip.skipping(active)
+        assert spskip.update_skips([quiet], self.tolerance, 3) == 1
+        # the exchange is forced every 3 steps
+        assert spskip.update_skips([quiet], self.tolerance, 3) == 0
+        spskip.exchanged(quiet, self.tolerance)
+        assert spskip.update_skips([quiet], self.tolerance, 3) == 1
+        spskip.invalidate(quiet)
+        assert spskip.update_skips([quiet], self.tolerance, 3) == 0
+
+    def test_les_change(self):
+        les = self.column(5)
+        spskip.exchanged(les, self.tolerance)
+        les.les_profiles = dict(les.les_profiles, thl=les.les_profiles["thl"] + 0.5)
+        spskip.exchanged(les, self.tolerance)
+        assert numpy.isclose(les.les_change, 10.)
+        assert spskip.update_skips([les], self.tolerance, 3) == 0
@@ -1,3 +1,5 @@
+import os
+import tempfile
 import numpy
 from splib import sputils
 from splib import spdummy
@@ -43,3 +45,28 @@ class Testsputils(object):
         points = [(52.314970,4.824198),(52.379932,4.897997),(52.387264,5.082968),(52.278097,5.021635)]
         target = (52.356591, 4.954541)
         assert sputils.find_closest_points(points,target)[0] == 1
+
+    def test_stage_dir(self):
+        inputdir, stagedir = tempfile.mkdtemp(), os.path.join(tempfile.mkdtemp(), "staged")
+        for fname in ["namoptions", "prof.inp"]:
+            with open(os.path.join(inputdir, fname), "w") as f:
+                f.write(fname)
+        staged = sputils.stage_dir(inputdir, stagedir)
+        assert [os.path.basename(f) for f in staged] == ["namoptions", "prof.inp"]
+        # overwrite a staged file, keeping size and time stamps, to check that it is not copied again
+        marker = os.path.join(stagedir, "prof.inp")
+        st = os.stat(marker)
+        with open(marker, "w") as f:
+            f.write("PROF.INP")
+        os.utime(marker, (st.st_atime, st.st_mtime))
+        with open(os.path.join(inputdir, "namoptions"), "w") as f:
+            f.write("changed namoptions")
+        sputils.stage_dir(inputdir, stagedir)
+        with open(marker) as f:
+            assert f.read() == "PROF.INP"
+        with open(os.path.join(stagedir, "namoptions")) as f:
+            assert f.read() == "changed namoptions"
+
+    def test_array_nbytes(self):
+        data = {"a": numpy.zeros(10), "b": [numpy.zeros(4, dtype=numpy.float32), None], "c": "label"}
+        assert sputils.array_nbytes(data) == 96
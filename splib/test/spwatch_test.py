@@ -0,0 +1,64 @@
+import time
+
+from splib import spwatch
+
+
+class Testspwatch(object):
+
+    def test_straggler(self):
+        start = time.time()
+        steps = [spwatch.thread_step(time.sleep, (t,), str(i)) for i, t in enumerate([0.01, 0.02, 0.03, 1.])]
+        late = spwatch.wait_steps(steps, start, straggler_factor=5., poll_interval=0.01, min_time=0.2)
+        assert late == [3]
+        assert time.time() - start < 0.9
+        steps[3].finish()
+
+    def test_deadline(self):
+        start = time.time()
+        steps = [spwatch.thread_step(time.sleep, (t,), str(i)) for i, t in enumerate([0.01, 0.5])]
+        assert spwatch.wait_steps(steps, start, deadline=0.1, poll_interval=0.01) == [1]
+        assert spwatch.wait_steps(steps, start, poll_interval=0.01) == []
+
+    def test_call_deadline(self):
+        class Les(object):
+            pass
+
+        def calls(les, durations):
+            for d in durations:
+                spwatch.start_call(les)
+                time.sleep(d)
+
+        start = time.time()
+        fast, hung = Les(), Les()
+        steps = [spwatch.thread_step(calls, (fast, [0.02] * 2), "0", les=fast),
+                 spwatch.thread_step(calls, (hung, [0.01, 0.5]), "1", les=hung)]
+        assert spwatch.wait_steps(steps, start, poll_interval=0.01, call_deadline=0.1) == [1]
+        assert time.time() - start < 0.4
+        for step in steps:
+            step.finish()
+
+    def test_call_deadline_waits_healthy(self):
+        class Les(object):
+            pass
+
+        def calls(les, durations):
+            for d in durations:
+                spwatch.start_call(les)
+                time.sleep(d)
+
+        start = time.time()
+        hung, fast, slow = Les(), Les(), Les()
+        steps = [spwatch.thread_step(calls, (hung, [0.01, 1.]), "0", les=hung),
+                 spwatch.thread_step(calls, (fast, [0.05] * 2), "1", les=fast),
+                 spwatch.thread_step(calls, (slow, [0.05] * 6), "2", les=slow)]
+        assert spwatch.wait_steps(steps, start, poll_interval=0.01, call_deadline=0.1) == [0]
+        assert steps[1].done() and steps[2].done()
+        assert time.time() - start < 0.9
+        for step in steps:
+            step.finish()
+
+    def test_queued_step(self):
+        step = spwatch.queued_step(time.sleep, (0.01,))
+        assert not step.done()
+        step.run()
+        assert step.done() and step.finish() is None
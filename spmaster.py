@@ -31,6 +31,19 @@ def readable_dir(dirname):
         raise argparse.ArgumentTypeError("Input path {0} is not readable".format(dirname))
     return dirname
 
+
+# Parses a list of steps and step ranges, e.g. 5-10,20
+def parse_steps(steps):
+    result = []
+    for item in steps.split(","):
+        first, _, last = item.partition("-")
+        try:
+            result.extend(range(int(first), int(last or first) + 1))
+        except ValueError:
+            raise argparse.ArgumentTypeError("Invalid step range {0}".format(item))
+    return result
+
+
 # Splits the input into latitude/longitude pairs
 def parse_lat_lons(coordinate_list):
     n = len(coordinate_list)
@@ -87,6 +100,12 @@ def main():
                         default=splib.les_input_dir,
                         help="LES input directory")
 
+    parser.add_argument("--les_overlay", dest="les_overlay_files",
+                        metavar="FILE",
+                        nargs="+",
+                        default=splib.les_overlay_files,
+                        help="LES input files to copy into each LES run directory, other input files are linked")
+
     parser.add_argument("--lestype", dest="les_type",
                         metavar="TYPE",
                         choices=les_types,
@@ -100,12 +119,28 @@ def main():
                         default=splib.les_num_procs,
                         help="Nr. of MPI tasks per LES")
 
+    parser.add_argument("--les_startup", dest="les_startup_threads",
+                        metavar="N",
+                        type=int,
+                        default=splib.les_startup_threads,
+                        help="Nr. of LES instances to start up concurrently")
+
+    parser.add_argument("--les_per_worker", dest="les_columns_per_worker",
+                        metavar="N",
+                        type=int,
+                        default=splib.les_columns_per_worker,
+                        help="Nr. of superparametrized columns sharing a single LES worker (experimental)")
+
     parser.add_argument("--les_dt", dest="les_dt",
                         metavar="dt",
                         type=float,
                         default=60,
                         help="Time step (s) between saving LES statistics e.g. LWP fields")
 
+    parser.add_argument("--les_single_request", action="store_true",
+                        default=False,
+                        help="Evolve the LES over a GCM time step in a single request instead of les_dt increments")
+
     parser.add_argument("--spinup", dest="les_spinup",
                         metavar="T",
                         type=int,
@@ -183,6 +218,27 @@ def main():
                         default=None,
                         help="geoJSON file containing a polygon for statistics output")
 
+    parser.add_argument("--output_slab", dest="output_columns_slab", action="store_true",
+                        default=False,
+                        help="Store the extra output columns in a single netCDF group with a column dimension")
+
+    parser.add_argument("--output_background", dest="output_columns_background", action="store_true",
+                        default=False,
+                        help="Write the extra output columns in a background thread while the LES models evolve")
+
+    parser.add_argument("--journal", dest="output_journal", action="store_true",
+                        default=False,
+                        help="Write a binary step journal instead of the netCDF file during the run. Convert it "
+                             "afterwards with journal2nc.py")
+
+    parser.add_argument("--output_streams", dest="output_streams",
+                        metavar="JSON",
+                        type=json.loads,
+                        default=splib.output_streams,
+                        help="Output streams as a JSON dictionary, e.g. '{\"hourly\": {\"vars\": [\"thl\", \"qt\"], "
+                             "\"every\": 4, \"reduce\": \"mean\", \"file\": \"hourly.nc\"}}'. Variables not in "
+                             "a stream are written every time step")
+
     parser.add_argument("-a", "--all", action="store_true",
                         default=False,
                         help="Superparametrize all IFS grid columns")
@@ -201,6 +257,36 @@ def main():
                         help="Nr. of LES models to run concurrently. 1 denotes serial execution. Default: fully "
                              "parallel")
 
+    parser.add_argument("--cores", dest="les_core_budget",
+                        metavar="N",
+                        type=int,
+                        default=splib.les_core_budget,
+                        help="Nr. of cores for running LES instances. LES are started only when their MPI tasks fit. "
+                             "0: no limit, negative: all cores available to the master")
+
+    parser.add_argument("--metrics_port", dest="metrics_port",
+                        type=int,
+                        default=splib.metrics_port,
+                        help="Serve run metrics (step rate, phase latencies, les evolve times, memory, worker "
+                             "liveness) in the Prometheus text format on http://localhost:<port>/metrics")
+
+    parser.add_argument("--metrics_file", dest="metrics_file",
+                        default=splib.metrics_file,
+                        help="Status file in the output directory with the run metrics, rewritten after every step")
+
+    parser.add_argument("--profile_steps", dest="profile_steps",
+                        metavar="STEPS",
+                        type=parse_steps,
+                        default=splib.profile_steps,
+                        help="Profile the master during the given gcm steps, e.g. 5-10. Profiles of each step are "
+                             "written next to timing.txt, with a summary of the top functions by self time")
+
+    parser.add_argument("--precision", dest="coupling_precision",
+                        choices=["float64", "float32"],
+                        default=splib.coupling_precision,
+                        help="Precision of the coupling buffers and fields held by the master. float32 is used for "
+                             "winds, humidities and cloud fields only")
+
     parser.add_argument("--channel", dest="channel_type",
                         metavar="TYPE",
                         choices=["mpi", "sockets", "nospawn"],
@@ -208,14 +294,176 @@ def main():
                         default=splib.channel_type,
                         help="Amuse communication type")
 
+    parser.add_argument("--io_ranks", dest="io_ranks",
+                        metavar="N",
+                        type=int,
+                        default=splib.io_ranks,
+                        help="Nr. of dedicated MPI ranks writing the netCDF output, launched as spio_rank.py after "
+                             "the model workers (nospawn channel only)")
+
     parser.add_argument("--restart", action="store_true",
                         default=False,
                         help="Restart an old run")
 
+    parser.add_argument("--checkpoint", dest="checkpoint_interval",
+                        metavar="N",
+                        type=int,
+                        default=splib.checkpoint_interval,
+                        help="Nr. of GCM steps between coupler checkpoints, used for fast restarts. 0: no checkpoints")
+
+    parser.add_argument("--les_restart", dest="les_restart_interval",
+                        metavar="T",
+                        type=int,
+                        default=splib.les_restart_interval,
+                        help="Time (s) between LES restart files")
+
     parser.add_argument("--cplsurf", action="store_true",
                         default=False,
                         help="Couple surface fluxes and roughness lengths")
 
+    parser.add_argument("--async_coupling", action="store_true",
+                        default=False,
+                        help="Evolve the LES models concurrently with the GCM, applying their tendencies with a "
+                             "one step lag")
+
+    parser.add_argument("--event_driven", action="store_true",
+                        default=splib.event_driven,
+                        help="Drive the LES instances from a single thread, with asynchronous requests and at most "
+                             "--queue instances at a time. Used automatically when threads are requested "
+                             "but the MPI in use does not support them")
+
+    parser.add_argument("--pipelined_coupling", action="store_true",
+                        default=splib.pipelined_coupling,
+                        help="Couple every les in a thread of its own, exchanging its forcings and tendencies as "
+                             "soon as it is ready instead of with all les instances in turn")
+
+    parser.add_argument("--coupling_interval", dest="coupling_interval",
+                        metavar="N",
+                        type=int,
+                        default=splib.coupling_interval,
+                        help="Nr. of GCM steps per exchange with the LES. The LES evolve over N GCM steps with their "
+                             "forcings held, the GCM applies the last LES tendencies in between")
+
+    parser.add_argument("--les_nodes", dest="les_nodes",
+                        type=int,
+                        default=splib.les_nodes,
+                        help="Nr. of node sub-coordinators owning the LES instances. They set the LES forcings and "
+                             "compute the GCM tendencies locally, exchanging one message per step with the master")
+
+    parser.add_argument("--les_node_address", dest="les_node_address",
+                        metavar="HOST:PORT",
+                        default=splib.les_node_address,
+                        help="Address where the master waits for sub-coordinators started on the nodes with "
+                             "spnode_coordinator.py. By default the sub-coordinators are started locally")
+
+    parser.add_argument("--les_stage_dir", dest="les_stage_dir",
+                        metavar="DIR",
+                        default=splib.les_stage_dir,
+                        help="Node-local directory where every sub-coordinator copies the LES input once, linked "
+                             "into the LES run directories of its node. By default the LES run directories link to "
+                             "the input staged in the output directory")
+
+    parser.add_argument("--les_deadline", dest="les_step_deadline",
+                        type=float,
+                        default=splib.les_step_deadline,
+                        help="Wall time (s) for the LES instances per GCM step, after which the watchdog reports "
+                             "the late instances and applies --les_deadline_policy")
+
+    parser.add_argument("--les_call_deadline", dest="les_call_deadline",
+                        metavar="T",
+                        type=float,
+                        default=splib.les_call_deadline,
+                        help="Wall time (s) of a single request to an LES, after which it is late, see "
+                             "--les_deadline_policy (0: no limit)")
+
+    parser.add_argument("--les_straggler_factor", dest="les_straggler_factor",
+                        type=float,
+                        default=splib.les_straggler_factor,
+                        help="An LES is also late when it takes this many times the median LES wall time of the "
+                             "step, once half of the instances are done")
+
+    parser.add_argument("--les_deadline_policy", dest="les_deadline_policy",
+                        choices=["wait", "reuse", "drop"],
+                        default=splib.les_deadline_policy,
+                        help="For late LES instances: keep waiting, reuse their last tendencies until they catch up, "
+                             "or drop their columns from the superparametrization")
+
+    parser.add_argument("--les_failover", dest="les_failover", action="store_true",
+                        default=False,
+                        help="Replace an LES failing during a step, from its latest restart file or initialized to "
+                             "its GCM column, instead of ending the run. Failovers are listed in failover.txt")
+
+    parser.add_argument("--health_checks", dest="health_checks", action="store_true",
+                        default=False,
+                        help="Check the LES columns for non-finite or out of bounds profiles and outlier tendencies "
+                             "every step, and quarantine failing columns. Listed in health.txt")
+
+    parser.add_argument("--health_outlier_factor", dest="health_outlier_factor",
+                        type=float,
+                        default=splib.health_outlier_factor,
+                        help="A GCM tendency is an outlier at this many times the median over the LES columns "
+                             "(0: no outlier check)")
+
+    parser.add_argument("--health_reset", dest="health_reset", action="store_true",
+                        default=False,
+                        help="Reset quarantined LES instances to their GCM column instead of stopping them")
+
+    parser.add_argument("--health_max_resets", dest="health_max_resets",
+                        metavar="N",
+                        type=int,
+                        default=splib.health_max_resets,
+                        help="Nr. of resets of an LES failing the health checks, after which it is stopped "
+                             "(0: no limit)")
+
+    parser.add_argument("--dynamic_mask", dest="dynamic_mask", action="store_true",
+                        default=False,
+                        help="Run LES only in the selected columns whose GCM state crosses the dynamic mask "
+                             "thresholds, suspending LES instances in quiet columns")
+
+    parser.add_argument("--dynamic_mask_thresholds", dest="dynamic_mask_thresholds",
+                        type=json.loads,
+                        default=splib.dynamic_mask_thresholds,
+                        help="Column indicators activating an LES, as JSON, e.g. '{\"A\": 0.05, \"instability\": 2}'. "
+                             "Indicators: A (max. cloud fraction), QL (max. condensate, kg/kg), instability (K)")
+
+    parser.add_argument("--dynamic_mask_quiet_steps", dest="dynamic_mask_quiet_steps",
+                        metavar="N",
+                        type=int,
+                        default=splib.dynamic_mask_quiet_steps,
+                        help="Nr. of quiet steps after which the LES of a column is suspended")
+
+    parser.add_argument("--dynamic_mask_retire", dest="dynamic_mask_retire", action="store_true",
+                        default=False,
+                        help="Stop the LES of quiet columns instead of suspending them for reactivation")
+
+    parser.add_argument("--les_clustering", dest="les_clustering", action="store_true",
+                        default=False,
+                        help="Run LES only in representative columns of the region, at most --numles, and apply "
+                             "their tendencies to the similar columns. Assignments are stored in the clusters group")
+
+    parser.add_argument("--les_cluster_tolerance", dest="les_cluster_tolerance",
+                        type=json.loads,
+                        default=splib.les_cluster_tolerance,
+                        help="RMS profile differences of similar columns, as JSON with the keys Tv (K), QT (kg/kg), "
+                             "U and V (m/s)")
+
+    parser.add_argument("--incremental_coupling", dest="incremental_coupling", action="store_true",
+                        default=False,
+                        help="Skip the exchange with the LES of a column while its GCM and LES profiles change less "
+                             "than --incremental_tolerance, reusing its forcings and tendencies")
+
+    parser.add_argument("--incremental_tolerance", dest="incremental_tolerance",
+                        type=json.loads,
+                        default=splib.incremental_tolerance,
+                        help="Max. changes of the profiles of quiet columns between exchanges, as JSON with the GCM "
+                             "keys U, V, T, SH and the LES keys u, v, thl, qt")
+
+    parser.add_argument("--incremental_refresh", dest="incremental_refresh",
+                        metavar="N",
+                        type=int,
+                        default=splib.incremental_refresh,
+                        help="Nr. of steps after which the exchange with an LES is forced")
+
     parser.add_argument("--qt_forcing", dest="qt_forcing",
                         metavar="TYPE",
                         choices=["sp", "variance", "local"],
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+
+# Node sub-coordinator for superparametrization runs, owning the LES instances of its node.
+# See the --les_nodes option of spmaster.py. For multi-node runs, start one per node after the master,
+# with the address the master listens on and the same SPIFS_NODE_KEY in the environment, e.g.
+#   export SPIFS_NODE_KEY=<secret>
+#   python2 ./spmaster.py --les_nodes 4 --les_node_address master-host:5710 ... &
+#   srun -N 4 -n 4 python2 ./spnode_coordinator.py master-host:5710
+
+import logging
+import sys
+
+from splib import splib, spnode
+
+logging.basicConfig(level=logging.INFO)
+
+if __name__ == "__main__":
+    spnode.serve(sys.argv[1], splib)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+# Startup time benchmark for the spifs master script
+#
+# Runs short commands in fresh interpreters and reports the wall clock time they take,
+# to keep track of the import cost paid by every (short) spmaster job.
+#
+# usage: python startup_bench.py [-n N] [-- extra spmaster arguments]
+
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Commands timed by default: bare imports and the master script's argument parsing
+commands = [("python", [sys.executable, "-c", "pass"]),
+            ("import splib", [sys.executable, "-c", "from splib import splib"]),
+            ("spmaster --help", [sys.executable, "spmaster.py", "--help"])]
+
+
+# Times a command a number of times in fresh processes, returns the run times
+def time_command(args, repeat):
+    times = []
+    with open(os.devnull, "w") as devnull:
+        for i in range(repeat):
+            start = time.time()
+            subprocess.check_call(args, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    return times
+
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description="spmaster startup time benchmark")
+    parser.add_argument("-n", dest="repeat", metavar="N", type=int, default=5,
+                        help="Nr. of runs per command")
+    parser.add_argument("extra", nargs=argparse.REMAINDER,
+                        help="Additional spmaster arguments to time, e.g. -- --dryrun --gcmtype dummy")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    cmds = list(commands)
+    extra = [a for a in args.extra if a != "--"]
+    if any(extra):
+        cmds.append(("spmaster " + " ".join(extra), [sys.executable, "spmaster.py"] + extra))
+    for name, cmd in cmds:
+        times = sorted(time_command(cmd, args.repeat))
+        print("%-40s min %7.3f s  median %7.3f s" % (name, times[0], times[len(times) // 2]))
+
+
+if __name__ == "__main__":
+    main()